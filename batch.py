@@ -0,0 +1,114 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List
+
+from models import Request, Response
+
+BATCH_CONCURRENCY = 16
+# Streaming keeps at most this many times the concurrency of requests started ahead of the oldest one
+# still running, which bounds the responses buffered to be written in input order
+STREAM_WINDOW_FACTOR = 4
+
+
+# Common code for Part A and Part B
+def read_requests(input_filename: str) -> List[Request]:
+    return list(iter_requests(input_filename))
+
+
+# Requests of the input file one line at a time, blank lines are skipped
+def iter_requests(input_filename: str) -> Iterator[Request]:
+    with open(input_filename, 'r') as input_file:
+        for query in input_file:
+            query = query.rstrip('\n')
+            if len(query.strip()) == 0:
+                continue
+            url, type = tuple(query.split(" "))
+            yield Request(
+                name=url,
+                type=type
+            )
+
+
+# Resolve all requests with at most `concurrency` of them in flight, results are in request order
+def resolve_batch(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        requests: List[Request],
+        concurrency: int = BATCH_CONCURRENCY
+) -> List[Response]:
+    return asyncio.run(__resolve_batch__(resolve_dns_async, requests, concurrency))
+
+
+async def __resolve_batch__(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        requests: List[Request],
+        concurrency: int
+) -> List[Response]:
+    # The blocking resolver walks run on the loop's default executor, size it to the number in flight
+    concurrency = max(1, concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    asyncio.get_running_loop().set_default_executor(executor)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve_one(request: Request) -> Response:
+        async with semaphore:
+            return await resolve_dns_async(request)
+
+    try:
+        return await asyncio.gather(*(resolve_one(request) for request in requests))
+    finally:
+        executor.shutdown(wait=False)
+
+
+# Resolves requests taken lazily from the iterable with at most `concurrency` in flight and hands every
+# response to `on_response` in request order as soon as it and all earlier ones are done
+def resolve_stream(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        requests: Iterable[Request],
+        on_response: Callable[[Response], None],
+        concurrency: int = BATCH_CONCURRENCY
+):
+    asyncio.run(__resolve_stream__(resolve_dns_async, requests, on_response, concurrency))
+
+
+async def __resolve_stream__(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        requests: Iterable[Request],
+        on_response: Callable[[Response], None],
+        concurrency: int
+):
+    concurrency = max(1, concurrency)
+    window = concurrency * STREAM_WINDOW_FACTOR
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    asyncio.get_running_loop().set_default_executor(executor)
+
+    pending_requests = iter(requests)
+    has_pending_requests = True
+    in_flight: Dict[asyncio.Task, int] = {}
+    done_responses: Dict[int, Response] = {}
+    next_index = 0
+    next_to_write = 0
+
+    try:
+        while True:
+            while has_pending_requests and len(in_flight) < concurrency and next_index < next_to_write + window:
+                request = next(pending_requests, None)
+                if request is None:
+                    has_pending_requests = False
+                    break
+                in_flight[asyncio.ensure_future(resolve_dns_async(request))] = next_index
+                next_index += 1
+
+            if len(in_flight) == 0:
+                return
+
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                done_responses[in_flight.pop(task)] = task.result()
+
+            while next_to_write in done_responses:
+                on_response(done_responses.pop(next_to_write))
+                next_to_write += 1
+    finally:
+        for task in in_flight:
+            task.cancel()
+        executor.shutdown(wait=False)
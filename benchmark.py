@@ -0,0 +1,190 @@
+import argparse
+import itertools
+import random
+import resource
+import time
+import tracemalloc
+from typing import Callable, List, Tuple
+
+import dns.message
+import dns.rdatatype
+
+import dnssec_validation
+import metrics
+from batch import resolve_batch
+from fake_hierarchy import FakeHierarchy
+from loadtest import __percentile__
+from models import Request
+from referrals import parse_referral
+from sharding import resolve_sharded
+import mydig
+import mydig_dnssec
+import transport
+
+BENCHMARK_PORT = 5300
+BENCHMARK_QUERIES = 2000
+BENCHMARK_ZONES_PER_TLD = 100
+BENCHMARK_CONCURRENCY = 16
+# Popularity of the n-th most asked name falls off like 1 / n ** ZIPF_EXPONENT
+ZIPF_EXPONENT = 1.0
+NXDOMAIN_FRACTION = 0.1
+MODES = ["mydig", "mydig_dnssec", "batch", "batch_dnssec", "referral_parser"]
+
+
+# Common code for Part A and Part B
+# Questions for the fake hierarchy's leaf zones with a Zipf-like popularity: the apex, www (a CNAME) and
+# mail names, MX and NS for some apexes, and a share of names that do not exist
+def generate_requests(hierarchy: FakeHierarchy, total_queries: int, seed: int = 1) -> List[Request]:
+    generator = random.Random(seed)
+    questions = []
+    for zone in hierarchy.leaf_zones:
+        apex = zone.name.to_text()
+        questions += [Request(name=apex, type="A"), Request(name="www." + apex, type="A"),
+                      Request(name="mail." + apex, type="A"), Request(name=apex, type="MX"),
+                      Request(name=apex, type="NS")]
+    generator.shuffle(questions)
+    weights = [1 / (rank + 1) ** ZIPF_EXPONENT for rank in range(len(questions))]
+
+    requests = []
+    for request in generator.choices(questions, weights=weights, k=total_queries):
+        if generator.random() < NXDOMAIN_FRACTION:
+            apex = generator.choice(hierarchy.leaf_zones).name.to_text()
+            request = Request(name="missing%d.%s" % (generator.randrange(1000000), apex), type="A")
+        requests.append(request)
+    return requests
+
+
+# Points both resolvers at the fake root server, and for DNSSEC at the fake root's key as trust anchor
+def use_hierarchy(hierarchy: FakeHierarchy):
+    transport.DNS_PORT = hierarchy.port
+    for file_name in (mydig.ROOT_SERVER_IPV4S_FILE_NAME, mydig_dnssec.ROOT_SERVER_IPV4S_FILE_NAME):
+        mydig.root_server_ips_by_file[file_name] = [hierarchy.root_ip]
+    if hierarchy.root.signed:
+        dnssec_validation.trust_anchors = (None, hierarchy.root_dnskey())
+
+
+# Resolves the requests with the given mode and reports rate, latency percentiles, packets the fake servers
+# received per query and peak memory
+def run_benchmark(hierarchy: FakeHierarchy, mode: str, requests: List[Request], concurrency: int,
+                  trace_memory: bool, workers: int = 1):
+    dnssec = mode.endswith("dnssec")
+    resolver = mydig_dnssec if dnssec else mydig
+    latencies = []
+    failures = 0
+
+    def timed(resolve_dns: Callable):
+        def resolve(request: Request):
+            nonlocal failures
+            start_time = time.perf_counter()
+            response = resolve_dns(request)
+            latencies.append(time.perf_counter() - start_time)
+            if len(response.answer_records) == 0 and len(response.authority_records) == 0:
+                failures += 1
+            return response
+        return resolve
+
+    async def resolve_async(request: Request):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, timed(resolver.resolve_dns), request)
+
+    if trace_memory:
+        tracemalloc.start()
+    packets_before = hierarchy.packets
+    start_time = time.perf_counter()
+
+    if mode.startswith("batch") and workers > 1:
+        # The resolutions run in worker processes, which time them in query_time
+        def on_response(response):
+            nonlocal failures
+            latencies.append(response.query_time / 1000)
+            if len(response.answer_records) == 0 and len(response.authority_records) == 0:
+                failures += 1
+
+        resolve_sharded(resolver.resolve_dns_async, requests, on_response, workers, concurrency)
+    elif mode.startswith("batch"):
+        resolve_batch(resolve_async, requests, concurrency)
+    else:
+        resolve = timed(resolver.resolve_dns)
+        for request in requests:
+            resolve(request)
+
+    elapsed = time.perf_counter() - start_time
+    packets = hierarchy.packets - packets_before
+
+    latencies.sort()
+    print("Mode: " + mode + ", queries: " + str(len(requests)) + ", failed: " + str(failures))
+    print("Rate: " + str(round(len(requests) / elapsed, 1)) + " queries/s")
+    for percent in (50, 90, 99):
+        print("p" + str(percent) + " latency: " + str(round(__percentile__(latencies, percent) * 1000, 2)) + " ms")
+    print("Packets sent per query: " + str(round(packets / max(1, len(requests)), 3)))
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("Peak traced memory: " + str(round(peak / 1024 / 1024, 1)) + " MiB")
+    # Includes the fake servers, which run in this process
+    print("Peak RSS: " + str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)) + " MiB")
+
+
+# Referrals from the root and TLD servers of the hierarchy as (query, response wire)
+def generate_referrals(hierarchy: FakeHierarchy) -> List[Tuple[dns.message.Message, bytes]]:
+    referrals = []
+    for zone in hierarchy.leaf_zones:
+        request_message = dns.message.make_query("www." + zone.name.to_text(), "A", use_edns=0,
+                                                 payload=transport.EDNS_PAYLOAD_SIZE)
+        for server_zone in hierarchy.zones.values():
+            if server_zone is zone or not zone.name.is_subdomain(server_zone.name):
+                continue
+            response_message = server_zone.respond(request_message)
+            if len(response_message.answer) == 0 and response_message.authority[0].rdtype == dns.rdatatype.NS:
+                referrals.append((request_message, response_message.to_wire()))
+    return referrals
+
+
+# CPU time per referral packet of the lean referral parser against dnspython's full parser, no network
+def run_referral_parser_benchmark(hierarchy: FakeHierarchy, iterations: int):
+    referrals = generate_referrals(hierarchy)
+    for name, parse in (("full", transport.__parse_full_response__), ("lean", parse_referral)):
+        start_time = time.process_time()
+        for request_message, response_wire in itertools.islice(itertools.cycle(referrals), iterations):
+            parse(request_message, response_wire)
+        elapsed = time.process_time() - start_time
+        print("Referral parser " + name + ": " + str(round(elapsed / iterations * 1000000, 1)) + " us per packet")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, default="batch")
+    parser.add_argument("--queries", type=int, default=BENCHMARK_QUERIES,
+                        help="queries per pass, or packets parsed in referral_parser mode")
+    parser.add_argument("--concurrency", type=int, default=BENCHMARK_CONCURRENCY, help="requests in flight in batch modes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="shard batch modes by zone across this many processes")
+    parser.add_argument("--zones-per-tld", type=int, default=BENCHMARK_ZONES_PER_TLD)
+    parser.add_argument("--glueless-fraction", type=float, default=0.0,
+                        help="share of leaf zones delegated to a name server without glue")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every fake server waits before answering")
+    parser.add_argument("--loss", type=float, default=0.0, help="share of UDP queries the fake servers drop")
+    parser.add_argument("--port", type=int, default=BENCHMARK_PORT, help="port of the fake servers on 127.53.x.y")
+    parser.add_argument("--passes", type=int, default=1, help="resolve the same queries again with warm caches")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace-memory", action="store_true", help="report the peak memory traced by tracemalloc")
+    parser.add_argument("--metrics", choices=metrics.METRICS_FORMATS,
+                        help="print cache, latency and server RTT metrics after the last pass")
+    args = parser.parse_args()
+
+    fake_hierarchy = FakeHierarchy(args.zones_per_tld, args.mode.endswith("dnssec"), args.glueless_fraction,
+                                   args.port, args.latency, args.loss, args.seed)
+    if args.mode == "referral_parser":
+        run_referral_parser_benchmark(fake_hierarchy, args.queries)
+    else:
+        fake_hierarchy.start()
+        use_hierarchy(fake_hierarchy)
+        benchmark_requests = generate_requests(fake_hierarchy, args.queries, args.seed)
+        try:
+            for _ in range(args.passes):
+                run_benchmark(fake_hierarchy, args.mode, benchmark_requests, args.concurrency, args.trace_memory,
+                              args.workers)
+            if args.metrics is not None:
+                print(metrics.export_metrics(args.metrics))
+        finally:
+            fake_hierarchy.stop()
@@ -0,0 +1,400 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+import persistence
+import prefetch
+
+CACHE_MAX_SIZE = 10000
+# Expired RRsets are kept this long to answer with when the authoritative servers cannot be reached
+# (RFC 8767), 0 drops them at expiry. Stale answers are handed out with STALE_ANSWER_TTL.
+STALE_MAX_AGE = 0
+STALE_ANSWER_TTL = 30
+
+
+class CacheEntry:
+    rrset: dns.rrset.RRset
+    expires_at: float
+    secure: bool
+    glue: bool
+    hits: int
+
+    def __init__(self, rrset: dns.rrset.RRset, expires_at: float, secure: bool, glue: bool = False):
+        self.rrset = rrset
+        self.expires_at = expires_at
+        self.secure = secure
+        self.glue = glue
+        self.hits = 0
+
+
+class NegativeEntry:
+    rcode: dns.rcode.Rcode
+    soa_rrset: dns.rrset.RRset
+    expires_at: float
+    secure: bool
+
+    def __init__(self, rcode: dns.rcode.Rcode, soa_rrset: dns.rrset.RRset, expires_at: float, secure: bool):
+        self.rcode = rcode
+        self.soa_rrset = soa_rrset
+        self.expires_at = expires_at
+        self.secure = secure
+
+
+# Common code for Part A and Part B
+# RRsets keyed by (name, type, class), expired by record TTL and evicted least recently used first.
+# Entries stored by mydig_dnssec after validation are marked secure, so that the DNSSEC resolver
+# never serves data that only went through the unvalidated resolver.
+# Delegation NS records and glue addresses from referrals rank below answers (RFC 2181 section 5.4.1): they
+# never replace an answer, are only returned to find name server addresses and are not persisted.
+# Negative answers (RFC 2308) are kept next to the RRsets with the SOA record that came with them: NXDOMAIN
+# per name, also answering for every name below it (RFC 8020), and NODATA per name and type.
+# With a stale_max_age, expired RRsets stay around (still counting towards max_size) for get_stale.
+# With a warm cache file open, memory misses are read from it outside the lock, keys it does not have either
+# are remembered (up to max_size of them) so they are not read again until put.
+class RRsetCache:
+    max_size: int
+    stale_max_age: float
+    hits: int
+    misses: int
+    negative_hits: int
+    stale_hits: int
+    evictions: int
+    expirations: int
+
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, stale_max_age: float = STALE_MAX_AGE):
+        self.max_size = max_size
+        self.stale_max_age = stale_max_age
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__entries = OrderedDict()
+        self.__negative_entries = OrderedDict()
+        self.__persisted_misses = OrderedDict()
+        self.__lock = threading.Lock()
+
+    # Looks up each of the given types in order and returns the first live RRset, counting one hit or miss.
+    # With `glue`, delegation NS records and glue addresses are returned as well.
+    def get(self, name: dns.name.Name, rdtypes: Tuple[dns.rdatatype.RdataType, ...],
+            rdclass: dns.rdataclass.RdataClass = dns.rdataclass.IN,
+            secure: bool = False, glue: bool = False) -> Optional[dns.rrset.RRset]:
+        if persistence.persistent_store is not None:
+            self.__load_persisted_entries__([(name, rdtype, rdclass) for rdtype in rdtypes])
+
+        now = time.time()
+        entry = None
+
+        with self.__lock:
+            for rdtype in rdtypes:
+                key = (name, rdtype, rdclass)
+                entry = self.__entries.get(key)
+                if entry is not None and entry.expires_at <= now:
+                    if entry.expires_at + self.stale_max_age <= now:
+                        del self.__entries[key]
+                        self.expirations += 1
+                    entry = None
+
+                if entry is not None and (entry.secure or not secure) and (glue or not entry.glue):
+                    break
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            entry.hits += 1
+
+        if prefetch.prefetcher is not None:
+            prefetch.prefetcher.consider(name, entry.rrset.rdtype, entry.hits, entry.rrset.ttl, entry.expires_at - now)
+
+        # Hand out a copy carrying the remaining TTL, the cached RRset itself is never modified
+        rrset = entry.rrset.copy()
+        rrset.ttl = int(entry.expires_at - now)
+        return rrset
+
+    # Like get, but only returns RRsets that expired less than stale_max_age ago, for when a fresh copy
+    # could not be fetched
+    def get_stale(self, name: dns.name.Name, rdtypes: Tuple[dns.rdatatype.RdataType, ...],
+                  rdclass: dns.rdataclass.RdataClass = dns.rdataclass.IN,
+                  secure: bool = False) -> Optional[dns.rrset.RRset]:
+        now = time.time()
+        entry = None
+
+        with self.__lock:
+            for rdtype in rdtypes:
+                entry = self.__entries.get((name, rdtype, rdclass))
+                if entry is not None and entry.expires_at <= now < entry.expires_at + self.stale_max_age and \
+                        (entry.secure or not secure) and not entry.glue:
+                    break
+                entry = None
+
+            if entry is None:
+                return None
+            self.stale_hits += 1
+
+        rrset = entry.rrset.copy()
+        rrset.ttl = STALE_ANSWER_TTL
+        return rrset
+
+    def put(self, rrset: dns.rrset.RRset, secure: bool = False, glue: bool = False):
+        if rrset.ttl <= 0 or self.max_size <= 0:
+            return
+
+        key = (rrset.name, rrset.rdtype, rrset.rdclass)
+        now = time.time()
+
+        with self.__lock:
+            existing = self.__entries.get(key)
+            # Unvalidated data must not replace a live validated entry, nor glue a live answer
+            if existing is not None and existing.expires_at > now and \
+                    (existing.secure and not secure or glue and not existing.glue):
+                return
+
+            self.__insert_entry__(self.__entries, key, CacheEntry(rrset, now + rrset.ttl, secure, glue))
+            if glue:
+                return
+            self.__persisted_misses.pop(key, None)
+            # The name has records of this type now, and it and every name above it exist
+            self.__negative_entries.pop(key, None)
+            for ancestor in __ancestors__(rrset.name):
+                self.__negative_entries.pop((ancestor, None, rrset.rdclass), None)
+
+        if persistence.persistent_store is not None:
+            persistence.persistent_store.save_rrset(rrset, now + rrset.ttl, secure)
+
+    # The negative answer for the type at the name, as (rcode, SOA RRset with the remaining TTL). A cached
+    # NXDOMAIN of the name or of any name above it is an NXDOMAIN answer as well.
+    def get_negative(self, name: dns.name.Name, rdtype: dns.rdatatype.RdataType,
+                     rdclass: dns.rdataclass.RdataClass = dns.rdataclass.IN,
+                     secure: bool = False) -> Optional[Tuple[dns.rcode.Rcode, dns.rrset.RRset]]:
+        now = time.time()
+        entry = None
+
+        with self.__lock:
+            for key in [(name, rdtype, rdclass)] + [(ancestor, None, rdclass) for ancestor in __ancestors__(name)]:
+                entry = self.__negative_entries.get(key)
+                if entry is not None and entry.expires_at <= now:
+                    del self.__negative_entries[key]
+                    self.expirations += 1
+                    entry = None
+
+                if entry is not None and (entry.secure or not secure):
+                    break
+                entry = None
+
+            if entry is None:
+                return None
+
+            self.__negative_entries.move_to_end(key)
+            self.negative_hits += 1
+
+        soa_rrset = entry.soa_rrset.copy()
+        soa_rrset.ttl = int(entry.expires_at - now)
+        return entry.rcode, soa_rrset
+
+    # NXDOMAIN is stored for the name whatever the type, NODATA for the type only.
+    # The entry lives for the SOA TTL or SOA minimum, whichever is lower.
+    def put_negative(self, name: dns.name.Name, rdtype: dns.rdatatype.RdataType,
+                     rdclass: dns.rdataclass.RdataClass, rcode: dns.rcode.Rcode, soa_rrset: dns.rrset.RRset,
+                     secure: bool = False):
+        ttl = min(soa_rrset.ttl, soa_rrset[0].minimum)
+        if ttl <= 0 or self.max_size <= 0:
+            return
+
+        key = (name, None if rcode == dns.rcode.NXDOMAIN else rdtype, rdclass)
+        now = time.time()
+
+        with self.__lock:
+            existing = self.__negative_entries.get(key)
+            if existing is not None and existing.secure and not secure and existing.expires_at > now:
+                return
+
+            self.__insert_entry__(self.__negative_entries, key, NegativeEntry(rcode, soa_rrset, now + ttl, secure))
+
+    def __insert_entry__(self, entries: OrderedDict, key: tuple, entry):
+        entries[key] = entry
+        entries.move_to_end(key)
+
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+            self.evictions += 1
+
+    # Memory misses fall through to the on-disk warm cache. The reads happen outside the lock, so other threads
+    # keep answering from memory meanwhile, and what they find is inserted unless a put got there first.
+    def __load_persisted_entries__(self, keys: List[tuple]):
+        with self.__lock:
+            keys = [key for key in keys if key not in self.__entries and key not in self.__persisted_misses]
+        if len(keys) == 0:
+            return
+
+        loaded_entries = [(key, persistence.persistent_store.load_rrset(*key)) for key in keys]
+        with self.__lock:
+            for key, loaded in loaded_entries:
+                if loaded is None:
+                    self.__persisted_misses[key] = True
+                    if len(self.__persisted_misses) > self.max_size:
+                        self.__persisted_misses.popitem(last=False)
+                elif key not in self.__entries:
+                    rrset, expires_at, secure = loaded
+                    self.__insert_entry__(self.__entries, key, CacheEntry(rrset, expires_at, secure))
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__negative_entries.clear()
+            self.__persisted_misses.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "size": len(self.__entries),
+                "negative_size": len(self.__negative_entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "stale_hits": self.stale_hits,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+def __ancestors__(name: dns.name.Name):
+    while True:
+        yield name
+        if len(name) <= 1:
+            return
+        name = name.parent()
+
+
+rrset_cache = RRsetCache()
+
+
+# Builds a response for the question of the request message out of cached RRsets, or None on a miss.
+# A cached CNAME is returned on its own, so the caller follows it like a CNAME from a server.
+# A cached negative answer comes back as the NXDOMAIN or NODATA response with its SOA record.
+# Prefetches skip the cache, they are there to replace what it holds.
+def lookup_response_message(request_message: dns.message.Message, secure: bool = False) -> \
+      Optional[dns.message.Message]:
+    if prefetch.refreshing.get():
+        return None
+
+    question = request_message.question[0]
+    rrset = rrset_cache.get(question.name, (question.rdtype, dns.rdatatype.CNAME), question.rdclass, secure)
+    if rrset is not None:
+        response_message = dns.message.make_response(request_message)
+        response_message.answer.append(rrset)
+        return response_message
+
+    negative = rrset_cache.get_negative(question.name, question.rdtype, question.rdclass, secure)
+    if negative is not None:
+        rcode, soa_rrset = negative
+        response_message = dns.message.make_response(request_message)
+        response_message.set_rcode(rcode)
+        response_message.authority.append(soa_rrset)
+        return response_message
+
+    return None
+
+
+# Response for the question out of RRsets that expired less than stale_max_age ago (RFC 8767), or None
+def lookup_stale_response_message(request_message: dns.message.Message, secure: bool = False) -> \
+      Optional[dns.message.Message]:
+    question = request_message.question[0]
+    rrset = rrset_cache.get_stale(question.name, (question.rdtype, dns.rdatatype.CNAME), question.rdclass, secure)
+    if rrset is None:
+        return None
+
+    response_message = dns.message.make_response(request_message)
+    response_message.answer.append(rrset)
+    return response_message
+
+
+# Stores the answers of a response from the servers of `zone`, and the delegation NS records and glue
+# addresses of a referral as glue. Records outside the zone are not the servers' to give and are left out.
+# Validated answers are not kept past the expiration of their signatures. With `secure`, a negative answer
+# must have been proven by its NSEC or NSEC3 records.
+def cache_response_message(response_message: dns.message.Message, zone: dns.name.Name, secure: bool = False):
+    for rrset in response_message.answer:
+        if rrset.rdtype == dns.rdatatype.RRSIG or not rrset.name.is_subdomain(zone):
+            continue
+
+        if secure:
+            rrset = __limit_ttl_to_signatures__(rrset, response_message.answer)
+        rrset_cache.put(rrset, secure)
+
+    __cache_negative_answer__(response_message, zone, secure)
+
+    if len(response_message.answer) > 0:
+        return
+
+    for rrset in response_message.authority:
+        if rrset.rdtype == dns.rdatatype.NS and rrset.name.is_subdomain(zone):
+            rrset_cache.put(rrset, glue=True)
+
+    for rrset in response_message.additional:
+        if rrset.rdtype == dns.rdatatype.A and rrset.name.is_subdomain(zone):
+            rrset_cache.put(rrset, glue=True)
+
+
+# An NXDOMAIN or NODATA response, possibly at the end of a CNAME chain, is recognized by the SOA record of
+# the zone in the authority section. Referrals carry NS records there instead.
+def __cache_negative_answer__(response_message: dns.message.Message, zone: dns.name.Name, secure: bool):
+    soa_rrsets = [rrset for rrset in response_message.authority
+                  if rrset.rdtype == dns.rdatatype.SOA and rrset.name.is_subdomain(zone)]
+    if len(soa_rrsets) == 0 or len(response_message.question) == 0:
+        return
+
+    question = response_message.question[0]
+    name = question.name
+    answered = False
+    for _ in range(len(response_message.answer) + 1):
+        rrsets = {rrset.rdtype: rrset for rrset in response_message.answer
+                  if rrset.name == name and rrset.rdclass == question.rdclass}
+        if question.rdtype in rrsets:
+            answered = True
+            break
+        if dns.rdatatype.CNAME not in rrsets:
+            break
+        name = rrsets[dns.rdatatype.CNAME][0].target
+
+    rcode = response_message.rcode()
+    soa_rrset = soa_rrsets[0]
+    # A CNAME chain leaving the zone ends at a name the SOA says nothing about
+    if answered or rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN) or not name.is_subdomain(soa_rrset.name):
+        return
+
+    # The DNSSEC walk proves the negative answers it asked for, not one at the end of a CNAME chain, which it
+    # asks about again instead
+    secure = secure and len(response_message.answer) == 0
+    if secure:
+        soa_rrset = __limit_ttl_to_signatures__(soa_rrset, response_message.authority)
+    rrset_cache.put_negative(name, question.rdtype, question.rdclass, rcode, soa_rrset, secure)
+
+
+def __limit_ttl_to_signatures__(rrset: dns.rrset.RRset, section) -> dns.rrset.RRset:
+    expirations = [rrsig.expiration for rrsig_rrset in section
+                   if rrsig_rrset.rdtype == dns.rdatatype.RRSIG and rrsig_rrset.covers == rrset.rdtype
+                   and rrsig_rrset.name == rrset.name for rrsig in rrsig_rrset]
+    if len(expirations) == 0:
+        return rrset
+
+    ttl = min(rrset.ttl, int(min(expirations) - time.time()))
+    if ttl >= rrset.ttl:
+        return rrset
+
+    limited_rrset = rrset.copy()
+    limited_rrset.ttl = max(ttl, 0)
+    return limited_rrset
@@ -0,0 +1,221 @@
+import atexit
+import mmap
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dns.flags
+import dns.message
+from dns.message import Message
+
+# Capture file: a header, one record per upstream exchange in the order they happened and, once the capture
+# is closed, an index of the records by question and server followed by a footer pointing at it. A capture
+# cut short has no index, readers then scan the records.
+CAPTURE_MAGIC = b"MDCAP"
+CAPTURE_VERSION = 1
+# Magic, version, wall clock time the capture started
+FILE_HEADER = struct.Struct("<5sBd")
+# Seconds since the start of the capture, round trip (or time waited for a timeout), protocol, server IP,
+# request and response lengths. A response length of 0 records a timeout.
+RECORD_HEADER = struct.Struct("<dfBBHH")
+# Record offset, qtype, qclass, protocol, DO bit, server IP and qname lengths
+INDEX_ENTRY = struct.Struct("<QHHBBBB")
+INDEX_MAGIC = b"MDIX"
+# Index offset, number of index entries, magic
+FOOTER = struct.Struct("<QI4s")
+PROTOCOLS = ["udp", "tcp"]
+
+
+# Common code for Part A and Part B
+class CapturedExchange:
+    rtt: float
+    response_wire: Optional[bytes]
+
+    def __init__(self, rtt: float, response_wire: Optional[bytes]):
+        self.rtt = rtt
+        self.response_wire = response_wire
+
+
+# Writes every upstream query of this process with its raw response, or its timeout, to a capture file
+class CaptureRecorder:
+    file_name: str
+    records: int
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.records = 0
+        self.__started_at = time.time()
+        self.__index = []
+        self.__lock = threading.Lock()
+        self.__file = open(file_name, "wb")
+        self.__file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, self.__started_at))
+
+    def record(self, request_message: Message, request_wire: bytes, server_ip: str, protocol: str, sent_at: float,
+               rtt: float, response_wire: Optional[bytes]):
+        response_wire = b"" if response_wire is None else response_wire
+        ip = server_ip.encode()
+        header = RECORD_HEADER.pack(sent_at - self.__started_at, rtt, PROTOCOLS.index(protocol), len(ip),
+                                    len(request_wire), len(response_wire))
+        key = __key__(request_message, server_ip, protocol)
+        with self.__lock:
+            if self.__file is None:
+                return
+            self.__index.append((self.__file.tell(), key))
+            self.__file.write(header + ip + request_wire + response_wire)
+            self.records += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {"records": self.records}
+
+    # Records written so far reach the file, a capture that is never closed can be scanned up to here
+    def flush(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.flush()
+
+    # Writes the index, the capture is complete from then on
+    def close(self):
+        with self.__lock:
+            if self.__file is None:
+                return
+            index_offset = self.__file.tell()
+            for offset, (server_ip, qname, qtype, qclass, dnssec_ok, protocol) in self.__index:
+                ip = server_ip.encode()
+                name = qname.encode()
+                self.__file.write(INDEX_ENTRY.pack(offset, qtype, qclass, protocol, dnssec_ok, len(ip), len(name))
+                                  + ip + name)
+            self.__file.write(FOOTER.pack(index_offset, len(self.__index), INDEX_MAGIC))
+            self.__file.close()
+            self.__file = None
+
+
+# Serves upstream queries from capture files instead of the network. The exchanges recorded for the same
+# question to the same server are served in recorded order, the last one again once they run out. With a
+# `speed` of 1 the staggered attempts, RTTs and timeouts of every query play out as recorded, 2 twice as
+# fast. 0 replays the responses only, without waiting, which is no latency measurement.
+class CaptureReplayer:
+    file_names: List[str]
+    speed: float
+    served: int
+    timeouts: int
+    misses: int
+
+    def __init__(self, file_names: List[str], speed: float = 0.0):
+        self.file_names = file_names
+        self.speed = speed
+        self.served = 0
+        self.timeouts = 0
+        self.misses = 0
+        self.__exchanges: Dict[tuple, List[Tuple[memoryview, int]]] = dict()
+        self.__cursors: Dict[tuple, int] = dict()
+        self.__lock = threading.Lock()
+        for file_name in file_names:
+            self.__load__(file_name)
+
+    def lookup(self, request_message: Message, server_ip: str, protocol: str) -> Optional[CapturedExchange]:
+        key = __key__(request_message, server_ip, protocol)
+        with self.__lock:
+            exchanges = self.__exchanges.get(key)
+            if exchanges is None:
+                self.misses += 1
+                return None
+            cursor = self.__cursors.get(key, 0)
+            self.__cursors[key] = cursor + 1
+            view, offset = exchanges[min(cursor, len(exchanges) - 1)]
+
+        _, rtt, _, ip_length, request_length, response_length = RECORD_HEADER.unpack_from(view, offset)
+        with self.__lock:
+            if response_length == 0:
+                self.timeouts += 1
+            else:
+                self.served += 1
+        if response_length == 0:
+            return CapturedExchange(rtt, None)
+
+        response_offset = offset + RECORD_HEADER.size + ip_length + request_length
+        response_wire = bytearray(view[response_offset:response_offset + response_length])
+        # The response answers this query, not the recorded one
+        struct.pack_into("!H", response_wire, 0, request_message.id)
+        return CapturedExchange(rtt, bytes(response_wire))
+
+    # Waits as long as the exchange took when it was recorded, scaled by the replay speed
+    def wait(self, exchange: CapturedExchange):
+        if self.speed > 0 and exchange.rtt > 0:
+            time.sleep(exchange.rtt / self.speed)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "exchanges": sum(len(exchanges) for exchanges in self.__exchanges.values()),
+                "served": self.served,
+                "timeouts": self.timeouts,
+                "misses": self.misses
+            }
+
+    def __load__(self, file_name: str):
+        with open(file_name, "rb") as capture_file:
+            view = memoryview(mmap.mmap(capture_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        magic, version, _ = FILE_HEADER.unpack_from(view, 0)
+        if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+            raise ValueError(file_name + " is not a capture file")
+
+        index_offset, entries, index_magic = FOOTER.unpack_from(view, len(view) - FOOTER.size) \
+            if len(view) >= FILE_HEADER.size + FOOTER.size else (0, 0, b"")
+        if index_magic == INDEX_MAGIC:
+            offset = index_offset
+            for _ in range(entries):
+                record_offset, qtype, qclass, protocol, dnssec_ok, ip_length, name_length = \
+                    INDEX_ENTRY.unpack_from(view, offset)
+                offset += INDEX_ENTRY.size
+                server_ip = str(view[offset:offset + ip_length], "ascii")
+                qname = str(view[offset + ip_length:offset + ip_length + name_length], "ascii")
+                offset += ip_length + name_length
+                self.__add_exchange__((server_ip, qname, qtype, qclass, dnssec_ok, protocol), view, record_offset)
+            return
+
+        # No index, the capture was not closed. Records cut off at the end are left out.
+        print("Capture " + file_name + " has no index, scanning its records")
+        offset = FILE_HEADER.size
+        while offset + RECORD_HEADER.size <= len(view):
+            _, _, protocol, ip_length, request_length, response_length = RECORD_HEADER.unpack_from(view, offset)
+            end = offset + RECORD_HEADER.size + ip_length + request_length + response_length
+            if end > len(view):
+                break
+            ip_offset = offset + RECORD_HEADER.size
+            server_ip = str(view[ip_offset:ip_offset + ip_length], "ascii")
+            request_message = dns.message.from_wire(view[ip_offset + ip_length:ip_offset + ip_length + request_length]
+                                                    .tobytes())
+            self.__add_exchange__(__key__(request_message, server_ip, PROTOCOLS[protocol]), view, offset)
+            offset = end
+
+    def __add_exchange__(self, key: tuple, view: memoryview, offset: int):
+        self.__exchanges.setdefault(key, []).append((view, offset))
+
+
+# Server, lower case qname, qtype, qclass, DO bit and protocol index
+def __key__(request_message: Message, server_ip: str, protocol: str) -> tuple:
+    question = request_message.question[0]
+    return (server_ip, question.name.to_text().lower(), int(question.rdtype), int(question.rdclass),
+            1 if request_message.ednsflags & dns.flags.DO else 0, PROTOCOLS.index(protocol))
+
+
+recorder: Optional[CaptureRecorder] = None
+replayer: Optional[CaptureReplayer] = None
+
+
+# Records the upstream traffic of this process to the file, the index is written at exit
+def start_capture(file_name: str) -> CaptureRecorder:
+    global recorder
+    recorder = CaptureRecorder(file_name)
+    atexit.register(recorder.close)
+    return recorder
+
+
+# Serves upstream queries of this process from the capture files instead of the network
+def start_replay(file_names: List[str], speed: float = 0.0) -> CaptureReplayer:
+    global replayer
+    replayer = CaptureReplayer(file_names, speed)
+    return replayer
@@ -0,0 +1,218 @@
+import argparse
+import array
+import datetime
+import mmap
+import struct
+import sys
+from typing import BinaryIO, Dict, Iterator
+
+import dns.rdatatype
+
+from models import Response, ResponseRecord
+
+# Results stored column by column in blocks of rows. Every block is self-contained: a header, a string table
+# (offsets into UTF-8 data) and one little endian array per column, each padded to 8 bytes, so a memory-mapped
+# file is read without parsing. String id 0 stands for no string.
+COLUMNAR_MAGIC = b"MDRC"
+COLUMNAR_VERSION = 1
+# Magic, version, rows, records, strings, string data bytes
+BLOCK_HEADER = struct.Struct("<4sHxxIIII")
+COLUMNAR_BLOCK_SIZE = 100
+# Column name, array typecode and whether it has one entry more than there are rows. The records of a row,
+# its answer records followed by its authority records, run from its record offset to the next one.
+COLUMNS = [
+    ("names", "I", False), ("types", "I", False), ("query_times", "I", False), ("whens", "d", False),
+    ("msg_sizes", "I", False), ("dnssec_errors", "I", False), ("record_offsets", "I", True),
+    ("answer_counts", "I", False), ("record_types", "H", False), ("record_values", "I", False)
+]
+RECORD_COLUMNS = ("record_types", "record_values")
+
+
+# Common code for Part A and Part B
+class StringTable:
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self.__offsets = offsets
+        self.__data = data
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, string_id: int) -> str:
+        return str(self.__data[self.__offsets[string_id]:self.__offsets[string_id + 1]], "utf-8")
+
+
+# One block of a columnar result file, the columns are views of the file's bytes
+class ColumnarBlock:
+    rows: int
+    strings: StringTable
+    columns: Dict[str, memoryview]
+
+    def __init__(self, rows: int, strings: StringTable, columns: Dict[str, memoryview]):
+        self.rows = rows
+        self.strings = strings
+        self.columns = columns
+
+    def __len__(self):
+        return self.rows
+
+    def response(self, row: int) -> Response:
+        columns = self.columns
+        strings = self.strings
+        start = columns["record_offsets"][row]
+        answer_end = start + columns["answer_counts"][row]
+        end = columns["record_offsets"][row + 1]
+        records = [ResponseRecord(dns.rdatatype.RdataType.make(columns["record_types"][index]),
+                                  strings[columns["record_values"][index]]) for index in range(start, end)]
+
+        dnssec_error_id = columns["dnssec_errors"][row]
+        return Response(
+            name=strings[columns["names"][row]],
+            type=strings[columns["types"][row]],
+            answer_records=records[:answer_end - start],
+            authority_records=records[answer_end - start:],
+            query_time=columns["query_times"][row],
+            when=str(datetime.datetime.fromtimestamp(columns["whens"][row])),
+            msg_size_rcvd=columns["msg_sizes"][row],
+            dnssec_error=strings[dnssec_error_id] if dnssec_error_id != 0 else None
+        )
+
+    def responses(self) -> Iterator[Response]:
+        return (self.response(row) for row in range(self.rows))
+
+
+# Collects responses into the columns of a block, which is written once COLUMNAR_BLOCK_SIZE rows are in
+# or when flushed
+class ColumnarWriter:
+    block_size: int
+
+    def __init__(self, output_file: BinaryIO, block_size: int = COLUMNAR_BLOCK_SIZE):
+        self.block_size = block_size
+        self.__output_file = output_file
+        self.__reset__()
+
+    def add(self, response: Response):
+        columns = self.__columns
+        columns["names"].append(self.__string_id__(response.name))
+        columns["types"].append(self.__string_id__(response.type))
+        columns["query_times"].append(response.query_time)
+        columns["whens"].append(datetime.datetime.fromisoformat(response.when).timestamp())
+        columns["msg_sizes"].append(response.msg_size_rcvd)
+        columns["dnssec_errors"].append(0 if response.dnssec_error is None
+                                        else self.__string_id__(response.dnssec_error))
+
+        columns["answer_counts"].append(len(response.answer_records))
+        for response_record in response.answer_records + response.authority_records:
+            columns["record_types"].append(response_record.type)
+            columns["record_values"].append(self.__string_id__(response_record.value))
+        columns["record_offsets"].append(len(columns["record_types"]))
+
+        self.__rows += 1
+        if self.__rows >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.__rows == 0:
+            return
+
+        string_data = bytearray()
+        string_offsets = array.array("I", [0])
+        for string in self.__strings:
+            string_data += string.encode()
+            string_offsets.append(len(string_data))
+
+        output_file = self.__output_file
+        output_file.write(BLOCK_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, self.__rows,
+                                            len(self.__columns["record_types"]), len(self.__strings),
+                                            len(string_data)))
+        __write_padded__(output_file, __to_little_endian__(string_offsets))
+        __write_padded__(output_file, bytes(string_data))
+        for name, _, _ in COLUMNS:
+            __write_padded__(output_file, __to_little_endian__(self.__columns[name]))
+        self.__reset__()
+
+    def __string_id__(self, string: str) -> int:
+        string_id = self.__string_ids.get(string)
+        if string_id is None:
+            string_id = len(self.__strings)
+            self.__string_ids[string] = string_id
+            self.__strings.append(string)
+        return string_id
+
+    def __reset__(self):
+        self.__rows = 0
+        # Id 0 is taken by the missing string
+        self.__strings = [""]
+        self.__string_ids = dict()
+        self.__columns = {name: array.array(typecode) for name, typecode, _ in COLUMNS}
+        self.__columns["record_offsets"].append(0)
+
+
+# Blocks of a columnar result file, memory-mapped. The views stay valid while the blocks are referenced.
+def read_columnar(file_name: str) -> Iterator[ColumnarBlock]:
+    with open(file_name, "rb") as input_file:
+        try:
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return
+    view = memoryview(mapped)
+
+    offset = 0
+    while offset < len(view):
+        magic, version, rows, records, strings, string_data_size = BLOCK_HEADER.unpack_from(view, offset)
+        if magic != COLUMNAR_MAGIC or version != COLUMNAR_VERSION:
+            raise ValueError("Not a columnar result block at offset " + str(offset) + " of " + file_name)
+        offset += BLOCK_HEADER.size
+
+        string_offsets, offset = __read_column__(view, offset, "I", strings + 1)
+        string_data = view[offset:offset + string_data_size]
+        offset += __padded_size__(string_data_size)
+
+        columns = dict()
+        for name, typecode, extra_entry in COLUMNS:
+            count = records if name in RECORD_COLUMNS else rows + (1 if extra_entry else 0)
+            columns[name], offset = __read_column__(view, offset, typecode, count)
+
+        yield ColumnarBlock(rows, StringTable(string_offsets, string_data), columns)
+
+
+def iter_columnar_responses(file_name: str) -> Iterator[Response]:
+    for block in read_columnar(file_name):
+        yield from block.responses()
+
+
+def __read_column__(view: memoryview, offset: int, typecode: str, count: int):
+    size = array.array(typecode).itemsize * count
+    column = view[offset:offset + size]
+    if sys.byteorder == "little":
+        column = column.cast(typecode)
+    else:
+        column = array.array(typecode, column.tobytes())
+        column.byteswap()
+    return column, offset + __padded_size__(size)
+
+
+def __to_little_endian__(column: array.array) -> bytes:
+    if sys.byteorder != "little":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def __write_padded__(output_file: BinaryIO, data: bytes):
+    output_file.write(data)
+    output_file.write(bytes(__padded_size__(len(data)) - len(data)))
+
+
+def __padded_size__(size: int) -> int:
+    return (size + 7) // 8 * 8
+
+
+# Prints a columnar result file in the text format of mydig_output.txt
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", help="columnar result file written with --output-format columnar")
+    args = parser.parse_args()
+
+    for columnar_response in iter_columnar_responses(args.file):
+        sys.stdout.write(str(columnar_response))
@@ -1,86 +1,227 @@
-from typing import Optional
+import threading
+import time
+from typing import FrozenSet, List, Optional, Tuple
 
+import dns.rcode
 import dns.rdatatype
-import dns.resolver
 import dns.name
 import dns.message
-import dns.query
+import dns.rrset
 from dns.message import Message
 
-from models import Request
-from mydig import resolve_dns
-
-keys = dict()
+from nsec_cache import prove_denial
+import persistence
+import transport
+from signatures import verify_signatures
+from singleflight import resolution_flights
+import tracing
 
 DNSKEY_TIMEOUT = 1
+TRUST_ANCHOR_FILE_NAME = "./root_trust_anchor.txt"
+# Anchors themselves never expire, trust in the root keys ends with the DNSKEY TTL or signatures
+TRUST_ANCHOR_TTL = 2147483647
+# Failed validations are remembered this long, so a broken zone is not re-fetched for every response
+BOGUS_VALIDATION_TTL = 60
+# Servers that did not answer are no verdict on the zone, this failure is not remembered
+DNSKEY_FETCH_ERROR = "Could not fetch DNSKEY"
+
+
+class TrustEntry:
+    dnskey_rrset: Optional[dns.rrset.RRset]
+    ds_rdatas: Optional[FrozenSet]
+    err_msg: Optional[str]
+    expires_at: float
+
+    def __init__(self, dnskey_rrset: Optional[dns.rrset.RRset], ds_rdatas: Optional[FrozenSet],
+                 err_msg: Optional[str], expires_at: float):
+        self.dnskey_rrset = dnskey_rrset
+        self.ds_rdatas = ds_rdatas
+        self.err_msg = err_msg
+        self.expires_at = expires_at
+
+
+# Validated zones of the chain of trust: the zone's DNSKEY RRset, the DS RRset it was matched against and
+# the verdict. Valid entries expire at the earliest of the DNSKEY TTL, the DS TTL and the expiration of the
+# DNSKEY RRSIG, failed ones after BOGUS_VALIDATION_TTL. DNSKEY fetches that got no response are not stored. `get` makes this usable as the keys argument of
+# dns.dnssec.validate, only keys of zones that validated are handed out.
+class TrustCache:
+    def __init__(self):
+        self.__entries = dict()
+        self.__lock = threading.Lock()
+
+    def get(self, zone: dns.name.Name) -> Optional[dns.rrset.RRset]:
+        entry = self.lookup(zone)
+        return entry.dnskey_rrset if entry is not None and entry.err_msg is None else None
+
+    # Live entry for the zone, a DS RRset that differs from the validated one (key rollover) is a miss
+    def lookup(self, zone: dns.name.Name, ds_rrset: Optional[dns.rrset.RRset] = None) -> Optional[TrustEntry]:
+        now = time.time()
+        with self.__lock:
+            entry = self.__entries.get(zone)
+            if entry is not None and entry.expires_at <= now:
+                del self.__entries[zone]
+                entry = None
+
+        if entry is None:
+            entry = self.__load_persisted_entry__(zone)
+
+        if entry is None or (ds_rrset is not None and entry.ds_rdatas is not None
+                             and entry.ds_rdatas != frozenset(ds_rrset)):
+            return None
+
+        return entry
+
+    def put_trust_anchor(self, zone: dns.name.Name, dnskey_rrset: dns.rrset.RRset):
+        with self.__lock:
+            self.__entries[zone] = TrustEntry(dnskey_rrset, None, None, float("inf"))
+
+    def put_valid(self, zone: dns.name.Name, dnskey_rrset: dns.rrset.RRset, ds_rrset: dns.rrset.RRset,
+                  expires_at: float):
+        with self.__lock:
+            self.__entries[zone] = TrustEntry(dnskey_rrset, frozenset(ds_rrset), None, expires_at)
+
+        if persistence.persistent_store is not None:
+            persistence.persistent_store.save_trusted_zone(zone, dnskey_rrset, ds_rrset, expires_at)
+
+    def put_failure(self, zone: dns.name.Name, ds_rrset: dns.rrset.RRset, err_msg: str):
+        with self.__lock:
+            self.__entries[zone] = TrustEntry(None, frozenset(ds_rrset), err_msg, time.time() + BOGUS_VALIDATION_TTL)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    # Zones validated by an earlier run are taken from the on-disk warm cache when one is open
+    def __load_persisted_entry__(self, zone: dns.name.Name) -> Optional[TrustEntry]:
+        if persistence.persistent_store is None:
+            return None
+
+        loaded = persistence.persistent_store.load_trusted_zone(zone)
+        if loaded is None:
+            return None
+
+        dnskey_rrset, ds_rrset, expires_at = loaded
+        entry = TrustEntry(dnskey_rrset, frozenset(ds_rrset), None, expires_at)
+        with self.__lock:
+            self.__entries[zone] = entry
+        return entry
+
+
+trust_cache = TrustCache()
+
+
+# Secure zone cuts are only used while the zone's keys are still trusted
+def is_trusted_zone(zone: dns.name.Name) -> bool:
+    return trust_cache.get(zone) is not None
 
 
 # Code for part B
-def validate_response(response_message: Message) -> Optional[str]:
-    ds_records = []
-    record_signature_pairs = []
+# Checks every RRSIG of the response against the trusted keys of its signer. RRsets of the sections in
+# `signed_sections` must carry a signature, a secure zone never sends them unsigned.
+def validate_signatures(response_message: Message, signed_sections: list) -> Optional[str]:
+    record_signature_pairs = __collect_record_signature_pairs__(response_message)
 
-    # Collect all ds and rrsig records for validation
-    for section in response_message.sections:
-        prev = None
-        for rrset in section:
-            if rrset.rdtype == dns.rdatatype.DS:
-                ds_records.append(rrset)
+    signed_rrsets = {(record.name, record.rdtype) for record, _ in record_signature_pairs}
+    for rrset in signed_sections:
+        if rrset.rdtype != dns.rdatatype.RRSIG and (rrset.name, rrset.rdtype) not in signed_rrsets:
+            return "DNSSEC RRSIG record missing"
+
+    question = response_message.question[0]
+    with tracing.ValidationTimer(question.name, question.rdtype):
+        verified = all(verify_signatures(record_signature_pairs, trust_cache))
+    if not verified:
+        return "DNSSEC RRSIG record verification failed"
+
+    return None
+
+
+# A negative answer from the servers of `zone` holds only with proof: its NSEC or NSEC3 records must show
+# that the name does not exist for NXDOMAIN, or that it has no records of the type for NODATA (RFC 4035
+# section 5.4, RFC 5155 section 8). A signed SOA alone proves nothing, it can be replayed from any response.
+# Call after validate_signatures verified the authority section. Also returns whether the answer is secure,
+# a proof resting on an NSEC3 opt-out range leaves room for unsigned delegations below the zone.
+def validate_denial(response_message: Message, zone: dns.name.Name) -> Tuple[Optional[str], bool]:
+    soa_rrsets = [rrset for rrset in response_message.authority
+                  if rrset.rdtype == dns.rdatatype.SOA and rrset.name.is_subdomain(zone)]
+    if len(soa_rrsets) == 0:
+        return "DNSSEC denial of existence missing", False
 
-            if rrset.rdtype == dns.rdatatype.RRSIG and prev is not None:
-                record_signature_pairs.append((prev, rrset))
-            elif rrset.rdtype != dns.rdatatype.RRSIG:
-                prev = rrset
+    proof = prove_denial(response_message, soa_rrsets[0].name)
+    if proof is None or proof[0] != response_message.rcode():
+        return "DNSSEC denial of existence missing", False
+
+    return None, not any(nsec_range.opt_out for nsec_range in proof[1])
+
+
+# Validates the DS records of a referral with the parent's keys, then extends the chain of trust to the
+# child zone by asking the referral's name servers for the child's DNSKEY RRset
+def validate_delegation(response_message: Message, name_server_ips: List[str]) -> Optional[str]:
+    ds_records = [rrset for rrset in response_message.authority if rrset.rdtype == dns.rdatatype.DS]
 
-    # If we did not get the answer, we need to drill down to next zone
     # If that zone does not have a DS record, then DNSSEC is not supported
-    if len(response_message.answer) == 0 and len(ds_records) == 0:
+    if len(ds_records) == 0:
         return "DNSSEC not supported."
 
-    # Fetch and validate DNSKEY records for the child-zones from the DS records.
+    err_msg = validate_signatures(response_message, ds_records)
+    if err_msg is not None:
+        return err_msg
+
     for ds_record in ds_records:
-        err_msg = __fetch_and_validate_keys__(ds_record)
+        err_msg = __fetch_and_validate_keys__(ds_record, name_server_ips)
         if err_msg is not None:
             return err_msg
 
-    # After fetching keys, validate all of the rrsig records present
-    for record, rrsig_record in record_signature_pairs:
-        try:
-            dns.dnssec.validate(record, rrsig_record, keys)
-        except:
-            return "DNSSEC RRSIG record verification failed"
-
     return None
 
 
-def __fetch_and_validate_keys__(ds_record) -> Optional[str]:
-    # Get the nameservers and corresponding IPs for the child zone of DS record
-    result = resolve_dns(Request(
-        name=ds_record.name.to_text(),
-        type="NS"
-    ))
-    ns_names = [ns_record.value for ns_record in result.answer_records + result.authority_records if ns_record.type == dns.rdatatype.NS]
-    ns_ips = []
-    for ns_name in ns_names:
-        result = resolve_dns(Request(
-            name=ns_name,
-            type="A"
-        ))
-        ns_ips += [ns_ip_record.value for ns_ip_record in result.answer_records if ns_ip_record.type == dns.rdatatype.A]
-
-    err_msg = "Could not fetch DNSKEY"
-    for ns_ip in ns_ips:
-        try:
-            key_response = dns.query.udp(
-                dns.message.make_query(ds_record.name, dns.rdatatype.DNSKEY, want_dnssec=True),
-                ns_ip)
-            err_msg = None
-            break
-        except:
-            continue
+# Pairs every RRSIG RRset with the RRset of the same section it covers
+def __collect_record_signature_pairs__(response_message: Message) -> List[Tuple[dns.rrset.RRset, dns.rrset.RRset]]:
+    record_signature_pairs = []
 
-    if err_msg is not None:
+    for section in response_message.sections:
+        records = {(rrset.name, rrset.rdtype): rrset for rrset in section if rrset.rdtype != dns.rdatatype.RRSIG}
+        for rrset in section:
+            if rrset.rdtype == dns.rdatatype.RRSIG and (rrset.name, rrset.covers) in records:
+                record_signature_pairs.append((records[(rrset.name, rrset.covers)], rrset))
+
+    return record_signature_pairs
+
+
+def __fetch_and_validate_keys__(ds_record, name_server_ips: List[str]) -> Optional[str]:
+    # Zones validated (or found broken) a moment ago are not fetched again
+    entry = trust_cache.lookup(ds_record.name, ds_record)
+    if entry is not None:
+        return entry.err_msg
+
+    # Responses delegating to the same zone at once extend the chain of trust to it once
+    return resolution_flights.do(("DNSKEY", ds_record.name, frozenset(ds_record)),
+                                 lambda: __validate_keys__(ds_record, name_server_ips))
+
+
+def __validate_keys__(ds_record, name_server_ips: List[str]) -> Optional[str]:
+    err_msg, dnskey_record, expires_at = __fetch_and_verify_keys__(ds_record, name_server_ips)
+    if err_msg == DNSKEY_FETCH_ERROR:
         return err_msg
+    elif err_msg is not None:
+        trust_cache.put_failure(ds_record.name, ds_record, err_msg)
+    else:
+        trust_cache.put_valid(ds_record.name, dnskey_record, ds_record, expires_at)
+
+    return err_msg
+
+
+# The DNSKEY RRset is asked from the child zone's name servers named in the referral being followed
+def __fetch_and_verify_keys__(ds_record, name_server_ips: List[str]) -> \
+      Tuple[Optional[str], Optional[dns.rrset.RRset], float]:
+    key_response, _ = transport.query_servers(
+        dns.message.make_query(ds_record.name, dns.rdatatype.DNSKEY, want_dnssec=True,
+                               payload=transport.EDNS_PAYLOAD_SIZE),
+        name_server_ips,
+        DNSKEY_TIMEOUT
+    )
+
+    if key_response is None:
+        return DNSKEY_FETCH_ERROR, None, 0
 
     ksk_record = None
     dnskey_record = None
@@ -100,26 +241,30 @@ def __fetch_and_validate_keys__(ds_record) -> Optional[str]:
             rrsig_record = rrset
 
     if None in [ksk_record, dnskey_record, rrsig_record]:
-        return "DNSSEC not enabled"
+        return "DNSSEC not enabled", None, 0
 
-    try:
-        keys[ds_record.name] = dnskey_record
-        dns.dnssec.validate(dnskey_record, rrsig_record, keys)
-    except:
-        del keys[ds_record.name]
-        return "Failed to validate signature of DNSKEY record"
+    # Validate against the candidate keys only, so concurrent validations never trust an unverified key
+    with tracing.ValidationTimer(ds_record.name, dns.rdatatype.DNSKEY):
+        verified = verify_signatures([(dnskey_record, rrsig_record)], {ds_record.name: dnskey_record})[0]
+    if not verified:
+        return "Failed to validate signature of DNSKEY record", None, 0
 
     for ds_digest in ds_record:
         if ds_digest.algorithm != ksk_record.algorithm:
             continue
 
         # Verify KSK matches the hash present in DS record
-        ksk_digest = dns.dnssec.make_ds(ds_record.name, ksk_record, __parse_algorithm__(ds_digest.algorithm))
+        from dns.dnssec import make_ds
+        ksk_digest = make_ds(ds_record.name, ksk_record, __parse_algorithm__(ds_digest.algorithm))
         if ds_digest.digest == ksk_digest.digest:
-            return None
+            # Trust ends when a record runs out or the DNSKEY signatures expire, whichever comes first
+            expires_at = min(
+                time.time() + min(dnskey_record.ttl, ds_record.ttl),
+                min(rrsig.expiration for rrsig in rrsig_record)
+            )
+            return None, dnskey_record, expires_at
 
-    del keys[ds_record.name]
-    return "DS validation for KSK failed"
+    return "DS validation for KSK failed", None, 0
 
 
 def __parse_algorithm__(algorithm_enum) -> str:
@@ -131,7 +276,51 @@ def __parse_algorithm__(algorithm_enum) -> str:
     return 'SHA256'
 
 
+# Root trust anchors from TRUST_ANCHOR_FILE_NAME as (DS RRset, DNSKEY RRset), either may be None.
+# Parsed once, no network access.
+def load_trust_anchors():
+    global trust_anchors
+    if trust_anchors is None:
+        ds_rdatas = []
+        dnskey_rdatas = []
+        with open(TRUST_ANCHOR_FILE_NAME, "r") as anchor_file:
+            for line in anchor_file.readlines():
+                tokens = line.split(";")[0].split()
+                for rdtype, rdatas in (("DS", ds_rdatas), ("DNSKEY", dnskey_rdatas)):
+                    if rdtype in tokens and tokens[0] == ".":
+                        rdatas.append(" ".join(tokens[tokens.index(rdtype) + 1:]))
+
+        root_name = dns.name.root
+        trust_anchors = (
+            dns.rrset.from_text_list(root_name, TRUST_ANCHOR_TTL, "IN", "DS", ds_rdatas)
+            if len(ds_rdatas) > 0 else None,
+            dns.rrset.from_text_list(root_name, TRUST_ANCHOR_TTL, "IN", "DNSKEY", dnskey_rdatas)
+            if len(dnskey_rdatas) > 0 else None
+        )
+
+    return trust_anchors
+
+
+trust_anchors = None
+
+
+# Makes sure the root keys are trusted before a validated walk starts. A DNSKEY anchor is trusted as is,
+# a DS anchor is checked against the root DNSKEY RRset fetched from the root servers on first use and
+# again whenever that validation expires.
+def ensure_root_trust(root_server_ips: List[str]) -> Optional[str]:
+    if is_trusted_zone(dns.name.root):
+        return None
+
+    ds_anchor, dnskey_anchor = load_trust_anchors()
+    if dnskey_anchor is not None:
+        trust_cache.put_trust_anchor(dns.name.root, dnskey_anchor)
+        return None
+    if ds_anchor is None:
+        return "No root trust anchor"
+
+    return __fetch_and_validate_keys__(ds_anchor, root_server_ips)
+
+
 # Initialize in main before starting dnssec flow
 def __init__():
-    root_name = dns.name.from_text(".")
-    keys[root_name] = dns.resolver.resolve(qname='.', rdtype=dns.rdatatype.DNSKEY).rrset
+    load_trust_anchors()
@@ -0,0 +1,344 @@
+import asyncio
+import bisect
+import random
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+# Every server gets its own loopback address, all of 127.0.0.0/8 reaches the local host on Linux
+FAKE_SERVER_NETWORK = "127.53"
+FAKE_TLDS = ["com", "net", "org"]
+FAKE_RECORD_TTL = 3600
+FAKE_SIGNATURE_VALIDITY = 86400
+# SOA minimum, the TTL of negative answers and NSEC records
+FAKE_NEGATIVE_TTL = 300
+ED25519 = 15
+
+
+class FakeDelegation:
+    child: "FakeZone"
+    ns_names: List[dns.name.Name]
+    glue: Dict[dns.name.Name, str]
+
+    def __init__(self, child: "FakeZone", ns_names: List[dns.name.Name], glue: Dict[dns.name.Name, str]):
+        self.child = child
+        self.ns_names = ns_names
+        self.glue = glue
+
+
+# Common code for Part A and Part B
+# One zone on its own server address. Signed zones sign with an ED25519 key made up at start, signatures
+# are made once per RRset, and prove negative answers with an NSEC chain over the zone's names.
+class FakeZone:
+    name: dns.name.Name
+    server_ip: str
+    signed: bool
+
+    def __init__(self, name: dns.name.Name, server_ip: str, signed: bool):
+        self.name = name
+        self.server_ip = server_ip
+        self.signed = signed
+        self.records: Dict[Tuple[dns.name.Name, dns.rdatatype.RdataType], dns.rrset.RRset] = dict()
+        self.delegations: Dict[dns.name.Name, FakeDelegation] = dict()
+        self.dnskey = None
+        self.__private_key = None
+        self.__signatures = dict()
+        self.__owners = None
+        self.__owner_set = set()
+
+        if signed:
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric import ed25519
+            self.__private_key = ed25519.Ed25519PrivateKey.generate()
+            public_key = self.__private_key.public_key().public_bytes(serialization.Encoding.Raw,
+                                                                       serialization.PublicFormat.Raw)
+            # Flags 257 (zone key, secure entry point), protocol 3
+            self.dnskey = dns.rdata.from_wire(dns.rdataclass.IN, dns.rdatatype.DNSKEY,
+                                              struct.pack("!HBB", 257, 3, ED25519) + public_key, 0,
+                                              4 + len(public_key))
+            self.add(name, "DNSKEY", [self.dnskey.to_text()])
+
+    def add(self, name: dns.name.Name, rdtype: str, rdatas: List[str], ttl: int = FAKE_RECORD_TTL):
+        rrset = dns.rrset.from_text_list(name, ttl, "IN", rdtype, rdatas)
+        self.records[(name, rrset.rdtype)] = rrset
+
+    def delegate(self, child: "FakeZone", ns_names: List[dns.name.Name], glue: Dict[dns.name.Name, str]):
+        self.delegations[child.name] = FakeDelegation(child, ns_names, glue)
+
+    def ds(self) -> dns.rrset.RRset:
+        from dns.dnssec import make_ds
+        return dns.rrset.from_rdata_list(self.name, FAKE_RECORD_TTL, [make_ds(self.name, self.dnskey, "SHA256")])
+
+    # RRSIG over the RRset (RFC 4034 section 3.1.8.1), dnspython of this version only verifies
+    def sign(self, rrset: dns.rrset.RRset) -> dns.rrset.RRset:
+        key = (rrset.name, rrset.rdtype)
+        rrsig_rrset = self.__signatures.get(key)
+        if rrsig_rrset is not None:
+            return rrsig_rrset
+
+        from dns.dnssec import key_id
+        now = int(time.time())
+        template = dns.rdata.from_text("IN", "RRSIG", "%s %d %d %d %d %d %d %s AAAA" % (
+            dns.rdatatype.to_text(rrset.rdtype), ED25519, len(rrset.name) - 1, rrset.ttl,
+            now + FAKE_SIGNATURE_VALIDITY, now - 3600, key_id(self.dnskey), self.name.to_text()))
+        signed_data = template.to_wire()[:18] + self.name.to_digestable()
+        rdata_header = struct.pack("!HHI", rrset.rdtype, rrset.rdclass, rrset.ttl)
+        for rdata in sorted(rdata.to_digestable() for rdata in rrset):
+            signed_data += rrset.name.to_digestable() + rdata_header + struct.pack("!H", len(rdata)) + rdata
+
+        rrsig = template.replace(signature=self.__private_key.sign(signed_data))
+        rrsig_rrset = dns.rrset.from_rdata_list(rrset.name, rrset.ttl, [rrsig])
+        self.__signatures[key] = rrsig_rrset
+        return rrsig_rrset
+
+    def respond(self, request_message: dns.message.Message) -> dns.message.Message:
+        response_message = dns.message.make_response(request_message)
+        question = request_message.question[0]
+        name, rdtype = question.name, question.rdtype
+
+        def add(section: list, rrset: dns.rrset.RRset):
+            section.append(rrset)
+            if self.signed:
+                section.append(self.sign(rrset))
+
+        for child_name, delegation in self.delegations.items():
+            # DS records of the child are answered by the parent
+            if name.is_subdomain(child_name) and not (name == child_name and rdtype == dns.rdatatype.DS):
+                response_message.authority.append(
+                    dns.rrset.from_text_list(child_name, FAKE_RECORD_TTL, "IN", "NS",
+                                             [ns_name.to_text() for ns_name in delegation.ns_names]))
+                if self.signed and delegation.child.signed:
+                    add(response_message.authority, delegation.child.ds())
+                for ns_name, ip in delegation.glue.items():
+                    response_message.additional.append(dns.rrset.from_text(ns_name, FAKE_RECORD_TTL, "IN", "A", ip))
+                return response_message
+
+        response_message.flags |= dns.flags.AA
+        for answer_type in (rdtype, dns.rdatatype.CNAME):
+            rrset = self.records.get((name, answer_type))
+            if rrset is not None:
+                add(response_message.answer, rrset)
+                return response_message
+
+        # Empty non-terminals exist, they only have names below them
+        exists = any(owner.is_subdomain(name) for owner in self.__sorted_owners__())
+        if not exists:
+            response_message.set_rcode(dns.rcode.NXDOMAIN)
+        add(response_message.authority, self.records[(self.name, dns.rdatatype.SOA)])
+        if self.signed:
+            for nsec_rrset in self.__denial__(name, exists):
+                add(response_message.authority, nsec_rrset)
+        return response_message
+
+    # NSEC records proving the negative answer (RFC 4035 section 3.1.3): the name's own for NODATA, the one
+    # covering an empty non-terminal, or for NXDOMAIN the one covering the name and the one covering the
+    # wildcard at its closest encloser
+    def __denial__(self, name: dns.name.Name, exists: bool) -> List[dns.rrset.RRset]:
+        owners = self.__sorted_owners__()
+        if name in self.__owner_set:
+            return [self.__nsec__(name)]
+
+        covering = owners[bisect.bisect_right(owners, name) - 1]
+        if exists:
+            return [self.__nsec__(covering)]
+
+        closest_encloser = name.parent()
+        while closest_encloser != self.name and not any(owner.is_subdomain(closest_encloser) for owner in owners):
+            closest_encloser = closest_encloser.parent()
+        wildcard = dns.name.Name((b"*",) + closest_encloser.labels)
+        wildcard_covering = owners[bisect.bisect_right(owners, wildcard) - 1]
+        return [self.__nsec__(owner) for owner in sorted({covering, wildcard_covering})]
+
+    def __nsec__(self, owner: dns.name.Name) -> dns.rrset.RRset:
+        owners = self.__sorted_owners__()
+        next_owner = owners[(owners.index(owner) + 1) % len(owners)]
+        rdtypes = {rdtype for record_owner, rdtype in self.records if record_owner == owner}
+        rdtypes |= {dns.rdatatype.RRSIG, dns.rdatatype.NSEC}
+        delegation = self.delegations.get(owner)
+        if delegation is not None:
+            rdtypes.add(dns.rdatatype.NS)
+            if delegation.child.signed:
+                rdtypes.add(dns.rdatatype.DS)
+        return dns.rrset.from_text(owner, FAKE_NEGATIVE_TTL, "IN", "NSEC", next_owner.to_text() + " " +
+                                   " ".join(dns.rdatatype.to_text(rdtype) for rdtype in sorted(rdtypes)))
+
+    # Names with records or delegations in the zone in canonical order, the zone is complete once it serves
+    def __sorted_owners__(self) -> List[dns.name.Name]:
+        if self.__owners is None:
+            self.__owner_set = {owner for owner, _ in self.records} | set(self.delegations)
+            self.__owners = sorted(self.__owner_set)
+        return self.__owners
+
+
+# A root, FAKE_TLDS and `zones_per_tld` leaf zones under each TLD, every zone on its own server at
+# 127.53.x.y:`port`. Leaf zones have an apex A, MX and NS, www as a CNAME to the apex and a mail host.
+# A `glueless_fraction` of leaf zones is delegated to a name server in another leaf zone, without glue.
+class FakeHierarchy:
+    port: int
+    latency: float
+    loss: float
+    packets: int
+
+    def __init__(self, zones_per_tld: int = 100, signed: bool = False, glueless_fraction: float = 0.0,
+                 port: int = 5300, latency: float = 0.0, loss: float = 0.0, seed: int = 1):
+        self.port = port
+        self.latency = latency
+        self.loss = loss
+        self.packets = 0
+        self.zones: Dict[str, FakeZone] = dict()
+        self.leaf_zones: List[FakeZone] = []
+        self.__random = random.Random(seed)
+        self.__loop = None
+        self.__thread = None
+        self.__build__(zones_per_tld, signed, glueless_fraction)
+
+    @property
+    def root(self) -> FakeZone:
+        return self.zones[self.root_ip]
+
+    def root_dnskey(self) -> dns.rrset.RRset:
+        return dns.rrset.from_rdata_list(dns.name.root, FAKE_RECORD_TTL, [self.root.dnskey])
+
+    # Serves all zones from an event loop on a background thread until stop
+    def start(self):
+        started = threading.Event()
+
+        def run():
+            self.__loop = asyncio.new_event_loop()
+            self.__loop.run_until_complete(self.__serve__())
+            started.set()
+            self.__loop.run_forever()
+
+        self.__thread = threading.Thread(target=run, daemon=True)
+        self.__thread.start()
+        started.wait()
+
+    def stop(self):
+        if self.__loop is not None:
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop = None
+
+    def __build__(self, zones_per_tld: int, signed: bool, glueless_fraction: float):
+        self.root_ip = self.__server_ip__(0)
+        root = self.__add_zone__(dns.name.root, self.root_ip, signed)
+        root.add(dns.name.from_text("a.root-servers.fake."), "A", [self.root_ip])
+
+        for tld_index, tld in enumerate(FAKE_TLDS):
+            tld_zone = self.__add_zone__(dns.name.from_text(tld), self.__server_ip__(1 + tld_index), signed)
+            ns_name = dns.name.from_text("a.nic." + tld)
+            tld_zone.add(ns_name, "A", [tld_zone.server_ip])
+            root.delegate(tld_zone, [ns_name], {ns_name: tld_zone.server_ip})
+
+            for zone_index in range(zones_per_tld):
+                server_ip = self.__server_ip__(1 + len(FAKE_TLDS) + len(self.leaf_zones))
+                zone = self.__add_zone__(dns.name.from_text("zone%d.%s" % (zone_index, tld)), server_ip, signed)
+                self.leaf_zones.append(zone)
+
+        # The name servers of glueless zones live in zones delegated with glue, so no delegation depends on itself
+        glueless_zones = [zone for zone in self.leaf_zones if self.__random.random() < glueless_fraction]
+        host_zones = [zone for zone in self.leaf_zones if zone not in glueless_zones]
+        for zone in self.leaf_zones:
+            ns_name = dns.name.from_text("ns1", zone.name)
+            zone.add(ns_name, "A", [zone.server_ip])
+            zone.add(zone.name, "A", ["10.%d.%d.%d" % tuple(int(octet) for octet in zone.server_ip.split(".")[1:])])
+            zone.add(dns.name.from_text("www", zone.name), "CNAME", [zone.name.to_text()])
+            zone.add(dns.name.from_text("mail", zone.name), "A", ["10.0.0.25"])
+            zone.add(zone.name, "MX", ["10 " + dns.name.from_text("mail", zone.name).to_text()])
+
+            parent = self.zones[self.__tld_ip__(zone)]
+            if zone in glueless_zones and len(host_zones) > 0:
+                host_zone = self.__random.choice(host_zones)
+                ns_name = dns.name.from_text("ns-" + zone.name.to_text().rstrip(".").replace(".", "-"),
+                                             host_zone.name)
+                host_zone.add(ns_name, "A", [zone.server_ip])
+                zone.add(zone.name, "NS", [ns_name.to_text()])
+                parent.delegate(zone, [ns_name], {})
+            else:
+                zone.add(zone.name, "NS", [ns_name.to_text()])
+                parent.delegate(zone, [ns_name], {ns_name: zone.server_ip})
+
+    def __tld_ip__(self, zone: FakeZone) -> str:
+        return self.__server_ip__(1 + FAKE_TLDS.index(zone.name.labels[-2].decode()))
+
+    def __add_zone__(self, name: dns.name.Name, server_ip: str, signed: bool) -> FakeZone:
+        zone = FakeZone(name, server_ip, signed)
+        zone.add(name, "SOA", ["%s %s 1 7200 3600 1209600 %d" % (dns.name.from_text("ns1", name),
+                                                                dns.name.from_text("hostmaster", name),
+                                                                FAKE_NEGATIVE_TTL)])
+        self.zones[server_ip] = zone
+        return zone
+
+    def __server_ip__(self, index: int) -> str:
+        return "%s.%d.%d" % (FAKE_SERVER_NETWORK, index // 250, 1 + index % 250)
+
+    async def __serve__(self):
+        loop = asyncio.get_running_loop()
+        for zone in self.zones.values():
+            await loop.create_datagram_endpoint(lambda zone=zone: FakeServerProtocol(self, zone),
+                                                local_addr=(zone.server_ip, self.port))
+            await asyncio.start_server(lambda reader, writer, zone=zone: self.__serve_tcp__(zone, reader, writer),
+                                       zone.server_ip, self.port)
+
+    async def __serve_tcp__(self, zone: FakeZone, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                response_wire = self.answer(zone, await reader.readexactly(length), max_size=65535)
+                if self.latency > 0:
+                    await asyncio.sleep(self.latency)
+                writer.write(struct.pack("!H", len(response_wire)) + response_wire)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    # Wire format response, TC set when it does not fit the size the query allows
+    def answer(self, zone: FakeZone, request_wire: bytes, max_size: Optional[int] = None) -> Optional[bytes]:
+        self.packets += 1
+        try:
+            request_message = dns.message.from_wire(request_wire)
+        except Exception:
+            return None
+
+        if max_size is None:
+            max_size = max(512, request_message.payload) if request_message.edns >= 0 else 512
+        response_message = zone.respond(request_message)
+        try:
+            return response_message.to_wire(max_size=max_size)
+        except dns.exception.TooBig:
+            truncated_message = dns.message.make_response(request_message)
+            truncated_message.flags |= dns.flags.TC
+            return truncated_message.to_wire()
+
+
+class FakeServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, hierarchy: FakeHierarchy, zone: FakeZone):
+        self.hierarchy = hierarchy
+        self.zone = zone
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if self.hierarchy.loss > 0 and random.random() < self.hierarchy.loss:
+            self.hierarchy.packets += 1
+            return
+
+        response_wire = self.hierarchy.answer(self.zone, data)
+        if response_wire is None:
+            return
+        if self.hierarchy.latency > 0:
+            asyncio.get_running_loop().call_later(self.hierarchy.latency, self.transport.sendto, response_wire, addr)
+        else:
+            self.transport.sendto(response_wire, addr)
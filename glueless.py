@@ -0,0 +1,73 @@
+import contextvars
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, List, Set
+
+import dns.name
+import dns.rdatatype
+
+from cache import rrset_cache
+
+# Name server names of a glueless referral resolved at once
+GLUELESS_PARALLEL = 3
+
+
+# Common code for Part A and Part B
+# Addresses of the name servers of a referral without glue, resolved on demand. The first call resolves a
+# few names in parallel and returns as soon as one of them has addresses, later calls (made when the
+# servers returned so far did not answer) collect the lookups still running and start the next names.
+# Addresses already in the cache, glue from earlier referrals included, are returned first without any lookup.
+class GluelessAddresses:
+    def __init__(self, ns_names: List[str], resolve_ips: Callable[[str], List[str]]):
+        self.__pending_names = list(ns_names)
+        self.__resolve_ips = resolve_ips
+        self.__running: Set[Future] = set()
+        self.__executor = None
+
+    def next_ips(self) -> List[str]:
+        cached_ips = self.__take_cached_ips__()
+        if len(cached_ips) > 0:
+            return cached_ips
+
+        while len(self.__pending_names) > 0 or len(self.__running) > 0:
+            self.__start_lookups__()
+            done, self.__running = wait(self.__running, return_when=FIRST_COMPLETED)
+
+            ips = []
+            for future in done:
+                ips += future.result()
+            if len(ips) > 0:
+                return ips
+
+        self.close()
+        return []
+
+    # Called once the referral's servers answered or none are left. Lookups not started yet are dropped, those
+    # still running finish in the background and leave their addresses in the cache.
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+
+    def __take_cached_ips__(self) -> List[str]:
+        ips = []
+        for ns_name in list(self.__pending_names):
+            cached_rrset = rrset_cache.get(dns.name.from_text(ns_name), (dns.rdatatype.A,), glue=True)
+            if cached_rrset is not None:
+                ips += [item.address for item in cached_rrset.items]
+                self.__pending_names.remove(ns_name)
+        return ips
+
+    def __start_lookups__(self):
+        while len(self.__running) < GLUELESS_PARALLEL and len(self.__pending_names) > 0:
+            if self.__executor is None:
+                self.__executor = ThreadPoolExecutor(max_workers=GLUELESS_PARALLEL)
+            # The lookups run on behalf of the resolution waiting for them, see singleflight.py
+            self.__running.add(self.__executor.submit(
+                contextvars.copy_context().run, self.__resolve_ips__, self.__pending_names.pop(0)))
+
+    def __resolve_ips__(self, ns_name: str) -> List[str]:
+        try:
+            return self.__resolve_ips(ns_name)
+        except Exception as e:
+            print("Error when resolving name server " + ns_name + " error message " + str(e))
+            return []
@@ -0,0 +1,125 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Per server round trip statistics, kept the same way as TCP's RTO estimator (RFC 6298) and BIND's SRTT
+INFRA_CACHE_MAX_SIZE = 10000
+# Statistics older than this are forgotten, so a server that was slow or dead gets a fresh chance
+INFRA_ENTRY_TTL = 900
+# Assumed round trip of a server that was never queried, known servers faster than this are tried first
+UNKNOWN_SERVER_RTT = 0.3
+# Added to a server's score for every timeout since its last response
+TIMEOUT_PENALTY = 1.0
+MIN_QUERY_TIMEOUT = 0.1
+MAX_QUERY_TIMEOUT = 3.0
+
+
+class ServerStats:
+    srtt: Optional[float]
+    rttvar: float
+    timeouts: int
+    updated_at: float
+
+    def __init__(self, srtt: Optional[float], rttvar: float, timeouts: int, updated_at: float):
+        self.srtt = srtt
+        self.rttvar = rttvar
+        self.timeouts = timeouts
+        self.updated_at = updated_at
+
+
+# Common code for Part A and Part B
+class InfraCache:
+    max_size: int
+    entry_ttl: float
+
+    def __init__(self, max_size: int = INFRA_CACHE_MAX_SIZE, entry_ttl: float = INFRA_ENTRY_TTL):
+        self.max_size = max_size
+        self.entry_ttl = entry_ttl
+        self.__servers = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def record_rtt(self, server_ip: str, rtt: float):
+        now = time.time()
+        with self.__lock:
+            stats = self.__get_stats__(server_ip, now)
+            if stats is None or stats.srtt is None:
+                stats = ServerStats(rtt, rtt / 2, 0, now)
+            else:
+                stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+                stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+                stats.timeouts = 0
+                stats.updated_at = now
+            self.__put_stats__(server_ip, stats)
+
+    def record_timeout(self, server_ip: str):
+        now = time.time()
+        with self.__lock:
+            stats = self.__get_stats__(server_ip, now)
+            if stats is None:
+                stats = ServerStats(None, 0.0, 0, now)
+            stats.timeouts += 1
+            stats.updated_at = now
+            self.__put_stats__(server_ip, stats)
+
+    # Fastest expected server first, servers with equal scores keep their relative order
+    def sort_servers(self, server_ips: List[str]) -> List[str]:
+        now = time.time()
+        with self.__lock:
+            scores = {server_ip: self.__score__(self.__get_stats__(server_ip, now)) for server_ip in server_ips}
+        return sorted(server_ips, key=lambda server_ip: scores[server_ip])
+
+    # Retransmission timeout for a server, unknown servers get the caller's default timeout
+    def timeout_for(self, server_ip: str, default_timeout: float) -> float:
+        with self.__lock:
+            stats = self.__get_stats__(server_ip, time.time())
+        if stats is None or stats.srtt is None:
+            return default_timeout
+
+        rto = min(max(stats.srtt + 4 * stats.rttvar, MIN_QUERY_TIMEOUT), MAX_QUERY_TIMEOUT)
+        return min(rto * 2 ** stats.timeouts, MAX_QUERY_TIMEOUT)
+
+    def get(self, server_ip: str) -> Optional[ServerStats]:
+        with self.__lock:
+            return self.__get_stats__(server_ip, time.time())
+
+    def clear(self):
+        with self.__lock:
+            self.__servers.clear()
+
+    # SRTT in seconds (None before the first response) and timeouts since the last response, by server
+    def server_stats(self) -> Dict[str, Dict[str, Optional[float]]]:
+        with self.__lock:
+            return {server_ip: {"srtt": stats.srtt, "timeouts": stats.timeouts}
+                    for server_ip, stats in self.__servers.items()}
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "size": len(self.__servers),
+                "max_size": self.max_size
+            }
+
+    def __get_stats__(self, server_ip: str, now: float) -> Optional[ServerStats]:
+        stats = self.__servers.get(server_ip)
+        if stats is not None and now - stats.updated_at > self.entry_ttl:
+            del self.__servers[server_ip]
+            return None
+        return stats
+
+    def __put_stats__(self, server_ip: str, stats: ServerStats):
+        self.__servers[server_ip] = stats
+        self.__servers.move_to_end(server_ip)
+        while len(self.__servers) > self.max_size:
+            self.__servers.popitem(last=False)
+
+    @staticmethod
+    def __score__(stats: Optional[ServerStats]) -> float:
+        if stats is None:
+            return UNKNOWN_SERVER_RTT
+
+        srtt = UNKNOWN_SERVER_RTT if stats.srtt is None else stats.srtt
+        return srtt + stats.timeouts * TIMEOUT_PENALTY
+
+
+infra_cache = InfraCache()
@@ -0,0 +1,65 @@
+import argparse
+import asyncio
+import time
+from typing import List
+
+import dns.asyncquery
+import dns.exception
+import dns.message
+
+from batch import read_requests
+
+LOAD_TEST_QUERIES = 1000
+LOAD_TEST_CONCURRENCY = 50
+LOAD_TEST_TIMEOUT = 5
+
+
+# Sends the queries of an input file round robin to a running server.py, `concurrency` at a time,
+# and reports the sustained rate and latency percentiles
+async def run_load_test(host: str, port: int, input_filename: str, total_queries: int, concurrency: int):
+    requests = read_requests(input_filename)
+    queries = [dns.message.make_query(request.name, request.type) for request in requests]
+    latencies = []
+    failures = 0
+    next_query = 0
+
+    async def worker():
+        nonlocal failures, next_query
+        while next_query < total_queries:
+            query = queries[next_query % len(queries)]
+            next_query += 1
+
+            start_time = time.perf_counter()
+            try:
+                await dns.asyncquery.udp(query, host, timeout=LOAD_TEST_TIMEOUT, port=port)
+                latencies.append(time.perf_counter() - start_time)
+            except dns.exception.DNSException:
+                failures += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    print("Queries: " + str(len(latencies) + failures) + ", failed: " + str(failures))
+    print("Sustained rate: " + str(round(len(latencies) / elapsed, 1)) + " queries/s")
+    print("p50 latency: " + str(round(__percentile__(latencies, 50) * 1000, 2)) + " ms")
+    print("p99 latency: " + str(round(__percentile__(latencies, 99) * 1000, 2)) + " ms")
+
+
+def __percentile__(sorted_values: List[float], percent: int) -> float:
+    if len(sorted_values) == 0:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, len(sorted_values) * percent // 100)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5353)
+    parser.add_argument("--input", default="./mydig_input.txt", help="queries to send, in the mydig input format")
+    parser.add_argument("--queries", type=int, default=LOAD_TEST_QUERIES, help="total number of queries to send")
+    parser.add_argument("--concurrency", type=int, default=LOAD_TEST_CONCURRENCY)
+    args = parser.parse_args()
+
+    asyncio.run(run_load_test(args.host, args.port, args.input, args.queries, args.concurrency))
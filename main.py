@@ -1,6 +1,11 @@
-import sys
+import argparse
 
+import capture
 import mydig
+import output
+import persistence
+import tracing
+import transport
 from models import Request
 
 INPUT_FILENAME = "./mydig_input.txt"
@@ -8,29 +13,63 @@ OUTPUT_FILENAME = "./mydig_output.txt"
 
 # Code for Part A
 if __name__ == '__main__':
-    output_lines = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument("name", nargs="?")
+    parser.add_argument("type", nargs="?")
+    parser.add_argument("--concurrency", type=int,
+                        help="number of queries from the input file resolved at once")
+    parser.add_argument("--cache-file",
+                        help="keep a warm cache of delegations, records and DNSSEC keys in this file across runs")
+    parser.add_argument("--edns-payload-size", type=int,
+                        help="UDP payload size advertised to name servers, larger responses are fetched over TCP")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="shard the queries of the input file by zone across this many processes")
+    parser.add_argument("--input", default=INPUT_FILENAME, help="queries to resolve, one per line")
+    parser.add_argument("--output", default=OUTPUT_FILENAME)
+    parser.add_argument("--output-format", choices=output.OUTPUT_FORMATS, default="text")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue an interrupted run of the same input from its last checkpoint")
+    parser.add_argument("--trace", action="store_true",
+                        help="add every server query, cache hit and validation of a resolution to its output")
+    parser.add_argument("--capture", metavar="FILE", help="record every upstream query and response to this file")
+    parser.add_argument("--replay", nargs="+", metavar="FILE",
+                        help="answer upstream queries from these capture files instead of the network")
+    parser.add_argument("--replay-speed", type=float, default=0.0,
+                        help="1 takes as long as the capture did, 2 twice as fast, 0 does not wait")
+    parser.add_argument("--metrics-file", help="write cache, latency and server RTT metrics to this file at exit")
+    parser.add_argument("--metrics-format", choices=["json", "prometheus"], default="json")
+    args = parser.parse_args()
 
-    if len(sys.argv) > 2:
-        _, name, type = tuple(sys.argv)
+    if args.cache_file is not None:
+        persistence.open_persistent_store(args.cache_file)
+    if args.capture is not None:
+        capture.start_capture(args.capture)
+    if args.replay is not None:
+        capture.start_replay(args.replay, args.replay_speed)
+    if args.edns_payload_size is not None:
+        transport.EDNS_PAYLOAD_SIZE = args.edns_payload_size
+    if args.trace:
+        tracing.enable_tracing()
+
+    if args.type is not None:
         response = mydig.resolve_dns(
             Request(
-                name=name,
-                type=type
+                name=args.name,
+                type=args.type
             )
         )
-        output_lines.append(str(response))
+
+        output.write_responses(args.output, [response], args.output_format)
     else:
-        with open(INPUT_FILENAME, 'r') as input_file:
-            for query in input_file.readlines():
-                url, type = tuple(query.rstrip('\n').split(" "))
-                response = mydig.resolve_dns(
-                    Request(
-                        name=url,
-                        type=type
-                    )
-                )
-                output_lines.append(str(response))
-
-    with open(OUTPUT_FILENAME, 'w') as output_file:
-        for output_line in output_lines:
-            output_file.write(output_line)
+        # Only file mode needs the asyncio machinery, a single query starts without it.
+        # Results are written as they complete, so memory does not grow with the input.
+        import batch
+        import pipeline
+        concurrency = args.concurrency if args.concurrency is not None else batch.BATCH_CONCURRENCY
+
+        pipeline.run_pipeline(mydig.resolve_dns_async, args.input, args.output, args.output_format, concurrency,
+                              args.resume, args.workers)
+
+    if args.metrics_file is not None:
+        import metrics
+        metrics.write_metrics(args.metrics_file, args.metrics_format)
@@ -0,0 +1,96 @@
+import json
+from typing import Dict
+
+import capture
+from cache import rrset_cache
+from infra import infra_cache
+from nsec_cache import nsec_cache
+import prefetch
+from signatures import signature_memo
+from singleflight import query_flights, resolution_flights
+import tracing
+from zone_cuts import zone_cut_index
+
+METRICS_FORMATS = ["json", "prometheus"]
+PROMETHEUS_PREFIX = "mydig_"
+
+
+# Common code for Part A and Part B
+# Counters of the process wide caches and coalescing, by component
+def collect_metrics() -> Dict[str, Dict[str, int]]:
+    metrics = {
+        "rrset_cache": rrset_cache.stats(),
+        "zone_cuts": zone_cut_index.stats(),
+        "infra_cache": infra_cache.stats(),
+        "signature_memo": signature_memo.stats(),
+        "aggressive_nsec": nsec_cache.stats(),
+        "query_coalescing": query_flights.stats(),
+        "resolution_coalescing": resolution_flights.stats()
+    }
+    if prefetch.prefetcher is not None:
+        metrics["prefetch"] = prefetch.prefetcher.stats()
+    if capture.recorder is not None:
+        metrics["capture"] = capture.recorder.stats()
+    if capture.replayer is not None:
+        metrics["replay"] = capture.replayer.stats()
+    return metrics
+
+
+# Latency histograms in seconds, of whole resolutions and of DNSSEC signature validations
+def collect_histograms() -> Dict[str, Dict]:
+    return {
+        "resolution_latency_seconds": tracing.resolution_latency.stats(),
+        "validation_latency_seconds": tracing.validation_latency.stats()
+    }
+
+
+# Counters, histograms and per server RTTs in the given METRICS_FORMATS format
+def export_metrics(metrics_format: str = "json") -> str:
+    if metrics_format == "prometheus":
+        return __export_prometheus__()
+
+    histograms = collect_histograms()
+    for histogram in histograms.values():
+        histogram["buckets"] = {__format_bound__(bound): count for bound, count in histogram["buckets"].items()}
+    return json.dumps({
+        "counters": collect_metrics(),
+        "histograms": histograms,
+        "servers": infra_cache.server_stats()
+    }, indent=2)
+
+
+# Prometheus text exposition format, counters are exported as untyped samples
+def __export_prometheus__() -> str:
+    lines = []
+    for component, counters in collect_metrics().items():
+        for counter, value in counters.items():
+            lines.append(PROMETHEUS_PREFIX + component + "_" + counter + " " + str(value))
+
+    for name, histogram in collect_histograms().items():
+        metric_name = PROMETHEUS_PREFIX + name
+        lines.append("# TYPE " + metric_name + " histogram")
+        for bound, count in histogram["buckets"].items():
+            lines.append(metric_name + '_bucket{le="' + __format_bound__(bound) + '"} ' + str(count))
+        lines.append(metric_name + "_sum " + repr(histogram["sum"]))
+        lines.append(metric_name + "_count " + str(histogram["count"]))
+
+    server_stats = infra_cache.server_stats()
+    lines.append("# TYPE " + PROMETHEUS_PREFIX + "server_srtt_seconds gauge")
+    for server_ip, stats in server_stats.items():
+        if stats["srtt"] is not None:
+            lines.append(PROMETHEUS_PREFIX + 'server_srtt_seconds{server="' + server_ip + '"} ' + repr(stats["srtt"]))
+    lines.append("# TYPE " + PROMETHEUS_PREFIX + "server_timeouts gauge")
+    for server_ip, stats in server_stats.items():
+        lines.append(PROMETHEUS_PREFIX + 'server_timeouts{server="' + server_ip + '"} ' + str(stats["timeouts"]))
+
+    return "\n".join(lines) + "\n"
+
+
+def __format_bound__(bound: float) -> str:
+    return "+Inf" if bound == float("inf") else repr(bound)
+
+
+# Writes the metrics to a file, for the command line tools at exit
+def write_metrics(file_name: str, metrics_format: str = "json"):
+    with open(file_name, "w") as metrics_file:
+        metrics_file.write(export_metrics(metrics_format))
@@ -1,34 +1,43 @@
+import sys
 from typing import List, Optional
 
-import dns
+import dns.rdatatype
+
+from tracing import QueryTrace
 
 
 # Common code for Part A and Part B
+# Batch runs keep many of these alive, so they are slotted and the strings that repeat across results
+# (types, name server and mail exchange names) are interned
 class Request:
+    __slots__ = ("name", "type")
     name: str
     type: str
 
     def __init__(self, name: str, type: str):
         self.name = name
-        self.type = type
+        self.type = sys.intern(type)
 
     def is_valid_request(self):
         return self.type in ['A', 'NS', 'MX']
 
 
 class ResponseRecord:
+    __slots__ = ("type", "value")
     type: dns.rdatatype.RdataType
     value: str
 
     def __init__(self, type, value):
         self.type = type
-        self.value = value
+        self.value = sys.intern(value)
 
     def __str__(self):
         return str(self.type) + " " + self.value
 
 
 class Response:
+    __slots__ = ("name", "type", "answer_records", "authority_records", "query_time", "when", "msg_size_rcvd",
+                 "dnssec_error", "trace")
     name: str
     type: str
     answer_records: List[ResponseRecord]
@@ -37,23 +46,26 @@ class Response:
     when: str
     msg_size_rcvd: int
     dnssec_error: Optional[str]
+    trace: Optional[QueryTrace]
 
-    def __init__(self, name: str, type: str, answer_records: List[ResponseRecord], authority_records: List[ResponseRecord], query_time: int, when: str, msg_size_rcvd: int, dnssec_error: Optional[str] = None):
+    def __init__(self, name: str, type: str, answer_records: List[ResponseRecord], authority_records: List[ResponseRecord], query_time: int, when: str, msg_size_rcvd: int, dnssec_error: Optional[str] = None, trace: Optional[QueryTrace] = None):
         self.name = name
-        self.type = type
+        self.type = sys.intern(type)
         self.answer_records = answer_records
         self.authority_records = authority_records
         self.query_time = query_time
         self.when = when
         self.msg_size_rcvd = msg_size_rcvd
         self.dnssec_error= dnssec_error
+        self.trace = trace
 
     def __str__(self):
-        return "Question section - " + "Name: " + self.name + " Type: " + self.type \
-               + "\nAnswer section - " + \
-               str([str(response_record) for response_record in self.answer_records]) + \
-               "\nAuthority section - " + \
-               str([str(response_record) for response_record in self.authority_records]) + \
-               "\nMetadata - Query time: " + str(self.query_time) + "ms When: " + self.when + \
-               " Msg size rcvd: " + str(self.msg_size_rcvd) + "\n" + \
-               "DNSSEC error message: " + str(self.dnssec_error) + "\n"
+        return "".join((
+            "Question section - Name: ", self.name, " Type: ", self.type,
+            "\nAnswer section - ", str([str(response_record) for response_record in self.answer_records]),
+            "\nAuthority section - ", str([str(response_record) for response_record in self.authority_records]),
+            "\nMetadata - Query time: ", str(self.query_time), "ms When: ", self.when,
+            " Msg size rcvd: ", str(self.msg_size_rcvd), "\n",
+            "DNSSEC error message: ", str(self.dnssec_error), "\n",
+            "" if self.trace is None else "Trace -\n" + str(self.trace) + "\n"
+        ))
@@ -1,56 +1,131 @@
 import datetime
-import sys
 import time
 from typing import Optional, List, Tuple
 
 import dns.name
-import dns.query
+import dns.rcode
+import dns.rrset
 from dns.message import make_query, Message
+from cache import lookup_response_message, lookup_stale_response_message, cache_response_message
 from models import Request, Response, ResponseRecord
+from glueless import GluelessAddresses
+import tracing
+import transport
+from singleflight import resolution_flights
+from zone_cuts import closest_name_servers, referral_glue, referral_ns_rrset, referral_zone, remember_referral
 
 DNS_QUERY_TIMEOUT = 1
 ROOT_SERVER_IPV4S_FILE_NAME = "./root_server_ipv4s.txt"
 
+root_server_ips_by_file = dict()
+
 
 # Code for part A
 def resolve_dns(request: Request) -> Response:
+    trace = tracing.start_trace()
     start_time = time.time()
-    answer_records, authority_records, msg_size_rcvd = __resolve_dns__(request)
+    answer_rrsets, authority_rrsets, _, msg_size_rcvd = __resolve_dns__(request)
     end_time = time.time()
+    tracing.finish_trace(trace, end_time - start_time)
 
     return Response(
         name=request.name,
         type=request.type,
-        answer_records=answer_records,
-        authority_records=authority_records,
+        answer_records=__parse_dns_records_from_section__(answer_rrsets),
+        authority_records=__parse_dns_records_from_section__(authority_rrsets),
         query_time=int((end_time - start_time) * 1000),
         when=str(datetime.datetime.now()),
-        msg_size_rcvd=msg_size_rcvd
+        msg_size_rcvd=msg_size_rcvd,
+        trace=trace
     )
 
 
+# Awaitable counterpart of resolve_dns for batch and server modes. The walk blocks, it runs on a thread of the
+# loop's default executor, whose size caps the resolutions in flight.
+async def resolve_dns_async(request: Request) -> Response:
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(None, resolve_dns, request)
+
+
+# The answer and authority RRsets the resolution ended with and its response code, for the daemon to answer
+# in wire format. The RRsets are shared and must not be modified.
+def resolve_rrsets(request: Request) -> Tuple[List[dns.rrset.RRset], List[dns.rrset.RRset], int]:
+    answer_rrsets, authority_rrsets, rcode, _ = __resolve_dns__(request)
+    return answer_rrsets, authority_rrsets, rcode
+
+
+# Concurrent resolutions of the same question share one walk, the RRsets returned must not be modified
 def __resolve_dns__(request: Request) -> Tuple[
-    List[ResponseRecord],
-    List[ResponseRecord],
+    List[dns.rrset.RRset],
+    List[dns.rrset.RRset],
+    int,
+    int
+]:
+    key = ("mydig", dns.name.from_text(request.name), request.type)
+    return resolution_flights.do(key, lambda: __walk__(request))
+
+
+# Answer and authority RRsets of the responses along the walk, CNAMEs included, the response code of the
+# last one and its size
+def __walk__(request: Request) -> Tuple[
+    List[dns.rrset.RRset],
+    List[dns.rrset.RRset],
+    int,
     int
 ]:
     request_message = __generate_request_message__(request)
 
-    root_server_ips = []
-    with open(ROOT_SERVER_IPV4S_FILE_NAME, "r") as root_file:
-        root_server_ips = [root_server_ip.rstrip('\n') for root_server_ip in root_file.readlines()]
+    root_server_ips = __read_root_server_ips__(ROOT_SERVER_IPV4S_FILE_NAME)
 
-    final_answer_records = []
-    final_authority_records = []
+    final_answer_rrsets = []
+    final_authority_rrsets = []
     final_message_size = 0
-    name_server_ips = root_server_ips
+    # The zone whose servers are asked, answers from them are only cached within it
+    zone, name_server_ips = closest_name_servers(request_message.question[0].name, root_server_ips)
+    new_question = True
+    from_root = zone == dns.name.root
+    glueless_ips = None
 
     while True:
-        response_message = __resolve_dns_from_servers__(request_message, name_server_ips)
-        final_message_size = sys.getsizeof(response_message.to_wire()) if response_message is not None else 0
+        # Answer new questions from cache before walking down from the root servers
+        response_message = lookup_response_message(request_message) if new_question else None
+        if response_message is not None:
+            tracing.record_hop(tracing.CACHE, request_message.question[0].name, request_message.question[0].rdtype)
+        new_question = False
 
-        # DNS resolution failed
         if response_message is None:
+            response_message = __resolve_dns_from_servers__(request_message, name_server_ips)
+            final_message_size = response_message.wire_size if response_message is not None else 0
+
+            # A referral that does not lead down towards the name goes nowhere, the servers are lame
+            if response_message is not None and __is_lame_referral__(response_message, zone):
+                response_message = None
+
+            # The servers of a referral without glue answered, the lookups of its other name servers can stop
+            if response_message is not None and glueless_ips is not None:
+                glueless_ips.close()
+                glueless_ips = None
+
+            if response_message is not None:
+                cache_response_message(response_message, zone)
+
+        # Nothing left to ask, answer with an expired copy if one was kept for this (RFC 8767)
+        if response_message is None and glueless_ips is None and from_root:
+            response_message = lookup_stale_response_message(request_message)
+
+        # The name servers of a referral without glue resolved so far did not answer, try the next ones
+        if response_message is None and glueless_ips is not None:
+            name_server_ips = glueless_ips.next_ips()
+            if len(name_server_ips) == 0:
+                glueless_ips = None
+            continue
+        # The servers of a remembered zone cut did not answer, walk down from the root servers instead
+        elif response_message is None and not from_root:
+            zone, name_server_ips = dns.name.root, root_server_ips
+            from_root = True
+            continue
+        # DNS resolution failed
+        elif response_message is None:
             break
         # Did not get an answer, so pass the request on to name servers
         elif len(response_message.answer) == 0 and (request.type == "A" or len(response_message.additional) > 0):
@@ -58,18 +133,18 @@ def __resolve_dns__(request: Request) -> Tuple[
 
             # In some cases, we get an SOA response for A requests, which cannot be resolved further
             if True in (authority_record.type == dns.rdatatype.SOA for authority_record in authority_records):
-                final_authority_records += authority_records
-                return final_answer_records, final_authority_records, final_message_size
+                final_authority_rrsets += response_message.authority
+                return final_answer_rrsets, final_authority_rrsets, response_message.rcode(), final_message_size
 
-            name_server_ips = __parse_name_server_ips_from_response__(response_message)
+            name_server_ips, glueless_ips = __parse_name_server_ips_from_response__(response_message, zone)
+            remember_referral(response_message, zone, name_server_ips)
+            zone = referral_zone(response_message, zone)
         else:
             # Got an answer, either in the 'Answer' or 'Authority' section
             answer_records = __parse_dns_records_from_section__(response_message.answer)
-            authority_records = __parse_dns_records_from_section__(response_message.authority) \
-                if len(response_message.authority) > 0 else []
 
-            final_answer_records += answer_records
-            final_authority_records += authority_records
+            final_answer_rrsets += response_message.answer
+            final_authority_rrsets += response_message.authority
 
             # got a CNAME record. Resolve as an 'A' request from root
             if len(answer_records) == 1 and answer_records[0].type == dns.rdatatype.CNAME:
@@ -77,39 +152,39 @@ def __resolve_dns__(request: Request) -> Tuple[
                     name=answer_records[0].value,
                     type="A"
                 ))
-                name_server_ips = root_server_ips
+                zone, name_server_ips = closest_name_servers(request_message.question[0].name, root_server_ips)
+                new_question = True
+                from_root = zone == dns.name.root
+                glueless_ips = None
             # we are done
             else:
-                return final_answer_records, final_authority_records, final_message_size
+                return final_answer_rrsets, final_authority_rrsets, response_message.rcode(), final_message_size
 
     # DNS resolution failed
-    return [], [], 0
+    return [], [], dns.rcode.SERVFAIL, 0
 
 
-# Try every server until we get a DNS response
-def __resolve_dns_from_servers__(request_message: Message, dns_server_ips: List[str]) -> Optional[Message]:
-    response_message = None
-    for dns_server_ip in dns_server_ips:
-        response_message = __resolve_dns_from_server__(request_message, dns_server_ip)
-        if response_message is not None:
-            break
+# The root hints are read once per file instead of on every resolution
+def __read_root_server_ips__(file_name: str) -> List[str]:
+    root_server_ips = root_server_ips_by_file.get(file_name)
+    if root_server_ips is None:
+        with open(file_name, "r") as root_file:
+            root_server_ips = [root_server_ip.rstrip('\n') for root_server_ip in root_file.readlines()]
+        root_server_ips_by_file[file_name] = root_server_ips
+
+    return root_server_ips
 
-    return response_message
 
+# A response with neither answers nor an SOA record that does not refer to a zone below the one asked either
+def __is_lame_referral__(response_message: Message, zone: dns.name.Name) -> bool:
+    return len(response_message.answer) == 0 and referral_zone(response_message, zone) is None and \
+        not any(rrset.rdtype == dns.rdatatype.SOA for rrset in response_message.authority)
 
-def __resolve_dns_from_server__(request_message: Message, root_server_name: str) -> Optional[Message]:
-    response_message = None
-    try:
-        response_message = dns.query.udp(
-            request_message,
-            root_server_name,
-            DNS_QUERY_TIMEOUT
-        )
-    except Exception as e:
-        print("Error when querying DNS server " + root_server_name + " error message " + e.msg)
-        response_message = None
-    finally:
-        return response_message
+
+# Try the servers with staggered parallel attempts until we get a DNS response
+def __resolve_dns_from_servers__(request_message: Message, dns_server_ips: List[str]) -> Optional[Message]:
+    response_message, _ = transport.query_servers(request_message, dns_server_ips, DNS_QUERY_TIMEOUT)
+    return response_message
 
 
 def __generate_request_message__(request: Request) -> Message:
@@ -120,31 +195,43 @@ def __generate_request_message__(request: Request) -> Message:
     else:
         dns_type = dns.rdatatype.MX
 
+    # EDNS lets referrals with many glue records come back over UDP instead of truncated
     return make_query(
         dns.name.from_text(request.name),
-        dns_type
+        dns_type,
+        use_edns=0,
+        payload=transport.EDNS_PAYLOAD_SIZE
     )
 
 
-def __parse_name_server_ips_from_response__(response_message: Message) -> List[str]:
+# Glue addresses of the referral, for a referral without glue the addresses of the first name server
+# resolved, with the lookups of the others kept for when those servers do not answer
+def __parse_name_server_ips_from_response__(response_message: Message, zone: dns.name.Name) -> Tuple[
+    List[str],
+    Optional[GluelessAddresses]
+]:
     name_server_ips = []
 
-    if len(response_message.additional) > 0:
-        for rrset in response_message.additional:
-            if rrset.rdtype == dns.rdatatype.A:
-                name_server_ips += [item.address for item in rrset.items]
-    else:
-        authority_records = __parse_dns_records_from_section__(response_message.authority)
-        for authority_record in authority_records:
-            new_request =  Request(
-                name=authority_record.value,
-                type='A'
-            )
-            answer_records, _, _ = __resolve_dns__(new_request)
-            name_server_ips += [answer_record.value for answer_record in answer_records
-                                if answer_record.type == dns.rdatatype.A]
-
-    return name_server_ips
+    glue_rrsets = referral_glue(response_message, zone)
+    if len(glue_rrsets) > 0:
+        for rrset in glue_rrsets:
+            name_server_ips += [item.address for item in rrset.items]
+        return name_server_ips, None
+
+    ns_rrset = referral_ns_rrset(response_message, zone)
+    glueless_ips = GluelessAddresses(
+        [item.target.to_text() for item in ns_rrset.items] if ns_rrset is not None else [],
+        __resolve_name_server_ips__
+    )
+    return glueless_ips.next_ips(), glueless_ips
+
+
+def __resolve_name_server_ips__(ns_name: str) -> List[str]:
+    answer_rrsets, _, _, _ = __resolve_dns__(Request(
+        name=ns_name,
+        type='A'
+    ))
+    return [item.address for rrset in answer_rrsets if rrset.rdtype == dns.rdatatype.A for item in rrset.items]
 
 
 def __parse_dns_records_from_section__(section) -> List[ResponseRecord]:
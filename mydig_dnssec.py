@@ -1,14 +1,22 @@
 import datetime
-import sys
 import time
 from typing import Optional, List, Tuple
 
 import dns.name
-import dns.query
+import dns.rcode
+import dns.rrset
 from dns.message import make_query, Message
+from cache import lookup_response_message, lookup_stale_response_message, cache_response_message
 from models import Request, Response, ResponseRecord
-from dnssec_validation import validate_response
+from dnssec_validation import validate_signatures, validate_delegation, validate_denial, is_trusted_zone, \
+    ensure_root_trust
 import mydig
+from glueless import GluelessAddresses
+import tracing
+import transport
+from nsec_cache import nsec_cache, synthesize_response_message
+from singleflight import resolution_flights
+from zone_cuts import closest_name_servers, referral_glue, referral_ns_rrset, referral_zone, remember_referral
 
 DNS_QUERY_TIMEOUT = 1
 ROOT_SERVER_IPV4S_FILE_NAME = "./root_server_ipv4s.txt"
@@ -16,63 +24,162 @@ ROOT_SERVER_IPV4S_FILE_NAME = "./root_server_ipv4s.txt"
 
 # Code for part B
 def resolve_dns(request: Request) -> Response:
+    trace = tracing.start_trace()
     start_time = time.time()
-    answer_records, authority_records, msg_size_rcvd, dnssec_error = __resolve_dns__(request)
+    answer_rrsets, authority_rrsets, _, msg_size_rcvd, dnssec_error = __resolve_dns__(request)
     end_time = time.time()
+    tracing.finish_trace(trace, end_time - start_time)
 
     return Response(
         name=request.name,
         type=request.type,
-        answer_records=answer_records,
-        authority_records=authority_records,
+        answer_records=__parse_dns_records_from_section__(answer_rrsets),
+        authority_records=__parse_dns_records_from_section__(authority_rrsets),
         query_time=int((end_time - start_time) * 1000),
         when=str(datetime.datetime.now()),
         msg_size_rcvd=msg_size_rcvd,
-        dnssec_error = dnssec_error
+        dnssec_error = dnssec_error,
+        trace=trace
     )
 
 
+# Awaitable counterpart of resolve_dns for batch and server modes. The walk blocks, it runs on a thread of the
+# loop's default executor, whose size caps the resolutions in flight.
+async def resolve_dns_async(request: Request) -> Response:
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(None, resolve_dns, request)
+
+
+# The answer and authority RRsets the resolution ended with and its response code, SERVFAIL when validation
+# failed, for the daemon to answer in wire format. The RRsets are shared and must not be modified.
+def resolve_rrsets(request: Request) -> Tuple[List[dns.rrset.RRset], List[dns.rrset.RRset], int]:
+    answer_rrsets, authority_rrsets, rcode, _, dnssec_error = __resolve_dns__(request)
+    if dnssec_error is not None:
+        return [], [], dns.rcode.SERVFAIL
+    return answer_rrsets, authority_rrsets, rcode
+
+
+# The delegation walk with DNSSEC validation as one of its stages: every referral extends the chain of trust
+# to the child zone, asking the referral's own name servers for the child's DNSKEY, and every answer is
+# checked against the keys of the zone that served it.
+# Concurrent resolutions of the same question share one walk, the RRsets returned must not be modified.
 def __resolve_dns__(request: Request) -> Tuple[
-    List[ResponseRecord],
-    List[ResponseRecord],
+    List[dns.rrset.RRset],
+    List[dns.rrset.RRset],
+    int,
+    int,
+    Optional[str]
+]:
+    key = ("mydig_dnssec", dns.name.from_text(request.name), request.type)
+    return resolution_flights.do(key, lambda: __walk__(request))
+
+
+def __walk__(request: Request) -> Tuple[
+    List[dns.rrset.RRset],
+    List[dns.rrset.RRset],
+    int,
     int,
     Optional[str]
 ]:
     request_message = __generate_request_message__(request)
 
-    root_server_ips = []
-    with open(ROOT_SERVER_IPV4S_FILE_NAME, "r") as root_file:
-        root_server_ips = [root_server_ip.rstrip('\n') for root_server_ip in root_file.readlines()]
+    root_server_ips = mydig.__read_root_server_ips__(ROOT_SERVER_IPV4S_FILE_NAME)
+
+    # The root trust anchor is checked against the root DNSKEY RRset the first time it is needed
+    dnssec_error = ensure_root_trust(root_server_ips)
+    if dnssec_error is not None:
+        return [], [], dns.rcode.SERVFAIL, 0, dnssec_error
 
-    final_answer_records = []
-    final_authority_records = []
+    final_answer_rrsets = []
+    final_authority_rrsets = []
     final_message_size = 0
-    name_server_ips = root_server_ips
+    # The zone whose servers are asked, answers from them are only cached within it
+    zone, name_server_ips = __closest_secure_name_servers__(request_message, root_server_ips)
+    new_question = True
+    from_root = zone == dns.name.root
+    glueless_ips = None
+    dnssec_error = None
 
     while True:
-        response_message, dnssec_error = __resolve_dns_from_servers__(request_message, name_server_ips)
-        final_message_size = sys.getsizeof(response_message.to_wire()) if response_message is not None else 0
-
+        # Only answers that passed DNSSEC validation are served from cache
+        response_message = lookup_response_message(request_message, secure=True) if new_question else None
+        # Names proven absent by validated NSEC/NSEC3 records are answered without asking the zone's servers
+        if response_message is None and new_question:
+            response_message = synthesize_response_message(request_message)
+        from_cache = response_message is not None
+        if from_cache:
+            tracing.record_hop(tracing.CACHE, request_message.question[0].name, request_message.question[0].rdtype)
+        new_question = False
+
+        if response_message is None:
+            response_message = __resolve_dns_from_servers__(request_message, name_server_ips)
+            final_message_size = response_message.wire_size if response_message is not None else 0
+
+            # A referral that does not lead down towards the name goes nowhere, the servers are lame
+            if response_message is not None and mydig.__is_lame_referral__(response_message, zone):
+                response_message = None
+
+            # The servers of a referral without glue answered, the lookups of its other name servers can stop
+            if response_message is not None and glueless_ips is not None:
+                glueless_ips.close()
+                glueless_ips = None
+
+        # Nothing left to ask, answer with an expired copy of validated records if one was kept (RFC 8767)
+        if response_message is None and glueless_ips is None and from_root:
+            response_message = lookup_stale_response_message(request_message, secure=True)
+            from_cache = response_message is not None
+
+        # The name servers of a referral without glue resolved so far did not answer, try the next ones
+        if response_message is None and glueless_ips is not None:
+            name_server_ips = glueless_ips.next_ips()
+            if len(name_server_ips) == 0:
+                glueless_ips = None
+            continue
+        # The servers of a remembered zone cut did not answer, walk down from the root servers instead
+        elif response_message is None and not from_root:
+            zone, name_server_ips = dns.name.root, root_server_ips
+            from_root = True
+            continue
         # DNS resolution failed
-        if response_message is None or dnssec_error is not None:
+        elif response_message is None:
             break
-        # Did not get an answer, so pass the request on to name servers
-        elif len(response_message.answer) == 0 and (request.type == "A" or len(response_message.additional) > 0):
-            authority_records = __parse_dns_records_from_section__(response_message.authority)
-
-            # In some cases, we get an SOA response for A requests, which cannot be resolved further
-            if True in (authority_record.type == dns.rdatatype.SOA for authority_record in authority_records):
-                final_authority_records += authority_records
-                return final_answer_records, final_authority_records, final_message_size, None
-
-            name_server_ips = __parse_name_server_ips_from_response__(response_message)
+        # A referral, whatever the type asked, extend the chain of trust to the child zone before following it
+        elif len(response_message.answer) == 0 and referral_zone(response_message, zone) is not None:
+            name_server_ips, glueless_ips = __parse_name_server_ips_from_response__(response_message, zone)
+            dnssec_error = validate_delegation(response_message, name_server_ips)
+            if dnssec_error is not None:
+                break
+
+            cache_response_message(response_message, zone)
+            remember_referral(response_message, zone, name_server_ips, secure=True)
+            zone = referral_zone(response_message, zone)
+        # No such name or no records of the type, which only its validated NSEC or NSEC3 records can prove
+        elif len(response_message.answer) == 0:
+            if not from_cache:
+                dnssec_error = validate_signatures(response_message, response_message.authority)
+                if dnssec_error is not None:
+                    break
+                dnssec_error, secure = validate_denial(response_message, zone)
+                if dnssec_error is not None:
+                    break
+                # Only proven negatives are secure, a secure NXDOMAIN answers for every name below it as well
+                cache_response_message(response_message, zone, secure=secure)
+                nsec_cache.put_response(response_message)
+
+            final_authority_rrsets += response_message.authority
+            return final_answer_rrsets, final_authority_rrsets, response_message.rcode(), final_message_size, None
         else:
+            if not from_cache:
+                dnssec_error = validate_signatures(response_message, response_message.answer)
+                if dnssec_error is not None:
+                    break
+                cache_response_message(response_message, zone, secure=True)
+                nsec_cache.put_response(response_message)
+
             answer_records = __parse_dns_records_from_section__(response_message.answer)
-            authority_records = __parse_dns_records_from_section__(response_message.authority) \
-                if len(response_message.authority) > 0 else []
 
-            final_answer_records += answer_records
-            final_authority_records += authority_records
+            final_answer_rrsets += response_message.answer
+            final_authority_rrsets += response_message.authority
 
             # got a CNAME record
             if len(answer_records) == 1 and answer_records[0].type == dns.rdatatype.CNAME:
@@ -80,48 +187,30 @@ def __resolve_dns__(request: Request) -> Tuple[
                     name=answer_records[0].value,
                     type="A"
                 ))
-                name_server_ips = root_server_ips
+                zone, name_server_ips = __closest_secure_name_servers__(request_message, root_server_ips)
+                new_question = True
+                from_root = zone == dns.name.root
+                glueless_ips = None
             # we are done
             else:
-                return final_answer_records, final_authority_records, final_message_size, None
+                return final_answer_rrsets, final_authority_rrsets, response_message.rcode(), final_message_size, \
+                    None
 
     # DNS resolution failed
-    return [], [], 0, dnssec_error
+    return [], [], dns.rcode.SERVFAIL, 0, dnssec_error
 
 
-def __resolve_dns_from_servers__(request_message: Message, dns_server_ips: List[str]) -> \
-      Tuple[Optional[Message], Optional[str]]:
-    response_message = None
-    dnssec_error = None
+# Start below the root only at zone cuts whose chain of trust is still valid
+def __closest_secure_name_servers__(request_message: Message, root_server_ips: List[str]) -> \
+      Tuple[dns.name.Name, List[str]]:
+    return closest_name_servers(request_message.question[0].name, root_server_ips, secure=True,
+                                is_trusted=is_trusted_zone)
 
-    for dns_server_ip in dns_server_ips:
-        response_message, dnssec_error = __resolve_dns_from_server__(request_message, dns_server_ip)
-        if response_message is not None or dnssec_error is not None:
-            break
 
-    return response_message, dnssec_error
-
-
-def __resolve_dns_from_server__(request_message: Message, root_server_name: str) -> \
-      Tuple[Optional[Message], Optional[str]]:
-    response_message = None
-
-    try:
-        response_message = dns.query.udp(
-            request_message,
-            root_server_name,
-            DNS_QUERY_TIMEOUT
-        )
-    except Exception as e:
-        print("Error when querying DNS server " + root_server_name + " error message " + e.msg)
-        response_message = None
-    finally:
-        # Do dnssec validation on the DNS response
-        err_message = validate_response(response_message)
-        if err_message is not None:
-            return None, err_message
-        else:
-            return response_message, None
+# Try the servers with staggered parallel attempts until we get a DNS response, validation is up to the caller
+def __resolve_dns_from_servers__(request_message: Message, dns_server_ips: List[str]) -> Optional[Message]:
+    response_message, _ = transport.query_servers(request_message, dns_server_ips, DNS_QUERY_TIMEOUT)
+    return response_message
 
 
 def __generate_request_message__(request: Request) -> Message:
@@ -135,29 +224,39 @@ def __generate_request_message__(request: Request) -> Message:
     return make_query(
         qname=dns.name.from_text(request.name),
         rdtype=dns_type,
-        want_dnssec=True
+        want_dnssec=True,
+        payload=transport.EDNS_PAYLOAD_SIZE
     )
 
 
-def __parse_name_server_ips_from_response__(response_message: Message) -> List[str]:
+# Glue addresses of the referral, for a referral without glue the addresses of the first name server
+# resolved, with the lookups of the others kept for when those servers do not answer
+def __parse_name_server_ips_from_response__(response_message: Message, zone: dns.name.Name) -> Tuple[
+    List[str],
+    Optional[GluelessAddresses]
+]:
     name_server_ips = []
 
-    if len(response_message.additional) > 0:
-        for rrset in response_message.additional:
-            if rrset.rdtype == dns.rdatatype.A:
-                name_server_ips += [item.address for item in rrset.items]
-    else:
-        authority_records = __parse_dns_records_from_section__(response_message.authority)
-        for authority_record in authority_records:
-            new_request =  Request(
-                name=authority_record.value,
-                type='A'
-            )
-            answer_records, _, _ = mydig.__resolve_dns__(new_request)
-            name_server_ips += [answer_record.value for answer_record in answer_records
-                                if answer_record.type == dns.rdatatype.A]
-
-    return name_server_ips
+    glue_rrsets = referral_glue(response_message, zone)
+    if len(glue_rrsets) > 0:
+        for rrset in glue_rrsets:
+            name_server_ips += [item.address for item in rrset.items]
+        return name_server_ips, None
+
+    ns_rrset = referral_ns_rrset(response_message, zone)
+    glueless_ips = GluelessAddresses(
+        [item.target.to_text() for item in ns_rrset.items] if ns_rrset is not None else [],
+        __resolve_name_server_ips__
+    )
+    return glueless_ips.next_ips(), glueless_ips
+
+
+def __resolve_name_server_ips__(ns_name: str) -> List[str]:
+    answer_rrsets, _, _, _ = mydig.__resolve_dns__(Request(
+        name=ns_name,
+        type='A'
+    ))
+    return [item.address for rrset in answer_rrsets if rrset.rdtype == dns.rdatatype.A for item in rrset.items]
 
 
 def __parse_dns_records_from_section__(section) -> List[ResponseRecord]:
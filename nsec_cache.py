@@ -0,0 +1,349 @@
+import base64
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple, Union
+
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+from cache import rrset_cache
+
+NSEC_CACHE_MAX_ZONES = 1000
+# Ranges kept per zone, a flood of random names against a zone cannot grow the index past this
+NSEC_ZONE_MAX_RANGES = 10000
+NSEC3_OPT_OUT = 0x01
+# The only NSEC3 hash algorithm defined (RFC 5155) and the only one dns.dnssec.nsec3_hash computes
+NSEC3_SHA1 = 1
+
+
+class NsecRange:
+    owner: Union[dns.name.Name, bytes]
+    next: Union[dns.name.Name, bytes]
+    windows: tuple
+    opt_out: bool
+    expires_at: float
+
+    def __init__(self, owner: Union[dns.name.Name, bytes], next: Union[dns.name.Name, bytes], windows: tuple,
+                 opt_out: bool, expires_at: float):
+        self.owner = owner
+        self.next = next
+        self.windows = windows
+        self.opt_out = opt_out
+        self.expires_at = expires_at
+
+    def has_type(self, rdtype: dns.rdatatype.RdataType) -> bool:
+        window, bit = divmod(int(rdtype), 256)
+        for number, bitmap in self.windows:
+            if number == window:
+                return bit // 8 < len(bitmap) and bitmap[bit // 8] & (0x80 >> (bit % 8)) != 0
+        return False
+
+    # The owner name exists, but is a delegation to a child zone or redirects with DNAME, so the names
+    # below it are not proven absent by this zone's chain
+    def is_cut(self) -> bool:
+        return (self.has_type(dns.rdatatype.NS) and not self.has_type(dns.rdatatype.SOA)) or \
+               self.has_type(dns.rdatatype.DNAME)
+
+
+# The validated NSEC or NSEC3 chain of a signed zone seen so far, as ranges sorted by owner: names in
+# canonical DNS order for NSEC, hashes for NSEC3. Ranges that expired are dropped when found.
+class ZoneNsecIndex:
+    zone: dns.name.Name
+    soa_rrset: Optional[dns.rrset.RRset]
+    soa_expires_at: float
+    nsec3_parameters: Optional[Tuple[bytes, int, int]]
+
+    def __init__(self, zone: dns.name.Name):
+        self.zone = zone
+        self.soa_rrset = None
+        self.soa_expires_at = 0
+        self.nsec3_parameters = None
+        self.__owners: List[Union[dns.name.Name, bytes]] = []
+        self.__ranges: Dict[Union[dns.name.Name, bytes], NsecRange] = dict()
+
+    def size(self) -> int:
+        return len(self.__owners)
+
+    def add(self, nsec_range: NsecRange):
+        if nsec_range.owner not in self.__ranges:
+            if len(self.__owners) >= NSEC_ZONE_MAX_RANGES:
+                self.__drop_expired__(time.time())
+                if len(self.__owners) >= NSEC_ZONE_MAX_RANGES:
+                    return
+            bisect.insort(self.__owners, nsec_range.owner)
+        self.__ranges[nsec_range.owner] = nsec_range
+
+    # The live range with the key as owner or covering it, with whether the key is the owner
+    def find(self, key: Union[dns.name.Name, bytes], now: float) -> Tuple[Optional[NsecRange], bool]:
+        index = bisect.bisect_right(self.__owners, key) - 1
+        if index < 0:
+            # Only the last range of the chain, wrapping around to the start, can cover keys before the first owner
+            index = len(self.__owners) - 1
+            if index < 0:
+                return None, False
+
+        nsec_range = self.__ranges[self.__owners[index]]
+        if nsec_range.expires_at <= now:
+            self.__remove__(nsec_range.owner)
+            return None, False
+
+        if nsec_range.owner == key:
+            return nsec_range, True
+
+        wraps = nsec_range.next <= nsec_range.owner
+        covers = (nsec_range.owner < key < nsec_range.next) or \
+                 (wraps and (key > nsec_range.owner or key < nsec_range.next))
+        return (nsec_range, False) if covers else (None, False)
+
+    def nsec3_hash(self, name: dns.name.Name) -> bytes:
+        salt, iterations, algorithm = self.nsec3_parameters
+        # Imported on first use, like the rest of dns.dnssec
+        from dns.dnssec import nsec3_hash
+        return base64.b32hexdecode(nsec3_hash(name, salt, iterations, algorithm).upper())
+
+    def __drop_expired__(self, now: float):
+        for owner in [owner for owner, nsec_range in self.__ranges.items() if nsec_range.expires_at <= now]:
+            self.__remove__(owner)
+
+    def __remove__(self, owner: Union[dns.name.Name, bytes]):
+        del self.__ranges[owner]
+        del self.__owners[bisect.bisect_left(self.__owners, owner)]
+
+
+# Code for part B
+# Aggressive use of DNSSEC validated NSEC and NSEC3 records (RFC 8198): a name covered by a cached range does
+# not exist and a name whose own range lacks the type has no such records, so NXDOMAIN and NODATA answers
+# for the zone are synthesized without asking its servers. Synthesized answers last as long as the ranges
+# and SOA record they come from.
+class AggressiveNsecCache:
+    max_zones: int
+    synthesized_nxdomain: int
+    synthesized_nodata: int
+
+    def __init__(self, max_zones: int = NSEC_CACHE_MAX_ZONES):
+        self.max_zones = max_zones
+        self.synthesized_nxdomain = 0
+        self.synthesized_nodata = 0
+        self.__zones: OrderedDict = OrderedDict()
+        self.__lock = threading.Lock()
+
+    # Stores the NSEC and NSEC3 records of a response that passed validate_signatures, only records with a
+    # signature in the response are taken, their signatures were verified with the rest of the response
+    def put_response(self, response_message: dns.message.Message):
+        soa_rrsets = [rrset for rrset in response_message.authority if rrset.rdtype == dns.rdatatype.SOA]
+        rrsigs = {(rrset.name, rrset.covers): rrset for rrset in response_message.authority
+                  if rrset.rdtype == dns.rdatatype.RRSIG}
+        now = time.time()
+
+        with self.__lock:
+            for rrset in response_message.authority:
+                rrsig_rrset = rrsigs.get((rrset.name, rrset.rdtype))
+                if rrset.rdtype not in (dns.rdatatype.NSEC, dns.rdatatype.NSEC3) or rrsig_rrset is None:
+                    continue
+
+                zone = rrsig_rrset[0].signer
+                if not rrset.name.is_subdomain(zone):
+                    continue
+
+                # Negative answers may not be kept longer than the SOA allows (RFC 9077)
+                ttl = min([rrset.ttl] + [min(soa.ttl, soa[0].minimum) for soa in soa_rrsets if soa.name == zone])
+                expires_at = min(now + ttl, min(rrsig.expiration for rrsig in rrsig_rrset))
+                self.__zones[zone] = __add_range__(self.__zone_index__(zone), rrset, expires_at)
+
+            for soa_rrset in soa_rrsets:
+                zone_index = self.__zones.get(soa_rrset.name)
+                if zone_index is not None:
+                    zone_index.soa_rrset = soa_rrset
+                    zone_index.soa_expires_at = now + soa_rrset.ttl
+
+    # (rcode, SOA RRset with the TTL the answer may be cached for) when cached ranges prove the name does not
+    # exist or has no records of the type
+    def synthesize(self, name: dns.name.Name,
+                   rdtype: dns.rdatatype.RdataType) -> Optional[Tuple[dns.rcode.Rcode, dns.rrset.RRset]]:
+        now = time.time()
+
+        with self.__lock:
+            zone_index = self.__closest_zone_index__(name)
+            if zone_index is None or zone_index.soa_rrset is None or zone_index.soa_expires_at <= now:
+                return None
+
+            if zone_index.nsec3_parameters is None:
+                proof = __prove_with_nsec__(zone_index, name, rdtype, now)
+            else:
+                proof = __prove_with_nsec3__(zone_index, name, rdtype, now)
+            if proof is None:
+                return None
+
+            rcode, ranges = proof
+            if rcode == dns.rcode.NXDOMAIN:
+                self.synthesized_nxdomain += 1
+            else:
+                self.synthesized_nodata += 1
+
+            soa_rrset = zone_index.soa_rrset.copy()
+            soa_rrset.ttl = int(min([zone_index.soa_expires_at] + [nsec_range.expires_at for nsec_range in ranges])
+                                - now)
+            return rcode, soa_rrset
+
+    def clear(self):
+        with self.__lock:
+            self.__zones.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "zones": len(self.__zones),
+                "ranges": sum(zone_index.size() for zone_index in self.__zones.values()),
+                "synthesized_nxdomain": self.synthesized_nxdomain,
+                "synthesized_nodata": self.synthesized_nodata
+            }
+
+    def __zone_index__(self, zone: dns.name.Name) -> ZoneNsecIndex:
+        zone_index = self.__zones.get(zone)
+        if zone_index is None:
+            zone_index = ZoneNsecIndex(zone)
+            self.__zones[zone] = zone_index
+            while len(self.__zones) > self.max_zones:
+                self.__zones.popitem(last=False)
+        self.__zones.move_to_end(zone)
+        return zone_index
+
+    def __closest_zone_index__(self, name: dns.name.Name) -> Optional[ZoneNsecIndex]:
+        while True:
+            zone_index = self.__zones.get(name)
+            if zone_index is not None or len(name) <= 1:
+                return zone_index
+            name = name.parent()
+
+
+
+# Adds the ranges of an NSEC or NSEC3 RRset to the zone's index and returns the index, a new one when the
+# zone changed its NSEC3 parameters and so started a new chain. NSEC3 records of other hash algorithms are
+# skipped, names could not be hashed to look them up.
+def __add_range__(zone_index: ZoneNsecIndex, rrset: dns.rrset.RRset, expires_at: float) -> ZoneNsecIndex:
+    for rdata in rrset:
+        if rrset.rdtype == dns.rdatatype.NSEC:
+            zone_index.add(NsecRange(rrset.name, rdata.next, rdata.windows, False, expires_at))
+        elif rdata.algorithm == NSEC3_SHA1:
+            parameters = (rdata.salt, rdata.iterations, rdata.algorithm)
+            if zone_index.nsec3_parameters != parameters:
+                if zone_index.size() > 0:
+                    zone_index = ZoneNsecIndex(zone_index.zone)
+                zone_index.nsec3_parameters = parameters
+
+            owner_hash = base64.b32hexdecode(rrset.name[0].upper())
+            zone_index.add(NsecRange(owner_hash, rdata.next, rdata.windows,
+                                     rdata.flags & NSEC3_OPT_OUT != 0, expires_at))
+    return zone_index
+
+
+# NODATA from the NSEC of the name, NXDOMAIN from the NSEC covering the name together with the one covering
+# the wildcard at its closest encloser (RFC 4035 section 5.4)
+def __prove_with_nsec__(zone_index: ZoneNsecIndex, name: dns.name.Name, rdtype: dns.rdatatype.RdataType,
+                        now: float) -> Optional[Tuple[dns.rcode.Rcode, List[NsecRange]]]:
+    nsec_range, matches = zone_index.find(name, now)
+    if nsec_range is None:
+        return None
+
+    if matches:
+        if nsec_range.is_cut() or nsec_range.has_type(rdtype) or nsec_range.has_type(dns.rdatatype.CNAME):
+            return None
+        return dns.rcode.NOERROR, [nsec_range]
+
+    if name.is_subdomain(nsec_range.owner) and nsec_range.is_cut():
+        return None
+    # Names below the name exist, it is an empty non-terminal without records of any type
+    if nsec_range.next.is_subdomain(name):
+        return dns.rcode.NOERROR, [nsec_range]
+
+    # The closest encloser is the longest existing ancestor, the owner and next name both exist
+    common_labels = max(name.fullcompare(nsec_range.owner)[2], name.fullcompare(nsec_range.next)[2],
+                        len(zone_index.zone))
+    closest_encloser = name.split(common_labels)[1]
+    wildcard_range, wildcard_matches = zone_index.find(dns.name.Name((b"*",) + closest_encloser.labels), now)
+    if wildcard_range is None or wildcard_matches:
+        return None
+
+    return dns.rcode.NXDOMAIN, [nsec_range, wildcard_range]
+
+
+# NODATA from the NSEC3 matching the name's hash, NXDOMAIN from the closest encloser proof: an NSEC3 matching
+# the closest encloser, one covering the next closer name and one covering the wildcard (RFC 5155 section 8.4).
+# Opt-out ranges leave room for unsigned delegations, they only prove a name absent with `allow_opt_out`.
+def __prove_with_nsec3__(zone_index: ZoneNsecIndex, name: dns.name.Name, rdtype: dns.rdatatype.RdataType,
+                         now: float, allow_opt_out: bool = False) -> \
+      Optional[Tuple[dns.rcode.Rcode, List[NsecRange]]]:
+    nsec_range, matches = zone_index.find(zone_index.nsec3_hash(name), now)
+    if matches:
+        if nsec_range.is_cut() or nsec_range.has_type(rdtype) or nsec_range.has_type(dns.rdatatype.CNAME):
+            return None
+        return dns.rcode.NOERROR, [nsec_range]
+
+    next_closer = name
+    while next_closer != zone_index.zone:
+        closest_encloser = next_closer.parent()
+        encloser_range, encloser_matches = zone_index.find(zone_index.nsec3_hash(closest_encloser), now)
+        if encloser_matches:
+            if encloser_range.is_cut():
+                return None
+
+            next_closer_range, next_closer_matches = zone_index.find(zone_index.nsec3_hash(next_closer), now)
+            wildcard = dns.name.Name((b"*",) + closest_encloser.labels)
+            wildcard_range, wildcard_matches = zone_index.find(zone_index.nsec3_hash(wildcard), now)
+            if next_closer_range is None or next_closer_matches or \
+                    (next_closer_range.opt_out and not allow_opt_out) or \
+                    wildcard_range is None or wildcard_matches:
+                return None
+
+            return dns.rcode.NXDOMAIN, [encloser_range, next_closer_range, wildcard_range]
+
+        next_closer = closest_encloser
+
+    return None
+
+
+nsec_cache = AggressiveNsecCache()
+
+
+# What the NSEC or NSEC3 records of a negative response from `zone` prove for its question, as (rcode,
+# ranges used): NXDOMAIN, NOERROR for NODATA, or None when they prove neither. Only records signed by the zone
+# count, call after validate_signatures verified them. They are indexed on their own, records cached from
+# other responses take no part. An NSEC3 opt-out range is accepted for the next closer name, unsigned
+# delegations may exist below it then.
+def prove_denial(response_message: dns.message.Message,
+                 zone: dns.name.Name) -> Optional[Tuple[dns.rcode.Rcode, List[NsecRange]]]:
+    question = response_message.question[0]
+    signers = {(rrset.name, rrset.covers): {rrsig.signer for rrsig in rrset} for rrset in response_message.authority
+               if rrset.rdtype == dns.rdatatype.RRSIG}
+    zone_index = ZoneNsecIndex(zone)
+    for rrset in response_message.authority:
+        if rrset.rdtype in (dns.rdatatype.NSEC, dns.rdatatype.NSEC3) and rrset.name.is_subdomain(zone) and \
+                zone in signers.get((rrset.name, rrset.rdtype), ()):
+            zone_index = __add_range__(zone_index, rrset, float("inf"))
+
+    if zone_index.size() == 0 or not question.name.is_subdomain(zone):
+        return None
+    if zone_index.nsec3_parameters is None:
+        return __prove_with_nsec__(zone_index, question.name, question.rdtype, time.time())
+    return __prove_with_nsec3__(zone_index, question.name, question.rdtype, time.time(), allow_opt_out=True)
+
+
+# A negative response to the request message synthesized from cached NSEC or NSEC3 records, or None.
+# The answer goes to the negative cache like one received from the zone's servers.
+def synthesize_response_message(request_message: dns.message.Message) -> Optional[dns.message.Message]:
+    question = request_message.question[0]
+    negative = nsec_cache.synthesize(question.name, question.rdtype)
+    if negative is None:
+        return None
+
+    rcode, soa_rrset = negative
+    rrset_cache.put_negative(question.name, question.rdtype, question.rdclass, rcode, soa_rrset, secure=True)
+    response_message = dns.message.make_response(request_message)
+    response_message.set_rcode(rcode)
+    response_message.authority.append(soa_rrset)
+    return response_message
@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+from typing import Dict, List
+
+import dns.rdatatype
+
+from columnar import ColumnarWriter
+from models import Response, ResponseRecord
+
+# Formats of the result file, columnar results are binary, see columnar.py
+OUTPUT_FORMATS = ["text", "jsonl", "csv", "columnar"]
+CSV_HEADER = ["name", "type", "answer", "authority", "query_time", "when", "msg_size_rcvd", "dnssec_error"]
+
+
+# Common code for Part A and Part B
+# Result formats, apart from pipeline.py so a single query is written without the batch and asyncio machinery
+def format_response(response: Response, output_format: str) -> str:
+    if output_format == "jsonl":
+        record = {
+            "name": response.name,
+            "type": response.type,
+            "answer": __records_to_dicts__(response.answer_records),
+            "authority": __records_to_dicts__(response.authority_records),
+            "query_time": response.query_time,
+            "when": response.when,
+            "msg_size_rcvd": response.msg_size_rcvd,
+            "dnssec_error": response.dnssec_error
+        }
+        if response.trace is not None:
+            record["trace"] = response.trace.to_dicts()
+        return json.dumps(record, separators=(",", ":")) + "\n"
+
+    if output_format == "csv":
+        return __csv_line__([response.name, response.type, __records_to_text__(response.answer_records),
+                             __records_to_text__(response.authority_records), response.query_time, response.when,
+                             response.msg_size_rcvd, "" if response.dnssec_error is None else response.dnssec_error])
+
+    return str(response)
+
+
+# Writes the responses to a new output file, with the header row for CSV
+def write_responses(output_filename: str, responses: List[Response], output_format: str = "text"):
+    with open(output_filename, "wb") as output_file:
+        if output_format == "columnar":
+            columnar_writer = ColumnarWriter(output_file)
+            for response in responses:
+                columnar_writer.add(response)
+            columnar_writer.flush()
+            return
+
+        if output_format == "csv":
+            output_file.write(__csv_line__(CSV_HEADER).encode())
+        for response in responses:
+            output_file.write(format_response(response, output_format).encode())
+
+
+def __records_to_dicts__(records: List[ResponseRecord]) -> List[Dict[str, str]]:
+    return [{"type": dns.rdatatype.to_text(record.type), "value": record.value} for record in records]
+
+
+def __records_to_text__(records: List[ResponseRecord]) -> str:
+    return ";".join(dns.rdatatype.to_text(record.type) + " " + record.value for record in records)
+
+
+def __csv_line__(fields: list) -> str:
+    line = io.StringIO()
+    csv.writer(line, lineterminator="\n").writerow(fields)
+    return line.getvalue()
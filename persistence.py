@@ -0,0 +1,184 @@
+import atexit
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+# Writes are committed in batches instead of one transaction per cached record
+PERSIST_BATCH_SIZE = 500
+PERSIST_FLUSH_INTERVAL = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rrsets (
+    name TEXT NOT NULL,
+    rdtype INTEGER NOT NULL,
+    rdclass INTEGER NOT NULL,
+    secure INTEGER NOT NULL,
+    expires_at REAL NOT NULL,
+    rdatas TEXT NOT NULL,
+    PRIMARY KEY (name, rdtype, rdclass)
+);
+CREATE TABLE IF NOT EXISTS zone_cuts (
+    zone TEXT PRIMARY KEY,
+    ns_names TEXT NOT NULL,
+    ns_ips TEXT NOT NULL,
+    secure INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trusted_zones (
+    zone TEXT PRIMARY KEY,
+    dnskey_rdatas TEXT NOT NULL,
+    ds_rdatas TEXT NOT NULL,
+    ds_ttl INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+# Common code for Part A and Part B
+# Warm cache kept in an SQLite file, so a restarted process picks up delegations, RRsets and validated keys
+# with one indexed point lookup per miss instead of deserializing the whole file at startup.
+# Names are stored lower cased, expiry times are absolute.
+class PersistentStore:
+    file_name: str
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.__connection = None
+        self.__pending_writes = 0
+        self.__last_flush = time.time()
+        self.__lock = threading.Lock()
+
+    def load_rrset(self, name: dns.name.Name, rdtype: dns.rdatatype.RdataType,
+                   rdclass: dns.rdataclass.RdataClass) -> Optional[Tuple[dns.rrset.RRset, float, bool]]:
+        row = self.__fetch_one__(
+            "SELECT secure, expires_at, rdatas FROM rrsets WHERE name = ? AND rdtype = ? AND rdclass = ?",
+            (__key__(name), int(rdtype), int(rdclass))
+        )
+        if row is None:
+            return None
+
+        secure, expires_at, rdatas = row
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return None
+
+        rrset = dns.rrset.from_text_list(name, ttl, rdclass, rdtype, rdatas.split("\n"))
+        return rrset, expires_at, bool(secure)
+
+    def save_rrset(self, rrset: dns.rrset.RRset, expires_at: float, secure: bool):
+        self.__write__(
+            "INSERT OR REPLACE INTO rrsets VALUES (?, ?, ?, ?, ?, ?)",
+            (__key__(rrset.name), int(rrset.rdtype), int(rrset.rdclass), int(secure), expires_at,
+             "\n".join(item.to_text() for item in rrset.items))
+        )
+
+    # Live cuts for any of the zones, as (zone, ns names, ns ips, expires at, secure)
+    def load_zone_cuts(self, zones: List[dns.name.Name]) -> List[Tuple[dns.name.Name, List[str], List[str], float, bool]]:
+        if len(zones) == 0:
+            return []
+
+        rows = self.__fetch_all__(
+            "SELECT zone, ns_names, ns_ips, expires_at, secure FROM zone_cuts WHERE expires_at > ? AND zone IN (" +
+            ", ".join("?" for _ in zones) + ")",
+            (time.time(), *[__key__(zone) for zone in zones])
+        )
+        return [(dns.name.from_text(zone), ns_names.split(" "), ns_ips.split(" "), expires_at, bool(secure))
+                for zone, ns_names, ns_ips, expires_at, secure in rows]
+
+    def save_zone_cut(self, zone: dns.name.Name, ns_names: List[str], ns_ips: List[str], expires_at: float,
+                      secure: bool):
+        self.__write__(
+            "INSERT OR REPLACE INTO zone_cuts VALUES (?, ?, ?, ?, ?)",
+            (__key__(zone), " ".join(ns_names), " ".join(ns_ips), int(secure), expires_at)
+        )
+
+    # Live validated zone as (DNSKEY RRset, DS RRset it matched, expires at)
+    def load_trusted_zone(self, zone: dns.name.Name) -> Optional[Tuple[dns.rrset.RRset, dns.rrset.RRset, float]]:
+        row = self.__fetch_one__(
+            "SELECT dnskey_rdatas, ds_rdatas, ds_ttl, expires_at FROM trusted_zones WHERE zone = ?",
+            (__key__(zone),)
+        )
+        if row is None:
+            return None
+
+        dnskey_rdatas, ds_rdatas, ds_ttl, expires_at = row
+        ttl = int(expires_at - time.time())
+        if ttl <= 0:
+            return None
+
+        dnskey_rrset = dns.rrset.from_text_list(zone, ttl, dns.rdataclass.IN, dns.rdatatype.DNSKEY,
+                                                dnskey_rdatas.split("\n"))
+        ds_rrset = dns.rrset.from_text_list(zone, ds_ttl, dns.rdataclass.IN, dns.rdatatype.DS, ds_rdatas.split("\n"))
+        return dnskey_rrset, ds_rrset, expires_at
+
+    def save_trusted_zone(self, zone: dns.name.Name, dnskey_rrset: dns.rrset.RRset, ds_rrset: dns.rrset.RRset,
+                          expires_at: float):
+        self.__write__(
+            "INSERT OR REPLACE INTO trusted_zones VALUES (?, ?, ?, ?, ?)",
+            (__key__(zone), "\n".join(item.to_text() for item in dnskey_rrset.items),
+             "\n".join(item.to_text() for item in ds_rrset.items), ds_rrset.ttl, expires_at)
+        )
+
+    def flush(self):
+        with self.__lock:
+            if self.__connection is not None and self.__pending_writes > 0:
+                self.__connection.commit()
+            self.__pending_writes = 0
+            self.__last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    # The file is opened on first use, expired rows are dropped at that point
+    def __connect__(self):
+        if self.__connection is None:
+            import sqlite3
+            self.__connection = sqlite3.connect(self.file_name, check_same_thread=False)
+            self.__connection.executescript(SCHEMA)
+            now = time.time()
+            for table in ("rrsets", "zone_cuts", "trusted_zones"):
+                self.__connection.execute("DELETE FROM " + table + " WHERE expires_at <= ?", (now,))
+            self.__connection.commit()
+        return self.__connection
+
+    def __fetch_one__(self, query: str, parameters: tuple) -> Optional[tuple]:
+        with self.__lock:
+            return self.__connect__().execute(query, parameters).fetchone()
+
+    def __fetch_all__(self, query: str, parameters: tuple) -> List[tuple]:
+        with self.__lock:
+            return self.__connect__().execute(query, parameters).fetchall()
+
+    def __write__(self, query: str, parameters: tuple):
+        with self.__lock:
+            connection = self.__connect__()
+            connection.execute(query, parameters)
+            self.__pending_writes += 1
+            if self.__pending_writes >= PERSIST_BATCH_SIZE or time.time() - self.__last_flush >= PERSIST_FLUSH_INTERVAL:
+                connection.commit()
+                self.__pending_writes = 0
+                self.__last_flush = time.time()
+
+
+def __key__(name: dns.name.Name) -> str:
+    return name.to_text().lower()
+
+
+persistent_store: Optional[PersistentStore] = None
+
+
+# Enables the warm cache for this process, nothing is read until the first cache miss
+def open_persistent_store(file_name: str) -> PersistentStore:
+    global persistent_store
+    persistent_store = PersistentStore(file_name)
+    atexit.register(persistent_store.close)
+    return persistent_store
@@ -0,0 +1,111 @@
+import itertools
+import json
+import os
+from typing import Awaitable, Callable
+
+import batch
+import output
+from columnar import ColumnarWriter
+from models import Request, Response
+
+# The checkpoint is written after this many results and when the run ends or is interrupted. Columnar
+# results are written in blocks of CHECKPOINT_INTERVAL rows.
+CHECKPOINT_INTERVAL = 100
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+# Common code for Part A and Part B
+# How far an interrupted run got: the number of requests whose results are in the output file and the
+# size of the output file at that point, anything written after it is cut off on resume
+class Checkpoint:
+    file_name: str
+    completed: int
+    output_offset: int
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.completed = 0
+        self.output_offset = 0
+
+    # Progress of an earlier run over the same input in the same format, if there is one
+    def load(self, input_filename: str, output_format: str) -> bool:
+        try:
+            with open(self.file_name, "r") as checkpoint_file:
+                state = json.load(checkpoint_file)
+        except (OSError, ValueError):
+            return False
+
+        if state.get("input") != input_filename or state.get("format") != output_format:
+            print("Checkpoint " + self.file_name + " is for another input or format, starting over")
+            return False
+
+        self.completed = state["completed"]
+        self.output_offset = state["output_offset"]
+        return True
+
+    # Replaced in one step, a crash while saving leaves the previous checkpoint
+    def save(self, input_filename: str, output_format: str):
+        temporary_file_name = self.file_name + ".tmp"
+        with open(temporary_file_name, "w") as checkpoint_file:
+            json.dump({"input": input_filename, "format": output_format, "completed": self.completed,
+                       "output_offset": self.output_offset}, checkpoint_file)
+        os.replace(temporary_file_name, self.file_name)
+
+
+# Resolves the queries of the input file without loading it, writing every result to the output file as
+# soon as it and the results before it are done. With `resume` a run interrupted earlier continues after
+# the last checkpointed result. With more than one worker the queries are sharded by zone across that many
+# processes, see sharding.py.
+def run_pipeline(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        input_filename: str,
+        output_filename: str,
+        output_format: str = "text",
+        concurrency: int = batch.BATCH_CONCURRENCY,
+        resume: bool = False,
+        workers: int = 1
+):
+    checkpoint = Checkpoint(output_filename + CHECKPOINT_SUFFIX)
+    resumed = resume and os.path.exists(output_filename) and checkpoint.load(input_filename, output_format)
+
+    if resumed:
+        print("Resuming after " + str(checkpoint.completed) + " queries")
+        output_file = open(output_filename, "r+b")
+        output_file.truncate(checkpoint.output_offset)
+        output_file.seek(checkpoint.output_offset)
+    else:
+        output_file = open(output_filename, "wb")
+        if output_format == "csv":
+            output_file.write(output.__csv_line__(output.CSV_HEADER).encode())
+        checkpoint.output_offset = output_file.tell()
+
+    columnar_writer = ColumnarWriter(output_file, CHECKPOINT_INTERVAL) if output_format == "columnar" else None
+
+    def write_response(response: Response):
+        if columnar_writer is not None:
+            columnar_writer.add(response)
+        else:
+            output_file.write(output.format_response(response, output_format).encode())
+        checkpoint.completed += 1
+        if checkpoint.completed % CHECKPOINT_INTERVAL == 0:
+            __save_checkpoint__(checkpoint, output_file, input_filename, output_format)
+
+    requests = itertools.islice(batch.iter_requests(input_filename), checkpoint.completed, None)
+    try:
+        if workers > 1:
+            import sharding
+            sharding.resolve_sharded(resolve_dns_async, requests, write_response, workers, concurrency)
+        else:
+            batch.resolve_stream(resolve_dns_async, requests, write_response, concurrency)
+    finally:
+        if columnar_writer is not None:
+            columnar_writer.flush()
+        __save_checkpoint__(checkpoint, output_file, input_filename, output_format)
+        output_file.close()
+
+
+def __save_checkpoint__(checkpoint: Checkpoint, output_file, input_filename: str, output_format: str):
+    output_file.flush()
+    os.fsync(output_file.fileno())
+    checkpoint.output_offset = output_file.tell()
+    checkpoint.save(input_filename, output_format)
@@ -0,0 +1,89 @@
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict
+
+import dns.name
+import dns.rdatatype
+
+from models import Request, Response
+
+# A cached RRset asked for at least PREFETCH_MIN_HITS times is refreshed in the background once this
+# fraction of its TTL has passed, so popular names never wait on a full resolution when they expire
+PREFETCH_TTL_FRACTION = 0.9
+PREFETCH_MIN_HITS = 2
+PREFETCH_WORKERS = 4
+
+# Set while a prefetch runs, the resolution then skips the cached answers it is meant to replace
+refreshing = contextvars.ContextVar("refreshing", default=False)
+
+
+# Common code for Part A and Part B
+class Prefetcher:
+    ttl_fraction: float
+    min_hits: int
+    scheduled: int
+    completed: int
+
+    def __init__(self, resolve_dns: Callable[[Request], Response], ttl_fraction: float = PREFETCH_TTL_FRACTION,
+                 min_hits: int = PREFETCH_MIN_HITS, workers: int = PREFETCH_WORKERS):
+        self.ttl_fraction = ttl_fraction
+        self.min_hits = min_hits
+        self.scheduled = 0
+        self.completed = 0
+        self.__resolve_dns = resolve_dns
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__pending = set()
+        self.__lock = threading.Lock()
+
+    # Called by the cache on every hit, schedules a refresh of the question when the entry is hot and
+    # near the end of its TTL. Only one refresh per question is queued at a time.
+    def consider(self, name: dns.name.Name, rdtype: dns.rdatatype.RdataType, hits: int, ttl: int,
+                 remaining_ttl: float):
+        if hits < self.min_hits or ttl <= 0 or remaining_ttl > ttl * (1 - self.ttl_fraction):
+            return
+
+        request = Request(name=name.to_text(), type=dns.rdatatype.to_text(rdtype))
+        if not request.is_valid_request():
+            return
+
+        key = (name, rdtype)
+        with self.__lock:
+            if key in self.__pending:
+                return
+            self.__pending.add(key)
+            self.scheduled += 1
+
+        self.__executor.submit(self.__refresh__, key, request)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "pending": len(self.__pending),
+                "scheduled": self.scheduled,
+                "completed": self.completed
+            }
+
+    def __refresh__(self, key: tuple, request: Request):
+        # The executor's threads are reused, the flag must not outlive this refresh
+        token = refreshing.set(True)
+        try:
+            self.__resolve_dns(request)
+        except Exception as e:
+            print("Error when prefetching " + request.name + " error message " + str(e))
+        finally:
+            refreshing.reset(token)
+            with self.__lock:
+                self.__pending.discard(key)
+                self.completed += 1
+
+
+prefetcher = None
+
+
+# Enables prefetching for this process, refreshing entries with the given resolver
+def enable_prefetch(resolve_dns: Callable[[Request], Response], ttl_fraction: float = PREFETCH_TTL_FRACTION) -> \
+      Prefetcher:
+    global prefetcher
+    prefetcher = Prefetcher(resolve_dns, ttl_fraction)
+    return prefetcher
@@ -0,0 +1,183 @@
+import socket
+import struct
+from typing import Dict, List, Optional, Tuple
+
+import dns.exception
+import dns.flags
+import dns.name
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rdtypes.ANY.NS
+import dns.rdtypes.IN.A
+import dns.rdtypes.IN.AAAA
+import dns.rrset
+from dns.message import Message
+
+HEADER = struct.Struct("!6H")
+RR_HEADER = struct.Struct("!HHIH")
+QUESTION_FIELDS = struct.Struct("!HH")
+# Compression pointers followed while reading one name, more than this means a pointer loop
+MAX_POINTERS = 64
+# Decoded names and records, the same name servers and glue show up in referral after referral. Names and
+# rdata are immutable, so they are shared. Emptied when full.
+DECODE_CACHE_MAX_SIZE = 10000
+
+names: Dict[tuple, dns.name.Name] = dict()
+rdatas: Dict[tuple, object] = dict()
+
+
+# Common code for Part A and Part B
+# A referral decoded straight from the wire: no answers, the NS RRset of the delegated zone in authority
+# and its glue in additional. Has the parts of dns.message.Message the walk, the caches and the zone cut
+# index use. Like shared messages it must not be modified.
+class ReferralMessage:
+    id: int
+    flags: int
+    question: list
+    answer: List[dns.rrset.RRset]
+    authority: List[dns.rrset.RRset]
+    additional: List[dns.rrset.RRset]
+    wire_size: int
+
+    def __init__(self, id: int, flags: int, question: list, authority: List[dns.rrset.RRset],
+                 additional: List[dns.rrset.RRset], wire_size: int):
+        self.id = id
+        self.flags = flags
+        self.question = question
+        self.answer = []
+        self.authority = authority
+        self.additional = additional
+        self.wire_size = wire_size
+
+    def rcode(self) -> int:
+        return dns.rcode.NOERROR
+
+
+class NotAReferral(Exception):
+    pass
+
+
+# The response as a ReferralMessage when it is a plain referral answering the request, None for anything
+# else (answers, negative answers, truncated or DNSSEC responses, malformed messages), which is left to
+# dnspython's full parser
+def parse_referral(request_message: Message, response_wire: bytes) -> Optional[ReferralMessage]:
+    try:
+        return __parse_referral__(request_message, memoryview(response_wire))
+    except (NotAReferral, struct.error, IndexError, ValueError, dns.exception.DNSException):
+        return None
+
+
+def __parse_referral__(request_message: Message, wire: memoryview) -> ReferralMessage:
+    message_id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(wire, 0)
+    if message_id != request_message.id or not flags & dns.flags.QR or flags & dns.flags.TC \
+            or dns.opcode.from_flags(flags) != request_message.opcode() or flags & 0x000f != dns.rcode.NOERROR \
+            or qdcount != 1 or ancount != 0 or nscount == 0:
+        raise NotAReferral()
+
+    question = request_message.question[0]
+    qname, offset = __read_name__(wire, HEADER.size)
+    qtype, qclass = QUESTION_FIELDS.unpack_from(wire, offset)
+    offset += QUESTION_FIELDS.size
+    if qname != question.name or qtype != question.rdtype or qclass != question.rdclass:
+        raise NotAReferral()
+
+    ns_rrset = None
+    for _ in range(nscount):
+        name, rdtype, rdclass, ttl, rdata_offset, offset = __read_rr_header__(wire, offset)
+        if rdtype != dns.rdatatype.NS or (ns_rrset is not None and name != ns_rrset.name):
+            raise NotAReferral()
+        if ns_rrset is None:
+            ns_rrset = dns.rrset.RRset(name, rdclass, rdtype)
+        target, target_end = __read_name__(wire, rdata_offset)
+        if target_end != offset:
+            raise NotAReferral()
+        rdata = rdatas.get((rdclass, rdtype, target))
+        if rdata is None:
+            rdata = __remember__(rdatas, (rdclass, rdtype, target), dns.rdtypes.ANY.NS.NS(rdclass, rdtype, target))
+        ns_rrset.add(rdata, ttl)
+
+    # Glue grouped into RRsets in the order the records came
+    glue: Dict[Tuple[dns.name.Name, int], dns.rrset.RRset] = dict()
+    for _ in range(arcount):
+        name, rdtype, rdclass, ttl, rdata_offset, offset = __read_rr_header__(wire, offset)
+        if rdtype == dns.rdatatype.OPT:
+            # Extended RCODE in the upper bits of the TTL
+            if ttl >> 24 != 0:
+                raise NotAReferral()
+            continue
+
+        if rdtype == dns.rdatatype.A and offset - rdata_offset == 4:
+            address = wire[rdata_offset:offset].tobytes()
+            rdata = rdatas.get((rdclass, rdtype, address))
+            if rdata is None:
+                rdata = __remember__(rdatas, (rdclass, rdtype, address), dns.rdtypes.IN.A.A(
+                    rdclass, rdtype, socket.inet_ntop(socket.AF_INET, address)))
+        elif rdtype == dns.rdatatype.AAAA and offset - rdata_offset == 16:
+            address = wire[rdata_offset:offset].tobytes()
+            rdata = rdatas.get((rdclass, rdtype, address))
+            if rdata is None:
+                rdata = __remember__(rdatas, (rdclass, rdtype, address), dns.rdtypes.IN.AAAA.AAAA(
+                    rdclass, rdtype, socket.inet_ntop(socket.AF_INET6, address)))
+        else:
+            raise NotAReferral()
+
+        rrset = glue.get((name, rdtype))
+        if rrset is None:
+            rrset = dns.rrset.RRset(name, rdclass, rdtype)
+            glue[(name, rdtype)] = rrset
+        rrset.add(rdata, ttl)
+
+    if offset != len(wire):
+        raise NotAReferral()
+
+    return ReferralMessage(message_id, flags, request_message.question, [ns_rrset], list(glue.values()), len(wire))
+
+
+# Owner name, type, class, TTL, start of the RDATA and end of the record
+def __read_rr_header__(wire: memoryview, offset: int) -> Tuple[dns.name.Name, int, int, int, int, int]:
+    name, offset = __read_name__(wire, offset)
+    rdtype, rdclass, ttl, rdlength = RR_HEADER.unpack_from(wire, offset)
+    rdata_offset = offset + RR_HEADER.size
+    end = rdata_offset + rdlength
+    if end > len(wire):
+        raise NotAReferral()
+    return name, rdtype, rdclass, ttl, rdata_offset, end
+
+
+# A possibly compressed name (RFC 1035 section 4.1.4) and the offset right after it where it started
+def __read_name__(wire: memoryview, offset: int) -> Tuple[dns.name.Name, int]:
+    labels = []
+    end = None
+    pointers = 0
+    while True:
+        length = wire[offset]
+        if length == 0:
+            labels.append(b"")
+            labels = tuple(labels)
+            name = names.get(labels)
+            if name is None:
+                name = __remember__(names, labels, dns.name.Name(labels))
+            return name, offset + 1 if end is None else end
+        if length & 0xc0 == 0xc0:
+            pointers += 1
+            if pointers > MAX_POINTERS:
+                raise NotAReferral()
+            if end is None:
+                end = offset + 2
+            offset = (length & 0x3f) << 8 | wire[offset + 1]
+        elif length & 0xc0 == 0:
+            if offset + 1 + length > len(wire):
+                raise NotAReferral()
+            labels.append(wire[offset + 1:offset + 1 + length].tobytes())
+            offset += 1 + length
+        else:
+            raise NotAReferral()
+
+
+def __remember__(decoded: dict, key: tuple, value):
+    if len(decoded) >= DECODE_CACHE_MAX_SIZE:
+        decoded.clear()
+    decoded[key] = value
+    return value
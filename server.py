@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+import capture
+import metrics
+import mydig
+import mydig_dnssec
+import persistence
+import prefetch
+import transport
+from cache import rrset_cache
+from models import Request
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 5353
+# Resolutions running at once, the iterative walks run on these threads
+SERVER_WORKERS = 64
+# Clients without EDNS can only take classic 512 byte UDP responses
+DEFAULT_UDP_PAYLOAD = 512
+
+
+# Recursive resolver daemon, keeps the caches warm across requests and answers in wire format
+class ResolverServer:
+    dnssec: bool
+
+    def __init__(self, dnssec: bool = False):
+        self.dnssec = dnssec
+
+    # Wire format response to a wire format query, None when the query cannot be parsed
+    async def handle_query(self, wire: bytes, over_udp: bool) -> Optional[bytes]:
+        try:
+            query = dns.message.from_wire(wire)
+        except dns.exception.DNSException:
+            return None
+
+        response = await self.__resolve_query__(query)
+
+        if not over_udp:
+            return response.to_wire()
+
+        payload = max(DEFAULT_UDP_PAYLOAD, query.payload if query.edns >= 0 else DEFAULT_UDP_PAYLOAD)
+        try:
+            return response.to_wire(max_size=payload)
+        except dns.exception.TooBig:
+            # Let the client retry over TCP
+            truncated = dns.message.make_response(query)
+            truncated.flags |= dns.flags.TC
+            return truncated.to_wire()
+
+    async def __resolve_query__(self, query: dns.message.Message) -> dns.message.Message:
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.RA
+
+        if len(query.question) != 1:
+            response.set_rcode(dns.rcode.FORMERR)
+            return response
+
+        question = query.question[0]
+        rdtype_name = dns.rdatatype.to_text(question.rdtype)
+        request = Request(name=question.name.to_text(), type=rdtype_name)
+        if not request.is_valid_request():
+            response.set_rcode(dns.rcode.NOTIMP)
+            return response
+
+        resolver = mydig_dnssec if self.dnssec else mydig
+        answer_rrsets, authority_rrsets, rcode = await asyncio.get_running_loop().run_in_executor(
+            None, resolver.resolve_rrsets, request)
+
+        # No answer and no SOA seen either: the resolution failed
+        if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN) or \
+                len(answer_rrsets) == 0 and len(authority_rrsets) == 0:
+            response.set_rcode(dns.rcode.SERVFAIL)
+            return response
+
+        # The answer is built from the RRsets the walk ended with, whether they came from servers, from the
+        # cache or, with serve stale, from an expired cache entry. A negative answer carries its SOA record.
+        response.answer += [rrset for rrset in answer_rrsets if rrset.rdtype != dns.rdatatype.RRSIG]
+        if len(response.answer) == 0 or response.answer[-1].rdtype == dns.rdatatype.CNAME:
+            response.authority += [__negative_soa_rrset__(rrset) for rrset in authority_rrsets
+                                   if rrset.rdtype == dns.rdatatype.SOA]
+        response.set_rcode(rcode)
+        if self.dnssec:
+            response.flags |= dns.flags.AD
+        return response
+
+
+# The SOA record of a negative answer lives for its TTL or its minimum, whichever is lower (RFC 2308)
+def __negative_soa_rrset__(soa_rrset: dns.rrset.RRset) -> dns.rrset.RRset:
+    negative_soa_rrset = soa_rrset.copy()
+    negative_soa_rrset.ttl = min(soa_rrset.ttl, soa_rrset[0].minimum)
+    return negative_soa_rrset
+
+
+class UDPServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: ResolverServer):
+        self.server = server
+        self.transport = None
+        # The loop only keeps weak references to tasks, answers in flight are held here until done
+        self.pending = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        task = asyncio.ensure_future(self.__answer__(data, addr))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def __answer__(self, data: bytes, addr):
+        response_wire = await self.server.handle_query(data, over_udp=True)
+        if response_wire is not None:
+            self.transport.sendto(response_wire, addr)
+
+
+# TCP clients may pipeline several length prefixed queries on one connection, each is answered when ready
+async def __serve_tcp_client__(server: ResolverServer, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    pending = set()
+
+    async def answer(data: bytes):
+        response_wire = await server.handle_query(data, over_udp=False)
+        if response_wire is not None:
+            writer.write(struct.pack("!H", len(response_wire)) + response_wire)
+            await writer.drain()
+
+    try:
+        while True:
+            length = struct.unpack("!H", await reader.readexactly(2))[0]
+            task = asyncio.ensure_future(answer(await reader.readexactly(length)))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        if len(pending) > 0:
+            await asyncio.gather(*pending, return_exceptions=True)
+        writer.close()
+
+
+async def serve(host: str = SERVER_HOST, port: int = SERVER_PORT, dnssec: bool = False,
+                workers: int = SERVER_WORKERS):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=workers))
+    server = ResolverServer(dnssec)
+
+    udp_transport, _ = await loop.create_datagram_endpoint(lambda: UDPServerProtocol(server), local_addr=(host, port))
+    tcp_server = await asyncio.start_server(
+        lambda reader, writer: __serve_tcp_client__(server, reader, writer), host, port)
+
+    print("Serving DNS on " + host + " port " + str(port) + (" with DNSSEC validation" if dnssec else ""))
+    try:
+        async with tcp_server:
+            await tcp_server.serve_forever()
+    finally:
+        udp_transport.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--dnssec", action="store_true", help="validate answers like main_dnssec.py")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="number of resolutions running at once")
+    parser.add_argument("--cache-file",
+                        help="keep a warm cache of delegations, records and DNSSEC keys in this file across runs")
+    parser.add_argument("--prefetch", type=float, metavar="TTL_FRACTION",
+                        help="refresh popular records in the background once this fraction of their TTL has passed")
+    parser.add_argument("--serve-stale", type=int, metavar="SECONDS",
+                        help="answer with records expired up to this long ago when their servers cannot be reached")
+    parser.add_argument("--edns-payload-size", type=int,
+                        help="UDP payload size advertised to name servers, larger responses are fetched over TCP")
+    parser.add_argument("--capture", metavar="FILE", help="record every upstream query and response to this file")
+    parser.add_argument("--replay", nargs="+", metavar="FILE",
+                        help="answer upstream queries from these capture files instead of the network")
+    parser.add_argument("--replay-speed", type=float, default=0.0,
+                        help="1 takes as long as the capture did, 2 twice as fast, 0 does not wait")
+    parser.add_argument("--metrics-file", help="write cache, latency and server RTT metrics to this file at exit")
+    parser.add_argument("--metrics-format", choices=metrics.METRICS_FORMATS, default="json")
+    args = parser.parse_args()
+
+    if args.cache_file is not None:
+        persistence.open_persistent_store(args.cache_file)
+    if args.capture is not None:
+        capture.start_capture(args.capture)
+    if args.replay is not None:
+        capture.start_replay(args.replay, args.replay_speed)
+    if args.edns_payload_size is not None:
+        transport.EDNS_PAYLOAD_SIZE = args.edns_payload_size
+    if args.prefetch is not None:
+        prefetch.enable_prefetch(mydig_dnssec.resolve_dns if args.dnssec else mydig.resolve_dns, args.prefetch)
+    if args.serve_stale is not None:
+        rrset_cache.stale_max_age = args.serve_stale
+    if args.dnssec:
+        import dnssec_validation
+        dnssec_validation.__init__()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.dnssec, args.workers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.metrics_file is not None:
+            metrics.write_metrics(args.metrics_file, args.metrics_format)
@@ -0,0 +1,172 @@
+import os
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import batch
+import capture
+import persistence
+import signatures
+import tracing
+import transport
+from models import Request, Response
+
+# Requests sent to a worker at a time, and chunks outstanding per worker
+SHARD_CHUNK_SIZE = 64
+SHARD_CHUNKS_IN_FLIGHT = 2
+# Responses waiting for an earlier one before they can be handed on, per worker
+SHARD_WINDOW_CHUNKS = 8
+# Second level labels under which registrations are made, e.g. example.co.uk, as there is no public
+# suffix list to go by
+PUBLIC_SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "gov", "ltd", "me", "net", "nic", "or", "org", "plc", "sch"}
+
+
+# Common code for Part A and Part B
+# The zone a name was registered in, its last two labels or three below a public second level label
+def registrable_zone(name: str) -> str:
+    labels = name.lower().rstrip(".").split(".")
+    if len(labels) >= 3 and len(labels[-1]) == 2 and labels[-2] in PUBLIC_SECOND_LEVEL_LABELS:
+        return ".".join(labels[-3:])
+    return ".".join(labels[-2:])
+
+
+# The same zone always goes to the same worker, also across runs
+def shard_of(request: Request, workers: int) -> int:
+    return zlib.crc32(registrable_zone(request.name).encode()) % workers
+
+
+class WorkerStats:
+    queries: int
+    busy_time: float
+
+    def __init__(self):
+        self.queries = 0
+        self.busy_time = 0.0
+
+    def throughput(self) -> float:
+        return self.queries / self.busy_time if self.busy_time > 0 else 0.0
+
+
+# Resolver settings of this process that workers need as well, also when they do not start by forking it
+class WorkerSettings:
+    edns_payload_size: int
+    tracing: bool
+    cache_file: Optional[str]
+    capture_file: Optional[str]
+    replay_files: Optional[List[str]]
+    replay_speed: float
+
+    def __init__(self):
+        self.edns_payload_size = transport.EDNS_PAYLOAD_SIZE
+        self.tracing = tracing.enabled
+        self.cache_file = persistence.persistent_store.file_name if persistence.persistent_store is not None else None
+        self.capture_file = capture.recorder.file_name if capture.recorder is not None else None
+        self.replay_files = capture.replayer.file_names if capture.replayer is not None else None
+        self.replay_speed = capture.replayer.speed if capture.replayer is not None else 0.0
+
+
+# Resolves the requests on `workers` processes, one per shard, so every worker keeps the delegations, records
+# and DNSSEC keys of its zones in its own caches. Like batch.resolve_stream the requests are taken lazily and
+# every response is handed to `on_response` in request order. Returns the statistics of every worker.
+def resolve_sharded(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        requests: Iterable[Request],
+        on_response: Callable[[Response], None],
+        workers: int = os.cpu_count() or 1,
+        concurrency: int = batch.BATCH_CONCURRENCY
+) -> List[WorkerStats]:
+    workers = max(1, workers)
+    settings = WorkerSettings()
+    # One single process executor per shard, a pool would hand chunks to whichever process is free
+    executors = [ProcessPoolExecutor(max_workers=1, initializer=__init_worker__,
+                                     initargs=(settings, shard)) for shard in range(workers)]
+    worker_stats = [WorkerStats() for _ in range(workers)]
+    chunks: List[List[Tuple[int, Request]]] = [[] for _ in range(workers)]
+    in_flight: Dict[Future, int] = {}
+    done_responses: Dict[int, Response] = {}
+    window = workers * SHARD_CHUNK_SIZE * SHARD_WINDOW_CHUNKS
+    next_to_write = 0
+
+    def submit(shard: int):
+        in_flight[executors[shard].submit(__resolve_chunk__, resolve_dns_async, chunks[shard], concurrency)] = shard
+        chunks[shard] = []
+
+    def collect():
+        nonlocal next_to_write
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            shard = in_flight.pop(future)
+            indexed_responses, busy_time = future.result()
+            worker_stats[shard].queries += len(indexed_responses)
+            worker_stats[shard].busy_time += busy_time
+            done_responses.update(indexed_responses)
+
+        while next_to_write in done_responses:
+            on_response(done_responses.pop(next_to_write))
+            next_to_write += 1
+
+    try:
+        index = -1
+        for index, request in enumerate(requests):
+            shard = shard_of(request, workers)
+            chunks[shard].append((index, request))
+            if len(chunks[shard]) >= SHARD_CHUNK_SIZE:
+                while len(in_flight) >= workers * SHARD_CHUNKS_IN_FLIGHT:
+                    collect()
+                submit(shard)
+
+            # The oldest request still waiting may sit in a partial chunk, send those before waiting on it
+            while index + 1 - next_to_write >= window:
+                for partial_shard in range(workers):
+                    if len(chunks[partial_shard]) > 0:
+                        submit(partial_shard)
+                collect()
+
+        for shard in range(workers):
+            if len(chunks[shard]) > 0:
+                submit(shard)
+        while next_to_write <= index:
+            collect()
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    for shard, stats in enumerate(worker_stats):
+        print("Worker " + str(shard) + ": " + str(stats.queries) + " queries, "
+              + str(round(stats.throughput(), 1)) + " queries/s")
+    return worker_stats
+
+
+def __init_worker__(settings: WorkerSettings, shard: int):
+    # Pools of the parent process are not usable from a forked worker
+    signatures.signature_pool = None
+    transport.EDNS_PAYLOAD_SIZE = settings.edns_payload_size
+    if settings.tracing:
+        tracing.enable_tracing()
+    # A store inherited from the parent would share its SQLite connection, every worker opens its own
+    persistence.persistent_store = None
+    if settings.cache_file is not None:
+        persistence.open_persistent_store(settings.cache_file)
+    # Every worker captures to a file of its own, replay them all together
+    capture.recorder = None
+    if settings.capture_file is not None:
+        capture.start_capture(settings.capture_file + "." + str(shard))
+    if settings.replay_files is not None:
+        capture.start_replay(settings.replay_files, settings.replay_speed)
+
+
+def __resolve_chunk__(
+        resolve_dns_async: Callable[[Request], Awaitable[Response]],
+        indexed_requests: List[Tuple[int, Request]],
+        concurrency: int
+) -> Tuple[List[Tuple[int, Response]], float]:
+    start_time = time.perf_counter()
+    responses = batch.resolve_batch(resolve_dns_async, [request for _, request in indexed_requests], concurrency)
+    # Worker processes end without running atexit handlers
+    if persistence.persistent_store is not None:
+        persistence.persistent_store.flush()
+    if capture.recorder is not None:
+        capture.recorder.flush()
+    return [(index, response) for (index, _), response in zip(indexed_requests, responses)], \
+        time.perf_counter() - start_time
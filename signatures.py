@@ -0,0 +1,130 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import dns.name
+import dns.rrset
+
+# Verdicts of (RRset, RRSIG RRset, signer keys) checks that were already done, so repeat answers cost a hash
+SIGNATURE_MEMO_MAX_SIZE = 100000
+
+signature_pool = None
+
+
+# Code for part B
+# RSA/ECDSA verification holds the GIL, with a pool the signatures of a response, and of all responses
+# being validated at the same time, are checked on worker processes instead of one core
+def enable_signature_pool(workers: Optional[int] = None):
+    global signature_pool
+    if signature_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        signature_pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+    return signature_pool
+
+
+class SignatureMemo:
+    max_size: int
+    hits: int
+    misses: int
+
+    def __init__(self, max_size: int = SIGNATURE_MEMO_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.__verdicts = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key: tuple) -> Optional[bool]:
+        with self.__lock:
+            verdict = self.__verdicts.get(key)
+            if verdict is None:
+                self.misses += 1
+                return None
+
+            self.__verdicts.move_to_end(key)
+            self.hits += 1
+            return verdict
+
+    def put(self, key: tuple, verdict: bool):
+        with self.__lock:
+            self.__verdicts[key] = verdict
+            self.__verdicts.move_to_end(key)
+            while len(self.__verdicts) > self.max_size:
+                self.__verdicts.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "size": len(self.__verdicts),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+signature_memo = SignatureMemo()
+
+
+# Verifies each (RRset, RRSIG RRset) pair with the keys of its signer, returning one verdict per pair
+def verify_signatures(record_signature_pairs: List[Tuple[dns.rrset.RRset, dns.rrset.RRset]], keys) -> List[bool]:
+    now = time.time()
+    verdicts = [False] * len(record_signature_pairs)
+    pending = []
+
+    for index, (record, rrsig_record) in enumerate(record_signature_pairs):
+        signer_keys = {}
+        for rrsig in rrsig_record:
+            signer_key = keys.get(rrsig.signer)
+            if signer_key is not None:
+                signer_keys[rrsig.signer] = signer_key
+
+        # Memoized verdicts ignore time, so the validity window is checked on every use
+        if len(signer_keys) == 0 or not any(rrsig.inception <= now <= rrsig.expiration for rrsig in rrsig_record):
+            continue
+
+        memo_key = (__rrset_digest__(record), __rrset_digest__(rrsig_record),
+                    tuple(sorted(__rrset_digest__(signer_key) for signer_key in signer_keys.values())))
+        verdict = signature_memo.get(memo_key)
+        if verdict is not None:
+            verdicts[index] = verdict
+        else:
+            pending.append((index, memo_key, record, rrsig_record, signer_keys))
+
+    if signature_pool is not None and len(pending) > 1:
+        futures = [(index, memo_key, signature_pool.submit(__verify__, record, rrsig_record, signer_keys))
+                   for index, memo_key, record, rrsig_record, signer_keys in pending]
+        results = [(index, memo_key, future.result()) for index, memo_key, future in futures]
+    else:
+        results = [(index, memo_key, __verify__(record, rrsig_record, signer_keys))
+                   for index, memo_key, record, rrsig_record, signer_keys in pending]
+
+    for index, memo_key, verdict in results:
+        signature_memo.put(memo_key, verdict)
+        verdicts[index] = verdict
+
+    return verdicts
+
+
+# Runs in the worker processes, so it only gets picklable arguments
+def __verify__(record: dns.rrset.RRset, rrsig_record: dns.rrset.RRset,
+               signer_keys: Dict[dns.name.Name, dns.rrset.RRset]) -> bool:
+    # Imported on first use, the cryptography bindings are a large part of the startup time
+    import dns.dnssec
+    try:
+        dns.dnssec.validate(record, rrsig_record, signer_keys)
+        return True
+    except Exception:
+        return False
+
+
+# Digest of the signed content of an RRset, the TTL is left out as it counts down in caches
+def __rrset_digest__(rrset: dns.rrset.RRset) -> bytes:
+    digest = hashlib.sha256(rrset.name.to_digestable())
+    digest.update(int(rrset.rdtype).to_bytes(2, "big") + int(rrset.rdclass).to_bytes(2, "big") +
+                  int(rrset.covers).to_bytes(2, "big"))
+    for rdata in sorted(rdata.to_digestable() for rdata in rrset):
+        digest.update(len(rdata).to_bytes(2, "big") + rdata)
+    return digest.digest()
@@ -0,0 +1,129 @@
+import contextvars
+import threading
+from typing import Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Key of the flight the current code runs for, copied into helper threads with contextvars.copy_context
+current_flight_key = contextvars.ContextVar("current_flight_key", default=None)
+
+
+class CoalescingCycleError(Exception):
+    pass
+
+
+class Flight:
+    done: threading.Event
+    result: object
+    error: Optional[BaseException]
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# Common code for Part A and Part B
+# Deduplicates identical work that is in progress on several threads at once: the first caller of `do` for
+# a key runs the function, callers arriving while it runs wait for it and share its result (or exception).
+# Nothing is kept once the leader finishes, caching is left to the caches.
+# Work that needs its own result, as with glueless delegations that point at each other, could never
+# finish, so the flights each flight depends on are tracked and such a call raises CoalescingCycleError.
+class SingleFlight:
+    leaders: int
+    coalesced: int
+    cycles: int
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self.cycles = 0
+        self.__flights: Dict[Hashable, Flight] = dict()
+        self.__dependencies: Dict[Hashable, Dict[Hashable, int]] = dict()
+        self.__lock = threading.Lock()
+
+    def do(self, key: Hashable, function: Callable[[], T]) -> T:
+        parent_key = current_flight_key.get()
+
+        with self.__lock:
+            if parent_key is not None and self.__depends_on__(key, parent_key):
+                self.cycles += 1
+                raise CoalescingCycleError("Resolution of " + str(key) + " depends on itself")
+
+            flight = self.__flights.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = Flight()
+                self.__flights[key] = flight
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            self.__add_dependency__(parent_key, key)
+
+        try:
+            if is_leader:
+                return self.__lead__(key, flight, function)
+
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        finally:
+            with self.__lock:
+                self.__remove_dependency__(parent_key, key)
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "in_flight": len(self.__flights),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "cycles": self.cycles
+            }
+
+    def __lead__(self, key: Hashable, flight: Flight, function: Callable[[], T]) -> T:
+        token = current_flight_key.set(key)
+        try:
+            flight.result = function()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            current_flight_key.reset(token)
+            with self.__lock:
+                del self.__flights[key]
+            flight.done.set()
+
+    # Whether the flight for `key` is, directly or through other flights, waiting on `dependent_key`
+    def __depends_on__(self, key: Hashable, dependent_key: Hashable) -> bool:
+        seen = set()
+        stack = [key]
+        while len(stack) > 0:
+            current_key = stack.pop()
+            if current_key == dependent_key:
+                return True
+            if current_key not in seen:
+                seen.add(current_key)
+                stack += self.__dependencies.get(current_key, {}).keys()
+        return False
+
+    def __add_dependency__(self, parent_key: Optional[Hashable], key: Hashable):
+        if parent_key is not None:
+            dependencies = self.__dependencies.setdefault(parent_key, dict())
+            dependencies[key] = dependencies.get(key, 0) + 1
+
+    def __remove_dependency__(self, parent_key: Optional[Hashable], key: Hashable):
+        if parent_key is not None:
+            dependencies = self.__dependencies[parent_key]
+            dependencies[key] -= 1
+            if dependencies[key] == 0:
+                del dependencies[key]
+            if len(dependencies) == 0:
+                del self.__dependencies[parent_key]
+
+
+# Identical queries to the same name servers, see transport.query_servers
+query_flights = SingleFlight()
+# Identical resolutions and chain of trust extensions
+resolution_flights = SingleFlight()
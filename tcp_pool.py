@@ -0,0 +1,206 @@
+import socket
+import struct
+import threading
+import time
+from typing import Dict, List, Optional
+
+import dns.inet
+
+# Connections to a server are kept open this long after their last query and shared by all threads
+TCP_IDLE_TIMEOUT = 10
+# Queries outstanding on one connection before another one is opened to the same server (RFC 7766 pipelining)
+TCP_MAX_PIPELINED = 16
+TCP_MAX_CONNECTIONS_PER_SERVER = 4
+# How often a thread waiting for its response checks whether it should read from the connection itself
+TCP_POLL_INTERVAL = 0.05
+
+
+class TCPWaiter:
+    done: threading.Event
+    response_wire: Optional[bytes]
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response_wire = None
+
+
+# Common code for Part A and Part B
+# One TCP connection with any number of queries in flight. Responses may come back in any order, each is
+# handed to the query with its message ID. There is no reader thread, whichever waiting thread gets the
+# read lock reads the next response for everyone.
+class TCPConnection:
+    server_ip: str
+    last_used: float
+    closed: bool
+
+    def __init__(self, server_ip: str, sock: socket.socket):
+        self.server_ip = server_ip
+        self.last_used = time.time()
+        self.closed = False
+        self.__sock = sock
+        self.__waiters: Dict[int, TCPWaiter] = dict()
+        self.__lock = threading.Lock()
+        self.__send_lock = threading.Lock()
+        self.__read_lock = threading.Lock()
+
+    def outstanding(self) -> int:
+        with self.__lock:
+            return len(self.__waiters)
+
+    # Response to the query, None on timeout or when the connection broke. The query's ID must not be
+    # in flight on this connection already.
+    def query(self, wire: bytes, timeout: float) -> Optional[bytes]:
+        query_id = struct.unpack("!H", wire[:2])[0]
+        waiter = TCPWaiter()
+        with self.__lock:
+            if self.closed or query_id in self.__waiters:
+                return None
+            self.__waiters[query_id] = waiter
+            self.last_used = time.time()
+
+        deadline = time.time() + timeout
+        try:
+            with self.__send_lock:
+                self.__sock.sendall(struct.pack("!H", len(wire)) + wire)
+
+            while not waiter.done.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+
+                if self.__read_lock.acquire(blocking=False):
+                    try:
+                        if not waiter.done.is_set():
+                            self.__read_response__(min(remaining, TCP_POLL_INTERVAL))
+                    finally:
+                        self.__read_lock.release()
+                else:
+                    waiter.done.wait(min(remaining, TCP_POLL_INTERVAL))
+
+            return waiter.response_wire
+        except OSError:
+            self.close()
+            return None
+        finally:
+            with self.__lock:
+                self.__waiters.pop(query_id, None)
+                self.last_used = time.time()
+
+    def close(self):
+        with self.__lock:
+            if self.closed:
+                return
+            self.closed = True
+            waiters = list(self.__waiters.values())
+
+        self.__sock.close()
+        for waiter in waiters:
+            waiter.done.set()
+
+    # Reads one response and hands it to its query, returns quietly when none started arriving in `timeout`
+    def __read_response__(self, timeout: float):
+        self.__sock.settimeout(timeout)
+        try:
+            first_byte = self.__sock.recv(1)
+        except socket.timeout:
+            return
+        if len(first_byte) == 0:
+            raise ConnectionResetError("connection closed by server")
+
+        # Once a response started arriving it is read in full, a partial read would lose the framing
+        self.__sock.settimeout(TCP_IDLE_TIMEOUT)
+        length = struct.unpack("!H", first_byte + self.__recv_exactly__(1))[0]
+        response_wire = self.__recv_exactly__(length)
+
+        with self.__lock:
+            waiter = self.__waiters.get(struct.unpack("!H", response_wire[:2])[0]) if length >= 2 else None
+        if waiter is not None:
+            waiter.response_wire = response_wire
+            waiter.done.set()
+
+    def __recv_exactly__(self, count: int) -> bytes:
+        data = b""
+        while len(data) < count:
+            chunk = self.__sock.recv(count - len(data))
+            if len(chunk) == 0:
+                raise ConnectionResetError("connection closed by server")
+            data += chunk
+        return data
+
+
+# Open connections by server, idle ones are closed when the pool is next used after TCP_IDLE_TIMEOUT
+class TCPConnectionPool:
+    def __init__(self):
+        self.__connections: Dict[str, List[TCPConnection]] = dict()
+        self.__lock = threading.Lock()
+
+    def query(self, wire: bytes, server_ip: str, port: int, timeout: float) -> Optional[bytes]:
+        deadline = time.time() + timeout
+        connection = self.__get_connection__(server_ip, port, timeout)
+        if connection is None:
+            return None
+
+        response_wire = connection.query(wire, deadline - time.time())
+        # The server may have closed a connection that looked idle, retry once on a new one
+        if response_wire is None and connection.closed and deadline > time.time():
+            connection = self.__get_connection__(server_ip, port, deadline - time.time())
+            if connection is not None:
+                response_wire = connection.query(wire, deadline - time.time())
+
+        return response_wire
+
+    def close(self):
+        with self.__lock:
+            connections = [connection for server in self.__connections.values() for connection in server]
+            self.__connections.clear()
+
+        for connection in connections:
+            connection.close()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "servers": len(self.__connections),
+                "connections": sum(len(server) for server in self.__connections.values())
+            }
+
+    def __get_connection__(self, server_ip: str, port: int, timeout: float) -> Optional[TCPConnection]:
+        now = time.time()
+        with self.__lock:
+            self.__close_idle__(now)
+            connections = self.__connections.get(server_ip, [])
+            least_busy = min(connections, key=lambda connection: connection.outstanding(), default=None)
+            if least_busy is not None and (least_busy.outstanding() < TCP_MAX_PIPELINED or
+                                           len(connections) >= TCP_MAX_CONNECTIONS_PER_SERVER):
+                return least_busy
+
+        try:
+            sock = socket.socket(dns.inet.af_for_address(server_ip), socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect((server_ip, port))
+        except (OSError, ValueError) as e:
+            print("Error when querying DNS server " + server_ip + " over TCP error message " + str(e))
+            return None
+
+        connection = TCPConnection(server_ip, sock)
+        with self.__lock:
+            self.__connections.setdefault(server_ip, []).append(connection)
+        return connection
+
+    def __close_idle__(self, now: float):
+        for server_ip in list(self.__connections):
+            live_connections = []
+            for connection in self.__connections[server_ip]:
+                if connection.closed or (connection.outstanding() == 0 and
+                                         now - connection.last_used > TCP_IDLE_TIMEOUT):
+                    connection.close()
+                else:
+                    live_connections.append(connection)
+
+            if len(live_connections) > 0:
+                self.__connections[server_ip] = live_connections
+            else:
+                del self.__connections[server_ip]
+
+
+tcp_pool = TCPConnectionPool()
@@ -0,0 +1,117 @@
+import unittest
+
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+from cache import RRsetCache, cache_response_message, rrset_cache
+
+SOA_TEXT = "ns1.example.com. hostmaster.example.com. 1 7200 3600 1209600 300"
+
+
+def make_soa(zone: str = "example.com.", ttl: int = 3600) -> dns.rrset.RRset:
+    return dns.rrset.from_text(zone, ttl, "IN", "SOA", SOA_TEXT)
+
+
+def name(text: str) -> dns.name.Name:
+    return dns.name.from_text(text)
+
+
+# Negative answers (RFC 2308) next to the RRsets, NXDOMAIN also covering the names below (RFC 8020)
+class NegativeCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = RRsetCache()
+
+    def test_nxdomain_covers_names_below(self):
+        self.cache.put_negative(name("gone.example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NXDOMAIN,
+                                make_soa())
+
+        for qname, rdtype in (("gone.example.com.", dns.rdatatype.MX), ("a.b.gone.example.com.", dns.rdatatype.A)):
+            rcode, soa_rrset = self.cache.get_negative(name(qname), rdtype)
+            self.assertEqual(rcode, dns.rcode.NXDOMAIN)
+            self.assertEqual(soa_rrset.name, name("example.com."))
+        self.assertIsNone(self.cache.get_negative(name("example.com."), dns.rdatatype.A))
+
+    def test_nodata_is_per_type(self):
+        self.cache.put_negative(name("mail.example.com."), dns.rdatatype.MX, dns.rdataclass.IN, dns.rcode.NOERROR,
+                                make_soa())
+
+        self.assertEqual(self.cache.get_negative(name("mail.example.com."), dns.rdatatype.MX)[0], dns.rcode.NOERROR)
+        self.assertIsNone(self.cache.get_negative(name("mail.example.com."), dns.rdatatype.A))
+        self.assertIsNone(self.cache.get_negative(name("x.mail.example.com."), dns.rdatatype.MX))
+
+    def test_ttl_is_capped_by_soa_minimum(self):
+        self.cache.put_negative(name("gone.example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NXDOMAIN,
+                                make_soa())
+
+        _, soa_rrset = self.cache.get_negative(name("gone.example.com."), dns.rdatatype.A)
+        self.assertLessEqual(soa_rrset.ttl, 300)
+
+    def test_put_drops_nxdomain_of_name_and_ancestors(self):
+        self.cache.put_negative(name("example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NXDOMAIN,
+                                make_soa("com."))
+        self.cache.put(dns.rrset.from_text("www.example.com.", 300, "IN", "A", "192.0.2.1"))
+
+        self.assertIsNone(self.cache.get_negative(name("example.com."), dns.rdatatype.A))
+        self.assertIsNone(self.cache.get_negative(name("other.example.com."), dns.rdatatype.A))
+
+    def test_secure_lookup_ignores_insecure_negative(self):
+        self.cache.put_negative(name("gone.example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NXDOMAIN,
+                                make_soa())
+
+        self.assertIsNone(self.cache.get_negative(name("gone.example.com."), dns.rdatatype.A, secure=True))
+        self.assertIsNotNone(self.cache.get_negative(name("gone.example.com."), dns.rdatatype.A))
+
+    def test_insecure_negative_does_not_replace_secure_one(self):
+        self.cache.put_negative(name("gone.example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NXDOMAIN,
+                                make_soa(), secure=True)
+        self.cache.put_negative(name("gone.example.com."), dns.rdatatype.A, dns.rdataclass.IN, dns.rcode.NOERROR,
+                                make_soa())
+
+        self.assertEqual(self.cache.get_negative(name("gone.example.com."), dns.rdatatype.A, secure=True)[0],
+                         dns.rcode.NXDOMAIN)
+
+
+# Negative answers taken from responses by cache_response_message
+class NegativeResponseTest(unittest.TestCase):
+    def setUp(self):
+        rrset_cache.clear()
+
+    def tearDown(self):
+        rrset_cache.clear()
+
+    def test_nxdomain_response(self):
+        response_message = dns.message.make_response(dns.message.make_query("gone.example.com.", "A"))
+        response_message.set_rcode(dns.rcode.NXDOMAIN)
+        response_message.authority.append(make_soa())
+        cache_response_message(response_message, name("example.com."), secure=True)
+
+        self.assertEqual(rrset_cache.get_negative(name("gone.example.com."), dns.rdatatype.A, secure=True)[0],
+                         dns.rcode.NXDOMAIN)
+
+    def test_soa_outside_zone_is_ignored(self):
+        response_message = dns.message.make_response(dns.message.make_query("gone.example.com.", "A"))
+        response_message.set_rcode(dns.rcode.NXDOMAIN)
+        response_message.authority.append(make_soa("com."))
+        cache_response_message(response_message, name("example.com."))
+
+        self.assertIsNone(rrset_cache.get_negative(name("gone.example.com."), dns.rdatatype.A))
+
+    def test_negative_at_end_of_cname_chain_is_not_secure(self):
+        response_message = dns.message.make_response(dns.message.make_query("www.example.com.", "A"))
+        response_message.set_rcode(dns.rcode.NXDOMAIN)
+        response_message.answer.append(dns.rrset.from_text("www.example.com.", 300, "IN", "CNAME",
+                                                           "gone.example.com."))
+        response_message.authority.append(make_soa())
+        cache_response_message(response_message, name("example.com."), secure=True)
+
+        self.assertIsNone(rrset_cache.get_negative(name("gone.example.com."), dns.rdatatype.A, secure=True))
+        self.assertEqual(rrset_cache.get_negative(name("gone.example.com."), dns.rdatatype.A)[0],
+                         dns.rcode.NXDOMAIN)
+
+
+if __name__ == '__main__':
+    unittest.main()
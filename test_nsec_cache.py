@@ -0,0 +1,169 @@
+import unittest
+
+import dns.dnssec
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+from cache import rrset_cache
+from dnssec_validation import validate_denial
+from nsec_cache import AggressiveNsecCache
+
+ZONE = dns.name.from_text("example.com.")
+SOA_TEXT = "ns1.example.com. hostmaster.example.com. 1 7200 3600 1209600 300"
+# The zone's NSEC chain: the apex, a.example.com with an A record and m.example.com with an MX record
+NSEC_CHAIN = [
+    ("example.com.", "a.example.com. A NS SOA RRSIG NSEC DNSKEY"),
+    ("a.example.com.", "m.example.com. A RRSIG NSEC"),
+    ("m.example.com.", "example.com. MX RRSIG NSEC")
+]
+
+
+def name(text: str) -> dns.name.Name:
+    return dns.name.from_text(text)
+
+
+# RRSIG RRset of the zone's key over the RRset, signatures are not verified here
+def make_rrsig(rrset: dns.rrset.RRset) -> dns.rrset.RRset:
+    return dns.rrset.from_text(rrset.name, rrset.ttl, "IN", "RRSIG",
+                               "%s 15 %d %d 20300101000000 20000101000000 1 %s AAAA" % (
+                                   dns.rdatatype.to_text(rrset.rdtype), len(rrset.name) - 1, rrset.ttl, ZONE))
+
+
+# Negative response to the question, with the zone's signed SOA and the given signed NSEC or NSEC3 RRsets
+def make_negative_response(qname: str, rdtype: str, rcode: dns.rcode.Rcode,
+                           denial_rrsets: list) -> dns.message.Message:
+    response_message = dns.message.make_response(dns.message.make_query(qname, rdtype, want_dnssec=True))
+    response_message.set_rcode(rcode)
+    for rrset in [dns.rrset.from_text(ZONE, 3600, "IN", "SOA", SOA_TEXT)] + denial_rrsets:
+        response_message.authority += [rrset, make_rrsig(rrset)]
+    return response_message
+
+
+def make_nsec(owner: str) -> dns.rrset.RRset:
+    return dns.rrset.from_text(owner, 300, "IN", "NSEC", dict(NSEC_CHAIN)[owner])
+
+
+# One NSEC3 record at the hash of the apex whose range wraps around the whole hash space, so every other
+# name is covered by it
+def make_nsec3(flags: int = 0, algorithm: int = 1) -> dns.rrset.RRset:
+    apex_hash = dns.dnssec.nsec3_hash(ZONE, b"", 0, 1).lower()
+    return dns.rrset.from_text(dns.name.from_text(apex_hash, ZONE), 300, "IN", "NSEC3",
+                               "%d %d 0 - %s A NS SOA RRSIG DNSKEY NSEC3PARAM" % (algorithm, flags, apex_hash))
+
+
+# Aggressive use of validated NSEC and NSEC3 records (RFC 8198)
+class NsecSynthesisTest(unittest.TestCase):
+    def setUp(self):
+        self.nsec_cache = AggressiveNsecCache()
+
+    def tearDown(self):
+        rrset_cache.clear()
+
+    def test_name_covered_by_nsec_range_is_nxdomain(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "c.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec("a.example.com."), make_nsec("example.com.")]))
+
+        rcode, soa_rrset = self.nsec_cache.synthesize(name("c.example.com."), dns.rdatatype.A)
+        self.assertEqual(rcode, dns.rcode.NXDOMAIN)
+        self.assertEqual(soa_rrset.name, ZONE)
+        self.assertLessEqual(soa_rrset.ttl, 300)
+        # Another name in the same range needs no other records
+        self.assertEqual(self.nsec_cache.synthesize(name("k.example.com."), dns.rdatatype.MX)[0],
+                         dns.rcode.NXDOMAIN)
+
+    def test_type_missing_from_bitmap_is_nodata(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "a.example.com.", "MX", dns.rcode.NOERROR, [make_nsec("a.example.com.")]))
+
+        self.assertEqual(self.nsec_cache.synthesize(name("a.example.com."), dns.rdatatype.MX)[0], dns.rcode.NOERROR)
+        self.assertIsNone(self.nsec_cache.synthesize(name("a.example.com."), dns.rdatatype.A))
+
+    def test_uncovered_wildcard_proves_nothing(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "c.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec("a.example.com.")]))
+
+        self.assertIsNone(self.nsec_cache.synthesize(name("c.example.com."), dns.rdatatype.A))
+
+    def test_unsigned_nsec_is_not_taken(self):
+        response_message = make_negative_response("c.example.com.", "A", dns.rcode.NXDOMAIN, [])
+        response_message.authority += [make_nsec("a.example.com."), make_nsec("example.com.")]
+        self.nsec_cache.put_response(response_message)
+
+        self.assertIsNone(self.nsec_cache.synthesize(name("c.example.com."), dns.rdatatype.A))
+
+    def test_nsec3_range_is_nxdomain(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "gone.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec3()]))
+
+        self.assertEqual(self.nsec_cache.synthesize(name("other.example.com."), dns.rdatatype.A)[0],
+                         dns.rcode.NXDOMAIN)
+        self.assertEqual(self.nsec_cache.synthesize(ZONE, dns.rdatatype.MX)[0], dns.rcode.NOERROR)
+
+    def test_nsec3_opt_out_proves_nothing(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "gone.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec3(flags=1)]))
+
+        self.assertIsNone(self.nsec_cache.synthesize(name("other.example.com."), dns.rdatatype.A))
+
+    def test_nsec3_with_unsupported_algorithm_is_skipped(self):
+        self.nsec_cache.put_response(make_negative_response(
+            "gone.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec3(algorithm=2)]))
+
+        self.assertIsNone(self.nsec_cache.synthesize(name("other.example.com."), dns.rdatatype.A))
+        self.assertEqual(self.nsec_cache.stats()["ranges"], 0)
+
+
+# Negative answers are only accepted with NSEC or NSEC3 records proving them (RFC 4035 section 5.4)
+class DenialValidationTest(unittest.TestCase):
+    def test_nxdomain_with_proof(self):
+        response_message = make_negative_response(
+            "c.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec("a.example.com."), make_nsec("example.com.")])
+
+        self.assertEqual(validate_denial(response_message, ZONE), (None, True))
+
+    def test_forged_nxdomain_without_nsec_is_rejected(self):
+        response_message = make_negative_response("a.example.com.", "A", dns.rcode.NXDOMAIN, [])
+
+        self.assertEqual(validate_denial(response_message, ZONE)[0], "DNSSEC denial of existence missing")
+
+    def test_nxdomain_for_existing_name_is_rejected(self):
+        # The proof of another name replayed for one that exists
+        response_message = make_negative_response(
+            "m.example.com.", "A", dns.rcode.NXDOMAIN, [make_nsec("a.example.com."), make_nsec("example.com.")])
+
+        self.assertIsNotNone(validate_denial(response_message, ZONE)[0])
+
+    def test_nodata_with_type_in_bitmap_is_rejected(self):
+        response_message = make_negative_response(
+            "a.example.com.", "A", dns.rcode.NOERROR, [make_nsec("a.example.com.")])
+
+        self.assertIsNotNone(validate_denial(response_message, ZONE)[0])
+
+    def test_nodata_with_proof(self):
+        response_message = make_negative_response(
+            "m.example.com.", "A", dns.rcode.NOERROR, [make_nsec("m.example.com.")])
+
+        self.assertEqual(validate_denial(response_message, ZONE), (None, True))
+
+    def test_nsec_signed_by_other_zone_is_rejected(self):
+        response_message = make_negative_response("c.example.com.", "A", dns.rcode.NXDOMAIN, [])
+        for owner in ("a.example.com.", "example.com."):
+            nsec_rrset = make_nsec(owner)
+            rrsig_rrset = make_rrsig(nsec_rrset)
+            response_message.authority += [nsec_rrset, dns.rrset.from_rdata_list(
+                nsec_rrset.name, 300, [rrsig_rrset[0].replace(signer=name("com."))])]
+
+        self.assertIsNotNone(validate_denial(response_message, ZONE)[0])
+
+    def test_nsec3_opt_out_is_insecure(self):
+        response_message = make_negative_response("gone.example.com.", "A", dns.rcode.NXDOMAIN,
+                                                  [make_nsec3(flags=1)])
+
+        self.assertEqual(validate_denial(response_message, ZONE), (None, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
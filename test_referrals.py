@@ -0,0 +1,107 @@
+import unittest
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rrset
+
+from referrals import parse_referral
+
+
+def make_query() -> dns.message.Message:
+    return dns.message.make_query("www.example.com.", "A", use_edns=0, payload=1232)
+
+
+# Referral from the com servers to example.com with the glue of its name servers
+def make_referral(request_message: dns.message.Message) -> dns.message.Message:
+    response_message = dns.message.make_response(request_message)
+    response_message.authority.append(dns.rrset.from_text(
+        "example.com.", 172800, "IN", "NS", "ns1.example.com.", "ns2.example.com.", "ns.example.net."))
+    response_message.additional.append(dns.rrset.from_text(
+        "ns1.example.com.", 172800, "IN", "A", "192.0.2.1", "192.0.2.11"))
+    response_message.additional.append(dns.rrset.from_text("ns1.example.com.", 172800, "IN", "AAAA", "2001:db8::1"))
+    response_message.additional.append(dns.rrset.from_text("ns2.example.com.", 86400, "IN", "A", "192.0.2.2"))
+    return response_message
+
+
+# The lean referral decoder against dnspython's full message parser
+class ReferralParserTest(unittest.TestCase):
+    def assert_parsed_like_dnspython(self, request_message: dns.message.Message, response_wire: bytes):
+        referral_message = parse_referral(request_message, response_wire)
+        full_message = dns.message.from_wire(response_wire)
+
+        self.assertIsNotNone(referral_message)
+        self.assertEqual(referral_message.id, full_message.id)
+        self.assertEqual(referral_message.flags, full_message.flags)
+        self.assertEqual(referral_message.rcode(), full_message.rcode())
+        self.assertEqual(referral_message.question, full_message.question)
+        self.assertEqual(referral_message.answer, full_message.answer)
+        self.assertEqual(referral_message.authority, full_message.authority)
+        # Names keep the case they came with
+        self.assertEqual([rrset.name.to_text() for rrset in referral_message.authority + referral_message.additional],
+                         [rrset.name.to_text() for rrset in full_message.authority + full_message.additional])
+        self.assertEqual([rrset.ttl for rrset in referral_message.authority],
+                         [rrset.ttl for rrset in full_message.authority])
+        self.assertEqual(referral_message.additional, full_message.additional)
+        self.assertEqual([rrset.ttl for rrset in referral_message.additional],
+                         [rrset.ttl for rrset in full_message.additional])
+        self.assertEqual(referral_message.wire_size, len(response_wire))
+
+    def test_referral_with_glue(self):
+        request_message = make_query()
+        self.assert_parsed_like_dnspython(request_message, make_referral(request_message).to_wire())
+
+    def test_referral_without_glue(self):
+        request_message = make_query()
+        response_message = make_referral(request_message)
+        response_message.additional.clear()
+        self.assert_parsed_like_dnspython(request_message, response_message.to_wire())
+
+    def test_referral_without_edns(self):
+        request_message = dns.message.make_query("www.example.com.", "A")
+        self.assert_parsed_like_dnspython(request_message, make_referral(request_message).to_wire())
+
+    def test_referral_to_mixed_case_names(self):
+        request_message = make_query()
+        response_message = make_referral(request_message)
+        response_message.authority[0] = dns.rrset.from_text("Example.COM.", 172800, "IN", "NS", "NS1.example.com.")
+        self.assert_parsed_like_dnspython(request_message, response_message.to_wire())
+
+    def test_other_responses_are_left_to_dnspython(self):
+        request_message = make_query()
+
+        answer_message = make_referral(request_message)
+        answer_message.answer.append(dns.rrset.from_text("www.example.com.", 300, "IN", "A", "192.0.2.80"))
+        nxdomain_message = make_referral(request_message)
+        nxdomain_message.set_rcode(dns.rcode.NXDOMAIN)
+        truncated_message = make_referral(request_message)
+        truncated_message.flags |= dns.flags.TC
+        signed_message = make_referral(request_message)
+        signed_message.authority.append(dns.rrset.from_text(
+            "example.com.", 86400, "IN", "DS", "12345 13 2 " + "ab" * 32))
+        other_question_message = make_referral(dns.message.make_query("mail.example.com.", "A"))
+        other_question_message.id = request_message.id
+
+        for response_message in (answer_message, nxdomain_message, truncated_message, signed_message,
+                                 other_question_message):
+            self.assertIsNone(parse_referral(request_message, response_message.to_wire()))
+
+    def test_other_message_id_is_not_a_referral(self):
+        request_message = make_query()
+        response_message = make_referral(request_message)
+        response_message.id = (request_message.id + 1) % 65536
+        self.assertIsNone(parse_referral(request_message, response_message.to_wire()))
+
+    def test_malformed_wire_is_not_a_referral(self):
+        request_message = make_query()
+        response_wire = make_referral(request_message).to_wire()
+
+        self.assertIsNone(parse_referral(request_message, response_wire[:-3]))
+        self.assertIsNone(parse_referral(request_message, response_wire + b"\x00"))
+        # The question name replaced by a compression pointer to itself
+        looped_wire = response_wire[:12] + b"\xc0\x0c" + response_wire[12 + len(b"\x03www\x07example\x03com\x00"):]
+        self.assertIsNone(parse_referral(request_message, looped_wire))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+import asyncio
+import socket
+import time
+import unittest
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+
+import cache
+import dnssec_validation
+import mydig
+import mydig_dnssec
+import transport
+from cache import rrset_cache
+from dnssec_validation import trust_cache
+from infra import infra_cache
+from server import ResolverServer
+from zone_cuts import zone_cut_index
+
+
+# The daemon answers from an expired cache entry when the upstream servers cannot be reached (RFC 8767)
+class ServeStaleTest(unittest.TestCase):
+    def setUp(self):
+        self.dns_port = transport.DNS_PORT
+        self.query_timeout = mydig.DNS_QUERY_TIMEOUT
+        self.dnssec_query_timeout = mydig_dnssec.DNS_QUERY_TIMEOUT
+        self.trust_anchors = dnssec_validation.trust_anchors
+        self.root_server_ips = mydig.root_server_ips_by_file.get(mydig.ROOT_SERVER_IPV4S_FILE_NAME)
+
+        # A local port nothing listens on stands in for unreachable root servers
+        unused_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        unused_socket.bind(("127.0.0.1", 0))
+        transport.DNS_PORT = unused_socket.getsockname()[1]
+        unused_socket.close()
+        mydig.DNS_QUERY_TIMEOUT = 0.2
+        mydig_dnssec.DNS_QUERY_TIMEOUT = 0.2
+        mydig.root_server_ips_by_file[mydig.ROOT_SERVER_IPV4S_FILE_NAME] = ["127.0.0.1"]
+        # A made up root key, trusted as an anchor without asking the unreachable root servers for it
+        dnssec_validation.trust_anchors = (None, dns.rrset.from_text(
+            ".", 3600, "IN", "DNSKEY", "257 3 15 l02Woi0iS8Aa25FQkUd9RMzZHJpBoRQwAQEX1SxZJA4="))
+
+        rrset_cache.clear()
+        zone_cut_index.clear()
+        infra_cache.clear()
+        trust_cache.clear()
+        rrset_cache.stale_max_age = 60
+
+    def tearDown(self):
+        transport.DNS_PORT = self.dns_port
+        mydig.DNS_QUERY_TIMEOUT = self.query_timeout
+        mydig_dnssec.DNS_QUERY_TIMEOUT = self.dnssec_query_timeout
+        dnssec_validation.trust_anchors = self.trust_anchors
+        if self.root_server_ips is None:
+            mydig.root_server_ips_by_file.pop(mydig.ROOT_SERVER_IPV4S_FILE_NAME, None)
+        else:
+            mydig.root_server_ips_by_file[mydig.ROOT_SERVER_IPV4S_FILE_NAME] = self.root_server_ips
+
+        rrset_cache.clear()
+        zone_cut_index.clear()
+        infra_cache.clear()
+        trust_cache.clear()
+        rrset_cache.stale_max_age = cache.STALE_MAX_AGE
+
+    def test_answers_from_expired_entry(self):
+        rrset_cache.put(dns.rrset.from_text("mail.example.com.", 1, "IN", "A", "10.0.0.25"))
+        time.sleep(1.1)
+
+        query = dns.message.make_query("mail.example.com.", dns.rdatatype.A)
+        response_wire = asyncio.run(ResolverServer().handle_query(query.to_wire(), over_udp=True))
+        response = dns.message.from_wire(response_wire)
+
+        self.assertEqual(response.rcode(), dns.rcode.NOERROR)
+        self.assertTrue(response.flags & dns.flags.RA)
+        self.assertEqual([item.address for rrset in response.answer for item in rrset], ["10.0.0.25"])
+        self.assertEqual(response.answer[0].ttl, cache.STALE_ANSWER_TTL)
+        self.assertEqual(rrset_cache.stats()["stale_hits"], 1)
+
+    def test_answers_from_expired_validated_entry(self):
+        rrset_cache.put(dns.rrset.from_text("mail.example.com.", 1, "IN", "A", "10.0.0.25"), secure=True)
+        rrset_cache.put(dns.rrset.from_text("www.example.com.", 1, "IN", "A", "10.0.0.80"))
+        time.sleep(1.1)
+
+        server = ResolverServer(dnssec=True)
+        query = dns.message.make_query("mail.example.com.", dns.rdatatype.A)
+        response = dns.message.from_wire(asyncio.run(server.handle_query(query.to_wire(), over_udp=True)))
+        self.assertEqual(response.rcode(), dns.rcode.NOERROR)
+        self.assertTrue(response.flags & dns.flags.AD)
+        self.assertEqual([item.address for rrset in response.answer for item in rrset], ["10.0.0.25"])
+
+        # Records that never passed validation are not served stale either
+        query = dns.message.make_query("www.example.com.", dns.rdatatype.A)
+        response = dns.message.from_wire(asyncio.run(server.handle_query(query.to_wire(), over_udp=True)))
+        self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+
+    def test_fails_without_expired_entry(self):
+        query = dns.message.make_query("mail.example.com.", dns.rdatatype.A)
+        response_wire = asyncio.run(ResolverServer().handle_query(query.to_wire(), over_udp=True))
+        response = dns.message.from_wire(response_wire)
+
+        self.assertEqual(response.rcode(), dns.rcode.SERVFAIL)
+        self.assertEqual(len(response.answer), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import bisect
+import contextvars
+import threading
+import time
+from typing import Dict, List, Optional
+
+import dns.name
+import dns.rdatatype
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+# Hop kinds
+QUERY = "query"
+TIMEOUT = "timeout"
+ERROR = "error"
+CACHE = "cache"
+VALIDATION = "validation"
+
+
+# Common code for Part A and Part B
+# One step of a resolution: a query to a server over UDP or TCP, an attempt that timed out or failed,
+# an answer taken from the caches, or a DNSSEC validation
+class Hop:
+    kind: str
+    qname: str
+    qtype: str
+    server_ip: Optional[str]
+    protocol: Optional[str]
+    duration: float
+    wire_bytes: int
+
+    def __init__(self, kind: str, qname: dns.name.Name, qtype: dns.rdatatype.RdataType, server_ip: Optional[str] = None,
+                 protocol: Optional[str] = None, duration: float = 0.0, wire_bytes: int = 0):
+        self.kind = kind
+        self.qname = qname.to_text()
+        self.qtype = dns.rdatatype.to_text(qtype)
+        self.server_ip = server_ip
+        self.protocol = protocol
+        self.duration = duration
+        self.wire_bytes = wire_bytes
+
+    def to_dict(self) -> Dict:
+        return {key: value for key, value in vars(self).items() if value is not None}
+
+    def __str__(self):
+        return self.kind + " " + self.qname + " " + self.qtype \
+               + ("" if self.server_ip is None else " @" + self.server_ip) \
+               + ("" if self.protocol is None else "/" + self.protocol) \
+               + " " + str(round(self.duration * 1000, 2)) + "ms" \
+               + ("" if self.wire_bytes == 0 else " " + str(self.wire_bytes) + " bytes")
+
+
+class QueryTrace:
+    hops: List[Hop]
+
+    def __init__(self):
+        self.hops = []
+
+    def to_dicts(self) -> List[Dict]:
+        return [hop.to_dict() for hop in self.hops]
+
+    def __str__(self):
+        return "\n".join("Hop " + str(index + 1) + " - " + str(hop) for index, hop in enumerate(self.hops))
+
+
+# Cumulative counts per bucket like Prometheus histograms, plus the sum of all observations
+class Histogram:
+    buckets: List[float]
+
+    def __init__(self, buckets: List[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            self.__counts[index] += 1
+            self.__sum += value
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+        cumulative = 0
+        buckets = dict()
+        for bound, count in zip(self.buckets + [float("inf")], counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {"buckets": buckets, "count": cumulative, "sum": total}
+
+
+# Trace of the resolution running in this context, None unless tracing is on. Lookups of name server
+# addresses started by a resolution record into its trace, resolutions sharing another one's walk do not.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+enabled = False
+
+resolution_latency = Histogram()
+validation_latency = Histogram()
+
+
+def enable_tracing():
+    global enabled
+    enabled = True
+
+
+# Starts a trace for the resolution about to run on this thread when tracing is on
+def start_trace() -> Optional[QueryTrace]:
+    if not enabled:
+        return None
+    trace = QueryTrace()
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Optional[QueryTrace], elapsed: float):
+    resolution_latency.observe(elapsed)
+    if trace is not None:
+        current_trace.set(None)
+
+
+def record_hop(kind: str, qname: dns.name.Name, qtype: dns.rdatatype.RdataType, server_ip: Optional[str] = None,
+               protocol: Optional[str] = None, duration: float = 0.0, wire_bytes: int = 0):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.hops.append(Hop(kind, qname, qtype, server_ip, protocol, duration, wire_bytes))
+
+
+# Times a DNSSEC validation, always counted in the validation histogram
+class ValidationTimer:
+    def __init__(self, qname: dns.name.Name, qtype: dns.rdatatype.RdataType):
+        self.qname = qname
+        self.qtype = qtype
+        self.started_at = 0.0
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter() - self.started_at
+        validation_latency.observe(duration)
+        record_hop(VALIDATION, self.qname, self.qtype, duration=duration)
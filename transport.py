@@ -0,0 +1,381 @@
+import heapq
+import selectors
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import dns.exception
+import dns.flags
+import dns.inet
+import dns.message
+import dns.rcode
+from dns.message import Message
+
+import capture
+from infra import infra_cache
+from referrals import parse_referral
+from singleflight import query_flights
+from tcp_pool import tcp_pool
+import tracing
+
+DNS_PORT = 53
+# Timeout for servers without RTT history, see infra.py for the others
+DNS_QUERY_TIMEOUT = 1
+# Happy eyeballs style querying: the next server is tried once the previous ones have been silent for
+# STAGGER_DELAY seconds, with at most MAX_PARALLEL_QUERIES outstanding. MAX_PARALLEL_QUERIES = 1 tries
+# servers strictly one after another.
+STAGGER_DELAY = 0.2
+MAX_PARALLEL_QUERIES = 3
+MAX_UDP_MESSAGE_SIZE = 65535
+# UDP payload size advertised with EDNS, large enough for most DNSSEC responses while avoiding IP
+# fragmentation (DNS flag day 2020). Responses that do not fit come back truncated and are asked over TCP.
+EDNS_PAYLOAD_SIZE = 1232
+# Every thread reuses one UDP socket per address family, replaced between queries after this many queries
+# so the source port keeps changing
+UDP_SOCKET_MAX_USES = 64
+
+
+class QueryAttempt:
+    server_ip: str
+    sent_at: float
+    deadline: float
+
+    def __init__(self, server_ip: str, sent_at: float, deadline: float):
+        self.server_ip = server_ip
+        self.sent_at = sent_at
+        self.deadline = deadline
+
+
+class ReusedSocket:
+    sock: socket.socket
+    uses: int
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.uses = 0
+
+
+udp_sockets = threading.local()
+
+
+# Common code for Part A and Part B
+# Lame and broken servers do not end the search, the next server is tried instead
+def is_usable_response(response_message: Message) -> bool:
+    return response_message.rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN)
+
+
+# Queries the servers fastest first with staggered parallel attempts and returns the first accepted response
+# together with the server that sent it. Outstanding attempts are abandoned once a response is accepted.
+# `timeout` applies to servers without RTT history, the others get a timeout derived from their SRTT.
+# A query identical to one already waiting on the same servers sends nothing and shares its response,
+# which must not be modified.
+def query_servers(
+        request_message: Message,
+        dns_server_ips: List[str],
+        timeout: float = DNS_QUERY_TIMEOUT,
+        stagger_delay: Optional[float] = None,
+        max_parallel: Optional[int] = None,
+        accept: Callable[[Message], bool] = is_usable_response
+) -> Tuple[Optional[Message], Optional[str]]:
+    question = request_message.question[0]
+    key = (frozenset(dns_server_ips), question.name, question.rdtype, question.rdclass, request_message.flags,
+           request_message.ednsflags, accept)
+    return query_flights.do(key, lambda: __query_servers__(
+        request_message, dns_server_ips, timeout, stagger_delay, max_parallel, accept))
+
+
+# The attempts of one query share the thread's UDP socket, taken by the first attempt and kept for the whole
+# query. Responses are matched to their attempt by source address and port, then by message ID and question.
+# Anything else, such as a late response to an abandoned attempt of an earlier query, is dropped.
+# Truncated responses are asked again over TCP. A timed replay runs the same race against the capture, its
+# clock scaled by the replay speed, so stagger, timeouts and RTTs play out as they were recorded.
+def __query_servers__(
+        request_message: Message,
+        dns_server_ips: List[str],
+        timeout: float,
+        stagger_delay: Optional[float],
+        max_parallel: Optional[int],
+        accept: Callable[[Message], bool]
+) -> Tuple[Optional[Message], Optional[str]]:
+    if capture.replayer is not None and capture.replayer.speed <= 0:
+        return __replay_query_servers__(request_message, dns_server_ips, accept)
+
+    stagger_delay = STAGGER_DELAY if stagger_delay is None else stagger_delay
+    max_parallel = max(1, MAX_PARALLEL_QUERIES if max_parallel is None else max_parallel)
+
+    wire = request_message.to_wire()
+    question = request_message.question[0]
+    pending_ips = iter(infra_cache.sort_servers(dns_server_ips))
+    has_pending_ips = True
+    attempts: Dict[str, QueryAttempt] = {}
+    next_start = time.time()
+    selector = selectors.DefaultSelector()
+    sockets: Dict[int, socket.socket] = {}
+    # Recorded responses of a timed replay as (arrival time, server, wire)
+    arrivals: List[Tuple[float, str, bytes]] = []
+    scale = 1.0 if capture.replayer is None else capture.replayer.speed
+
+    try:
+        while True:
+            now = time.time()
+
+            # Start the next attempt when a slot is free and the stagger delay has passed
+            while has_pending_ips and len(attempts) < max_parallel and now >= next_start:
+                server_ip = next(pending_ips, None)
+                if server_ip is None:
+                    has_pending_ips = False
+                    break
+
+                if server_ip in attempts:
+                    continue
+                if capture.replayer is None:
+                    if not __send__(selector, sockets, request_message, wire, server_ip):
+                        continue
+                elif not __replay_send__(arrivals, request_message, server_ip, now):
+                    continue
+
+                attempts[server_ip] = QueryAttempt(server_ip, now,
+                                                   now + infra_cache.timeout_for(server_ip, timeout) / scale)
+                next_start = now + stagger_delay / scale
+
+            for attempt in [attempt for attempt in attempts.values() if attempt.deadline <= now]:
+                print("Error when querying DNS server " + attempt.server_ip + " error message timed out")
+                infra_cache.record_timeout(attempt.server_ip)
+                tracing.record_hop(tracing.TIMEOUT, question.name, question.rdtype, attempt.server_ip, "udp",
+                                   (now - attempt.sent_at) * scale)
+                if capture.recorder is not None:
+                    capture.recorder.record(request_message, wire, attempt.server_ip, "udp", attempt.sent_at,
+                                            now - attempt.sent_at, None)
+                del attempts[attempt.server_ip]
+                next_start = now
+
+            if len(attempts) == 0:
+                if not has_pending_ips:
+                    return None, None
+                continue
+
+            wake_at = min(attempt.deadline for attempt in attempts.values())
+            if has_pending_ips and len(attempts) < max_parallel:
+                wake_at = min(wake_at, next_start)
+
+            if capture.replayer is None:
+                datagrams = []
+                for key, _ in selector.select(max(0.0, wake_at - time.time())):
+                    datagrams += __receive_all__(key.data)
+            else:
+                datagrams = __replay_receive__(arrivals, wake_at)
+
+            for response_wire, source in datagrams:
+                attempt = attempts.get(source[0])
+                if attempt is None or source[1] != DNS_PORT:
+                    continue
+
+                response_message = __parse_response__(request_message, response_wire)
+                if response_message is None:
+                    # Not a response to this query, keep waiting on the same attempt
+                    continue
+
+                rtt = (time.time() - attempt.sent_at) * scale
+                infra_cache.record_rtt(attempt.server_ip, rtt)
+                tracing.record_hop(tracing.QUERY, question.name, question.rdtype, attempt.server_ip, "udp", rtt,
+                                   len(response_wire))
+                if capture.recorder is not None:
+                    capture.recorder.record(request_message, wire, attempt.server_ip, "udp", attempt.sent_at, rtt,
+                                            response_wire)
+                del attempts[attempt.server_ip]
+                next_start = time.time()
+
+                if response_message.flags & dns.flags.TC:
+                    response_message = __query_tcp__(request_message, wire, attempt.server_ip,
+                                                     infra_cache.timeout_for(attempt.server_ip, timeout))
+
+                if response_message is not None and accept(response_message):
+                    return response_message, attempt.server_ip
+    finally:
+        for sock in sockets.values():
+            selector.unregister(sock.fileno())
+        selector.close()
+
+
+# Sends the query from the query's socket for the server's address family, taking the thread's socket and
+# watching it the first time the query needs that family
+def __send__(selector: selectors.BaseSelector, sockets: Dict[int, socket.socket], request_message: Message,
+             wire: bytes, server_ip: str) -> bool:
+    try:
+        address_family = dns.inet.af_for_address(server_ip)
+        sock = sockets.get(address_family)
+        if sock is None:
+            sock = __udp_socket__(address_family)
+            selector.register(sock.fileno(), selectors.EVENT_READ, sock)
+            sockets[address_family] = sock
+        sock.sendto(wire, (server_ip, DNS_PORT))
+        return True
+    except (OSError, ValueError) as e:
+        print("Error when querying DNS server " + server_ip + " error message " + str(e))
+        infra_cache.record_timeout(server_ip)
+        question = request_message.question[0]
+        tracing.record_hop(tracing.ERROR, question.name, question.rdtype, server_ip, "udp")
+        return False
+
+
+# Takes the attempt's exchange from the replayed capture instead of sending it. A recorded response arrives
+# once its recorded RTT, scaled by the replay speed, has passed, a recorded timeout never arrives. Servers
+# never asked in the capture are skipped.
+def __replay_send__(arrivals: List[Tuple[float, str, bytes]], request_message: Message, server_ip: str,
+                    now: float) -> bool:
+    exchange = capture.replayer.lookup(request_message, server_ip, "udp")
+    if exchange is None:
+        return False
+
+    if exchange.response_wire is not None:
+        heapq.heappush(arrivals, (now + exchange.rtt / capture.replayer.speed, server_ip, exchange.response_wire))
+    return True
+
+
+# Waits until the next replayed response arrives or `wake_at`, whichever comes first, and returns the
+# responses that have arrived as (wire, source address)
+def __replay_receive__(arrivals: List[Tuple[float, str, bytes]], wake_at: float) -> List[Tuple[bytes, tuple]]:
+    if len(arrivals) > 0:
+        wake_at = min(wake_at, arrivals[0][0])
+    time.sleep(max(0.0, wake_at - time.time()))
+
+    datagrams = []
+    now = time.time()
+    while len(arrivals) > 0 and arrivals[0][0] <= now:
+        _, server_ip, response_wire = heapq.heappop(arrivals)
+        datagrams.append((response_wire, (server_ip, DNS_PORT)))
+    return datagrams
+
+
+# The calling thread's UDP socket for the address family, a fresh one with a new source port once it has
+# been used for UDP_SOCKET_MAX_USES queries. Only called when a query starts using the family, no query of
+# the thread is waiting on the socket closed then.
+def __udp_socket__(address_family: int) -> socket.socket:
+    if not hasattr(udp_sockets, "by_family"):
+        udp_sockets.by_family = dict()
+
+    reused_socket = udp_sockets.by_family.get(address_family)
+    if reused_socket is None or reused_socket.uses >= UDP_SOCKET_MAX_USES:
+        if reused_socket is not None:
+            reused_socket.sock.close()
+
+        sock = socket.socket(address_family, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        reused_socket = ReusedSocket(sock)
+        udp_sockets.by_family[address_family] = reused_socket
+
+    reused_socket.uses += 1
+    return reused_socket.sock
+
+
+# Everything waiting on the socket as (wire, source address)
+def __receive_all__(sock: socket.socket) -> List[Tuple[bytes, tuple]]:
+    datagrams = []
+    while True:
+        try:
+            datagrams.append(sock.recvfrom(MAX_UDP_MESSAGE_SIZE))
+        except (BlockingIOError, InterruptedError):
+            return datagrams
+        except OSError as e:
+            print("Error when receiving DNS responses error message " + str(e))
+            return datagrams
+
+
+# Answers the query from the replayed capture without waiting (replay speed 0): servers are tried one after
+# another in the order of their RTTs, each exchange as recorded, servers never asked in the capture are
+# skipped. Only the responses are replayed, not their timing, so this is no latency measurement.
+def __replay_query_servers__(
+        request_message: Message,
+        dns_server_ips: List[str],
+        accept: Callable[[Message], bool]
+) -> Tuple[Optional[Message], Optional[str]]:
+    question = request_message.question[0]
+    for server_ip in infra_cache.sort_servers(dns_server_ips):
+        exchange = capture.replayer.lookup(request_message, server_ip, "udp")
+        if exchange is None:
+            continue
+
+        if exchange.response_wire is None:
+            print("Error when querying DNS server " + server_ip + " error message timed out")
+            infra_cache.record_timeout(server_ip)
+            tracing.record_hop(tracing.TIMEOUT, question.name, question.rdtype, server_ip, "udp", exchange.rtt)
+            continue
+
+        infra_cache.record_rtt(server_ip, exchange.rtt)
+        tracing.record_hop(tracing.QUERY, question.name, question.rdtype, server_ip, "udp", exchange.rtt,
+                           len(exchange.response_wire))
+        response_message = __parse_response__(request_message, exchange.response_wire)
+        if response_message is not None and response_message.flags & dns.flags.TC:
+            exchange = capture.replayer.lookup(request_message, server_ip, "tcp")
+            response_message = None
+            if exchange is not None and exchange.response_wire is not None:
+                tracing.record_hop(tracing.QUERY, question.name, question.rdtype, server_ip, "tcp", exchange.rtt,
+                                   len(exchange.response_wire))
+                response_message = __parse_response__(request_message, exchange.response_wire)
+
+        if response_message is not None and accept(response_message):
+            return response_message, server_ip
+
+    return None, None
+
+
+# Asks the server again over a pooled TCP connection, used when the UDP response was truncated
+def __query_tcp__(request_message: Message, wire: bytes, server_ip: str, timeout: float) -> Optional[Message]:
+    question = request_message.question[0]
+    if capture.replayer is not None:
+        exchange = capture.replayer.lookup(request_message, server_ip, "tcp")
+        if exchange is None or exchange.response_wire is None:
+            print("Error when querying DNS server " + server_ip + " over TCP error message no response")
+            tracing.record_hop(tracing.ERROR, question.name, question.rdtype, server_ip, "tcp")
+            return None
+
+        capture.replayer.wait(exchange)
+        tracing.record_hop(tracing.QUERY, question.name, question.rdtype, server_ip, "tcp", exchange.rtt,
+                           len(exchange.response_wire))
+        return __parse_response__(request_message, exchange.response_wire)
+
+    sent_at = time.time()
+    response_wire = tcp_pool.query(wire, server_ip, DNS_PORT, timeout)
+    if response_wire is None:
+        print("Error when querying DNS server " + server_ip + " over TCP error message no response")
+        tracing.record_hop(tracing.ERROR, question.name, question.rdtype, server_ip, "tcp", time.time() - sent_at)
+        return None
+
+    tracing.record_hop(tracing.QUERY, question.name, question.rdtype, server_ip, "tcp", time.time() - sent_at,
+                       len(response_wire))
+    if capture.recorder is not None:
+        capture.recorder.record(request_message, wire, server_ip, "tcp", sent_at, time.time() - sent_at, response_wire)
+
+    return __parse_response__(request_message, response_wire)
+
+
+# Plain referrals to queries without DNSSEC, most of the responses a walk gets, are decoded by the lean
+# referral parser, everything else by dnspython
+def __parse_response__(request_message: Message, response_wire: bytes) -> Optional[Message]:
+    if not request_message.ednsflags & dns.flags.DO and request_message.keyring is None:
+        referral_message = parse_referral(request_message, response_wire)
+        if referral_message is not None:
+            return referral_message
+
+    return __parse_full_response__(request_message, response_wire)
+
+
+def __parse_full_response__(request_message: Message, response_wire: bytes) -> Optional[Message]:
+    try:
+        response_message = dns.message.from_wire(
+            response_wire,
+            keyring=request_message.keyring,
+            request_mac=request_message.mac,
+            one_rr_per_rrset=False,
+            ignore_trailing=False
+        )
+    except dns.exception.DNSException:
+        return None
+
+    if not request_message.is_response(response_message):
+        return None
+
+    # Size of the message as it was received, which re-encoding would not reproduce
+    response_message.wire_size = len(response_wire)
+    return response_message
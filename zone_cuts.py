@@ -0,0 +1,238 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import dns.message
+import dns.name
+import dns.rdatatype
+import dns.rrset
+
+import persistence
+
+ZONE_CUT_MAX_SIZE = 10000
+
+
+class ZoneCut:
+    zone: dns.name.Name
+    ns_names: List[str]
+    ns_ips: List[str]
+    expires_at: float
+    secure: bool
+
+    def __init__(self, zone: dns.name.Name, ns_names: List[str], ns_ips: List[str], expires_at: float,
+                 secure: bool):
+        self.zone = zone
+        self.ns_names = ns_names
+        self.ns_ips = ns_ips
+        self.expires_at = expires_at
+        self.secure = secure
+
+
+class ZoneCutNode:
+    children: Dict[bytes, "ZoneCutNode"]
+    cut: Optional[ZoneCut]
+
+    def __init__(self):
+        self.children = {}
+        self.cut = None
+
+
+# Common code for Part A and Part B
+# Delegations learned from referrals, stored in a trie keyed by the reversed, lower cased labels of the
+# zone name so the deepest known cut above a name is found in one walk down from the root.
+# Cuts learned by mydig_dnssec after validating the DS records of the child zone are marked secure.
+# With a warm cache file open, zones not in memory are read from it outside the lock, zones it does not have
+# either are remembered (up to max_size of them) so they are not read again until added.
+class ZoneCutIndex:
+    max_size: int
+    lookups: int
+    hits: int
+    evictions: int
+
+    def __init__(self, max_size: int = ZONE_CUT_MAX_SIZE):
+        self.max_size = max_size
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+        self.__root = ZoneCutNode()
+        self.__cuts = OrderedDict()
+        self.__persisted_misses = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def add(self, zone: dns.name.Name, ns_names: List[str], ns_ips: List[str], ttl: int, secure: bool = False):
+        if ttl <= 0 or len(ns_ips) == 0 or self.max_size <= 0 or zone == dns.name.root:
+            return
+
+        now = time.time()
+        with self.__lock:
+            node = self.__find_node__(zone, create=True)
+            if node.cut is not None and node.cut.secure and not secure and node.cut.expires_at > now:
+                return
+
+            self.__insert_cut__(ZoneCut(zone, ns_names, ns_ips, now + ttl, secure))
+            self.__persisted_misses.pop(zone, None)
+
+        if persistence.persistent_store is not None:
+            persistence.persistent_store.save_zone_cut(zone, ns_names, ns_ips, now + ttl, secure)
+
+    # Deepest live cut at or above the name, or None if only the root is known. With `is_trusted`, secure cuts
+    # are only used while the chain of trust to their zone is still valid.
+    def find_closest(self, name: dns.name.Name, secure: bool = False,
+                     is_trusted: Optional[Callable[[dns.name.Name], bool]] = None) -> Optional[ZoneCut]:
+        if persistence.persistent_store is not None:
+            self.__load_persisted_cuts__(name)
+
+        now = time.time()
+        candidates = []
+
+        with self.__lock:
+            self.lookups += 1
+
+            node = self.__root
+            for label in reversed(name.labels[:-1] if name.is_absolute() else name.labels):
+                node = node.children.get(label.lower())
+                if node is None:
+                    break
+
+                cut = node.cut
+                if cut is not None and cut.expires_at <= now:
+                    del self.__cuts[cut.zone]
+                    node.cut = None
+                    cut = None
+
+                if cut is not None and (cut.secure or not secure):
+                    candidates.append(cut)
+
+        # Trust is checked outside the lock, it may have to consult the DNSSEC caches
+        for cut in reversed(candidates):
+            if is_trusted is None or is_trusted(cut.zone):
+                with self.__lock:
+                    if cut.zone in self.__cuts:
+                        self.__cuts.move_to_end(cut.zone)
+                    self.hits += 1
+                return cut
+
+        return None
+
+    def clear(self):
+        with self.__lock:
+            self.__root = ZoneCutNode()
+            self.__cuts.clear()
+            self.__persisted_misses.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self.__lock:
+            return {
+                "size": len(self.__cuts),
+                "max_size": self.max_size,
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "evictions": self.evictions
+            }
+
+    def __insert_cut__(self, cut: ZoneCut):
+        node = self.__find_node__(cut.zone, create=True)
+        node.cut = cut
+        self.__cuts[cut.zone] = node
+        self.__cuts.move_to_end(cut.zone)
+
+        while len(self.__cuts) > self.max_size:
+            _, evicted_node = self.__cuts.popitem(last=False)
+            evicted_node.cut = None
+            self.evictions += 1
+
+    # Pulls the cuts above the name that are not in memory from the on-disk warm cache, reading it outside the
+    # lock. A cut added meanwhile is newer than the one read.
+    def __load_persisted_cuts__(self, name: dns.name.Name):
+        missing_zones = []
+        with self.__lock:
+            while len(name.labels) > 1:
+                if name not in self.__cuts and name not in self.__persisted_misses:
+                    missing_zones.append(name)
+                name = name.parent()
+        if len(missing_zones) == 0:
+            return
+
+        loaded_cuts = persistence.persistent_store.load_zone_cuts(missing_zones)
+        with self.__lock:
+            loaded_zones = set()
+            for zone, ns_names, ns_ips, expires_at, secure in loaded_cuts:
+                loaded_zones.add(zone)
+                if zone not in self.__cuts:
+                    self.__insert_cut__(ZoneCut(zone, ns_names, ns_ips, expires_at, secure))
+
+            for zone in missing_zones:
+                if zone not in loaded_zones:
+                    self.__persisted_misses[zone] = True
+                    if len(self.__persisted_misses) > self.max_size:
+                        self.__persisted_misses.popitem(last=False)
+
+    def __find_node__(self, zone: dns.name.Name, create: bool) -> Optional[ZoneCutNode]:
+        node = self.__root
+        for label in reversed(zone.labels[:-1] if zone.is_absolute() else zone.labels):
+            child = node.children.get(label.lower())
+            if child is None:
+                if not create:
+                    return None
+                child = ZoneCutNode()
+                node.children[label.lower()] = child
+            node = child
+        return node
+
+
+zone_cut_index = ZoneCutIndex()
+
+
+# Zone and servers of the deepest known zone cut above the name, or the root zone and the root servers if
+# none is known
+def closest_name_servers(name: dns.name.Name, root_server_ips: List[str], secure: bool = False,
+                         is_trusted: Optional[Callable[[dns.name.Name], bool]] = None) -> \
+      Tuple[dns.name.Name, List[str]]:
+    cut = zone_cut_index.find_closest(name, secure, is_trusted)
+    return (dns.name.root, root_server_ips) if cut is None else (cut.zone, list(cut.ns_ips))
+
+
+# The zone a referral response from the servers of `zone` delegates to, None when it is not a referral
+def referral_zone(response_message: dns.message.Message, zone: dns.name.Name) -> Optional[dns.name.Name]:
+    rrset = referral_ns_rrset(response_message, zone)
+    return rrset.name if rrset is not None else None
+
+
+# The NS RRset of a referral from the servers of `zone`. A referral can only delegate a zone strictly below
+# the one asked that contains the name being resolved, upward and sideways referrals are not followed.
+def referral_ns_rrset(response_message: dns.message.Message, zone: dns.name.Name) -> Optional[dns.rrset.RRset]:
+    qname = response_message.question[0].name
+    for rrset in response_message.authority:
+        if rrset.rdtype == dns.rdatatype.NS and qname.is_subdomain(rrset.name) and rrset.name != zone and \
+                rrset.name.is_subdomain(zone):
+            return rrset
+    return None
+
+
+# Glue address RRsets of the referral's name servers, other address records in the additional section are
+# no business of the referral
+def referral_glue(response_message: dns.message.Message, zone: dns.name.Name) -> List[dns.rrset.RRset]:
+    rrset = referral_ns_rrset(response_message, zone)
+    if rrset is None:
+        return []
+
+    ns_names = {item.target for item in rrset.items}
+    return [glue_rrset for glue_rrset in response_message.additional
+            if glue_rrset.rdtype == dns.rdatatype.A and glue_rrset.name in ns_names]
+
+
+# Records the delegation of a referral response from the servers of `zone` once the addresses of its name
+# servers are known
+def remember_referral(response_message: dns.message.Message, zone: dns.name.Name, name_server_ips: List[str],
+                      secure: bool = False):
+    rrset = referral_ns_rrset(response_message, zone)
+    if rrset is None:
+        return
+
+    ttl = rrset.ttl
+    for glue_rrset in referral_glue(response_message, zone):
+        ttl = min(ttl, glue_rrset.ttl)
+
+    ns_names = [item.target.to_text() for item in rrset.items]
+    zone_cut_index.add(rrset.name, ns_names, name_server_ips, ttl, secure)